@@ -1,31 +1,48 @@
 import os
+import sys
+import re
+import json
 import time
+import random
+import sqlite3
+import queue
+import threading
+import shutil
+import hashlib
+import binascii
+import itertools
+import mmap
+from collections import Counter, defaultdict, deque
+import unicodedata
+import select
+import ssl
+import signal
+import subprocess
+from contextlib import contextmanager, nullcontext
 import logging
+import argparse
 import traceback
 from datetime import datetime, timedelta
-from typing import List, Optional
+from typing import Iterator, List, Optional
 
 import imaplib
 import email
 from email.header import decode_header
+from email.parser import BytesHeaderParser
 
 import gspread
+from gspread.utils import rowcol_to_a1
 from google.oauth2.service_account import Credentials
-from googleapiclient.errors import HttpError
 
+from html.parser import HTMLParser
+
+import requests
+from requests.adapters import HTTPAdapter
 from dateutil import parser
 from dotenv import load_dotenv
+# seleniumはマネーフォワードへの登録でのみ使うため、使う関数の中で読み込む
 
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service as ChromeService
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import Select, WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException, NoSuchElementException
-import helium
-
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 
 # 環境変数を読み込む
@@ -40,12 +57,72 @@ PASSWORD = os.getenv("PASSWORD")
 GOOGLE_APPLICATION_CREDENTIALS = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
 MAILBOX = os.getenv("GMAIL_MAILBOXNAME")
-
-# 必須環境変数のチェック
-required_env_vars = ['SHEET_ID', 'EMAIL', 'EMAIL_PASSWORD', 'GOOGLE_APPLICATION_CREDENTIALS']
-missing_vars = [var for var in required_env_vars if not os.getenv(var)]
-if missing_vars:
-    raise EnvironmentError(f"Required environment variables are missing: {', '.join(missing_vars)}")
+IMAP_FETCH_BATCH_SIZE = int(os.getenv("IMAP_FETCH_BATCH_SIZE", "100"))  # 1回のFETCHで取得するメール数
+IMAP_FETCH_MODE = os.getenv("IMAP_FETCH_MODE", "partial")  # partial: 本文のtext/plainだけを取得 / full: RFC822全体を取得
+SHEET_FLUSH_ROWS = int(os.getenv("SHEET_FLUSH_ROWS", "100"))  # この件数たまったらスプレッドシートに書き込む
+SHEET_FLUSH_SECONDS = float(os.getenv("SHEET_FLUSH_SECONDS", "10"))  # 前回の書き込みからこの秒数経過したら書き込む
+SHEET_PARTITION = os.getenv("SHEET_PARTITION", "")  # year/month: 利用日時の年/月ごとのシート (ANAPay_2024 など) に追加する
+SHEETS_REQUESTS_PER_MINUTE = float(os.getenv("SHEETS_REQUESTS_PER_MINUTE", "60"))  # Sheets APIの1分あたりの上限 (0なら制限しない)
+SHEETS_BURST = int(os.getenv("SHEETS_BURST", "10"))  # 間隔を空けずに続けて呼べる回数
+SHEETS_MAX_RETRIES = int(os.getenv("SHEETS_MAX_RETRIES", "5"))  # 429/5xxのときの再試行回数
+SHEETS_BACKOFF_MAX = float(os.getenv("SHEETS_BACKOFF_MAX", "64"))  # 再試行の待ち時間の上限 (秒)
+IMAP_CHECKPOINT_FILE = os.getenv("IMAP_CHECKPOINT_FILE", "imap_checkpoint.json")  # UID差分同期のチェックポイント
+INGEST_STREAMING = os.getenv("INGEST_STREAMING", "1") == "1"  # 取得・解析・書き込みを並行して流す
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "200"))  # ステージ間のキューに置ける件数
+DAEMON = os.getenv("DAEMON", "0") == "1"  # 終了せずIMAP IDLEで新着メールを待ち受ける
+IMAP_IDLE_TIMEOUT = float(os.getenv("IMAP_IDLE_TIMEOUT", "1500"))  # IDLEを張り直す間隔 (秒、サーバーの30分制限より短く)
+DAEMON_RECONNECT_MAX = float(os.getenv("DAEMON_RECONNECT_MAX", "300"))  # 再接続の待ち時間の上限 (秒)
+DAEMON_KEEP_BROWSER = os.getenv("DAEMON_KEEP_BROWSER", "0") == "1"  # ログイン済みのブラウザを次の通知まで残す
+MF_BACKEND = os.getenv("MF_BACKEND", "selenium")  # マネーフォワードへの登録方法 (selenium / http)
+MF_BASE_URL = os.getenv("MF_BASE_URL", "https://moneyforward.com")
+MF_SESSION_FILE = os.getenv("MF_SESSION_FILE", "mf_session.json")  # ログイン後のCookieの保存先
+MF_WAIT_TIMEOUT = float(os.getenv("MF_WAIT_TIMEOUT", "30"))  # ログイン中の画面遷移を待つ最大秒数
+MF_WAIT_POLL = float(os.getenv("MF_WAIT_POLL", "0.2"))  # 画面の判定間隔 (秒)
+MF_SAVE_TIMEOUT = float(os.getenv("MF_SAVE_TIMEOUT", "10"))  # 手入力の保存後の画面を待つ最大秒数
+MF_SESSION_CHECK_TIMEOUT = int(os.getenv("MF_SESSION_CHECK_TIMEOUT", "10"))  # 保存したセッションの確認で待つ秒数
+MF_CONCURRENCY = int(os.getenv("MF_CONCURRENCY", "1"))  # 並行して登録するブラウザ (セッション) の数
+MF_DEBUG_PORT = int(os.getenv("MF_DEBUG_PORT", "9222"))  # Chromeのリモートデバッグポート (MF_CONCURRENCY個の連番を使う)
+MF_BROWSER_ADDRESS = os.getenv("MF_BROWSER_ADDRESS", "")  # 起動済みのChrome (host:port) にタブを開いて使う (空なら毎回起動する)
+MF_WEBDRIVER_URL = os.getenv("MF_WEBDRIVER_URL", "")  # リモートのWebDriver (空ならローカルの /usr/bin/chromedriver)
+MF_BROWSER_BINARY = os.getenv("MF_BROWSER_BINARY", "/usr/bin/chromium")  # browser コマンドで起動するChrome
+MF_BROWSER_LISTEN = os.getenv("MF_BROWSER_LISTEN", "127.0.0.1")  # browser コマンドのデバッグポートを開くアドレス
+MF_BROWSER_STATE_FILE = os.getenv("MF_BROWSER_STATE_FILE", "mf_browser.json")  # 起動中のChromeで登録した件数
+MF_BROWSER_MAX_RECORDS = int(os.getenv("MF_BROWSER_MAX_RECORDS", "500"))  # この件数を登録したらChromeを起動し直す
+MF_BROWSER_MAX_RSS_MB = float(os.getenv("MF_BROWSER_MAX_RSS_MB", "800"))  # Chrome全体のメモリがこれを超えたら起動し直す
+MF_BROWSER_CHECK_SECONDS = float(os.getenv("MF_BROWSER_CHECK_SECONDS", "30"))  # browser コマンドの確認間隔 (秒)
+MF_IN_DOUBT = os.getenv("MF_IN_DOUBT", "hold")  # 登録中に止まった記録の扱い (hold / retry / done)
+DIAGNOSTICS_LEVEL = os.getenv("DIAGNOSTICS_LEVEL", "on-failure")  # スクリーンショット (off / on-failure / trace)
+DIAGNOSTICS_KEEP_RUNS = int(os.getenv("DIAGNOSTICS_KEEP_RUNS", "10"))  # スクリーンショットを残す実行の数
+SCREENSHOT_DIR = os.getenv("SCREENSHOT_DIR", "/app/screenshots")
+METRICS_REPORT_FILE = os.getenv("METRICS_REPORT_FILE", "run_report.jsonl")  # 実行ごとの計測結果 (JSON Lines で追記)
+METRICS_PROM_FILE = os.getenv("METRICS_PROM_FILE", "anapay2mf.prom")  # Prometheus textfile collector 用
+LEDGER_DB = os.getenv("LEDGER_DB", "anapay_ledger.sqlite3")  # 利用記録の台帳 (スプレッドシートはこのミラー)
+BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS", "0")) or os.cpu_count() or 1  # backfill で解析するプロセス数
+BACKFILL_CHUNK_SIZE = int(os.getenv("BACKFILL_CHUNK_SIZE", "64"))  # 1プロセスにまとめて渡すメール数
+ACCOUNTS_FILE = os.getenv("ACCOUNTS_FILE", "accounts.json")  # 複数アカウントのプロフィール (accounts コマンド)
+ACCOUNTS_DIR = os.getenv("ACCOUNTS_DIR", "accounts")  # アカウントごとの台帳やログの置き場所
+ACCOUNTS_INGEST_WORKERS = int(os.getenv("ACCOUNTS_INGEST_WORKERS", "8"))  # 同時に取り込むアカウントの数
+ACCOUNTS_BROWSER_WORKERS = int(os.getenv("ACCOUNTS_BROWSER_WORKERS", "2"))  # 同時にブラウザで登録するアカウントの数
+ACCOUNTS_TIMEOUT = float(os.getenv("ACCOUNTS_TIMEOUT", "1800"))  # 1アカウントの ingest / submit の制限時間 (秒)
+ACCOUNTS_KILL_GRACE = float(os.getenv("ACCOUNTS_KILL_GRACE", "10"))  # タイムアウト時にSIGTERMからSIGKILLまで待つ秒数
+ACCOUNTS_INTERVAL = float(os.getenv("ACCOUNTS_INTERVAL", "0"))  # 全アカウントを繰り返し実行する間隔 (秒、0なら1回)
+
+# コマンドごとの必須環境変数 (run ではマネーフォワードのログイン情報がなくても取得まで行う)
+REQUIRED_ENV_VARS = {
+    "ingest": ['SHEET_ID', 'EMAIL', 'EMAIL_PASSWORD', 'GOOGLE_APPLICATION_CREDENTIALS'],
+    "submit": ['SHEET_ID', 'GOOGLE_APPLICATION_CREDENTIALS', 'EMAILMF', 'PASSWORD'],
+    "run": ['SHEET_ID', 'EMAIL', 'EMAIL_PASSWORD', 'GOOGLE_APPLICATION_CREDENTIALS'],
+    "backfill": ['SHEET_ID', 'GOOGLE_APPLICATION_CREDENTIALS'],
+    "accounts": [],  # アカウントごとの設定はプロフィールから渡す
+    "browser": [],
+}
+
+
+def check_env(command: str) -> None:
+    """必須環境変数のチェック"""
+    missing_vars = [var for var in REQUIRED_ENV_VARS[command] if not os.getenv(var)]
+    if missing_vars:
+        raise EnvironmentError(f"Required environment variables are missing: {', '.join(missing_vars)}")
 
 
 @dataclass
@@ -56,6 +133,8 @@ class ANAPay:
     amount: int = 0
     store: str = ""
     email_id: str = ""
+    message_id: str = ""
+    ledger_key: str = ""  # Message-IDのない通知に Ledger.add が付けた台帳のキー
 
     def values(self) -> tuple[str, str, str, str]:
         """return tuple of values for spreadsheet"""
@@ -70,187 +149,2068 @@ class ANAPay:
         return f"{self.date_of_use:%Y-%m-%d %H:%M:%S}"
 
 
-def get_mail_info(msg, email_id) -> Optional[ANAPay]:
+@dataclass
+class IMAPCheckpoint:
+    """IMAP差分同期のチェックポイント (UIDVALIDITYと処理済みの最大UID)"""
+    uidvalidity: int = 0
+    last_uid: int = 0
+
+    def advance(self, uids: list[bytes], handled: set[bytes]) -> None:
+        """
+        検索したUIDを古い順に見て、取得できたものの間だけ last_uid を進める
+        取得に失敗したUIDがあればそこで止め、次回はそのUIDから検索し直す (解析できないメールは取得済みとして進める)
+        """
+        for uid in sorted(uids, key=int):
+            if uid not in handled:
+                break
+            self.last_uid = max(self.last_uid, int(uid))
+
+
+def load_checkpoint(path: str = IMAP_CHECKPOINT_FILE) -> IMAPCheckpoint:
+    """チェックポイントを読み込む。存在しない・壊れている場合は空のチェックポイントを返す"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return IMAPCheckpoint(uidvalidity=int(data["uidvalidity"]), last_uid=int(data["last_uid"]))
+    except FileNotFoundError:
+        return IMAPCheckpoint()
+    except (ValueError, KeyError, TypeError) as e:
+        logging.warning(f"Invalid IMAP checkpoint {path}, falling back to full resync: {e}")
+        return IMAPCheckpoint()
+
+
+def save_checkpoint(checkpoint: IMAPCheckpoint, path: str = IMAP_CHECKPOINT_FILE) -> None:
+    """チェックポイントを書き込む (途中で落ちても壊れないよう一時ファイル経由で置き換える)"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"uidvalidity": checkpoint.uidvalidity, "last_uid": checkpoint.last_uid}, f)
+    os.replace(tmp_path, path)
+    logging.info(f"IMAP checkpoint saved: {checkpoint}")
+
+
+def percentile(values: list[float], q: float) -> float:
+    """最近傍順位法によるパーセンタイル"""
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 1))  # ceil
+    return ordered[int(rank) - 1]
+
+
+class StepTimer:
+    """前回のmarkからの経過時間を "<prefix>.<name>" の区間として記録する"""
+
+    def __init__(self, metrics: "RunMetrics", prefix: str):
+        self.metrics = metrics
+        self.prefix = prefix
+        self.last = time.perf_counter()
+
+    def mark(self, name: str) -> None:
+        now = time.perf_counter()
+        self.metrics.observe(f"{self.prefix}.{name}", now - self.last)
+        self.last = now
+
+
+class RunMetrics:
+    """
+    1回の実行の区間ごとの所要時間と件数のカウンター
+    write_report でJSON Lines (1実行1行) とPrometheusのtextfile形式に書き出す
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """計測をやり直す (常駐時は通知ごとに1回の実行として扱う)"""
+        with self.lock:
+            self.started_at = datetime.now()
+            self.start = time.perf_counter()
+            self.spans: dict[str, list[float]] = {}
+            self.counters: dict[str, int] = {}
+
+    @contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def steps(self, prefix: str) -> StepTimer:
+        return StepTimer(self, prefix)
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self.lock:
+            self.spans.setdefault(name, []).append(seconds)
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self) -> dict:
+        with self.lock:
+            spans = {name: list(values) for name, values in self.spans.items()}
+            counters = dict(self.counters)
+        return {
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "duration": round(time.perf_counter() - self.start, 3),
+            "counters": counters,
+            "spans": {
+                name: {
+                    "count": len(values),
+                    "total": round(sum(values), 4),
+                    "p50": round(percentile(values, 0.5), 4),
+                    "p95": round(percentile(values, 0.95), 4),
+                    "max": round(max(values), 4),
+                }
+                for name, values in sorted(spans.items())
+            },
+        }
+
+    def prometheus(self, report: dict) -> str:
+        lines = [
+            "# HELP anapay2mf_stage_seconds Per-stage latency in the last run.",
+            "# TYPE anapay2mf_stage_seconds summary",
+        ]
+        for name, span in report["spans"].items():
+            lines.append(f'anapay2mf_stage_seconds{{stage="{name}",quantile="0.5"}} {span["p50"]}')
+            lines.append(f'anapay2mf_stage_seconds{{stage="{name}",quantile="0.95"}} {span["p95"]}')
+            lines.append(f'anapay2mf_stage_seconds_sum{{stage="{name}"}} {span["total"]}')
+            lines.append(f'anapay2mf_stage_seconds_count{{stage="{name}"}} {span["count"]}')
+        lines.append("# HELP anapay2mf_records Records processed in the last run.")
+        lines.append("# TYPE anapay2mf_records gauge")
+        for name, value in sorted(report["counters"].items()):
+            lines.append(f'anapay2mf_records{{kind="{name}"}} {value}')
+        lines.append("# HELP anapay2mf_run_duration_seconds Wall-clock time of the last run.")
+        lines.append("# TYPE anapay2mf_run_duration_seconds gauge")
+        lines.append(f"anapay2mf_run_duration_seconds {report['duration']}")
+        lines.append("# HELP anapay2mf_last_run_timestamp_seconds Start time of the last run.")
+        lines.append("# TYPE anapay2mf_last_run_timestamp_seconds gauge")
+        lines.append(f"anapay2mf_last_run_timestamp_seconds {self.started_at.timestamp():.0f}")
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, json_path: str = METRICS_REPORT_FILE, prom_path: str = METRICS_PROM_FILE) -> dict:
+        report = self.report()
+        for name, span in report["spans"].items():
+            logging.info("span %s: n=%d total=%.3fs p50=%.3fs p95=%.3fs",
+                         name, span["count"], span["total"], span["p50"], span["p95"])
+        logging.info("counters: %s", report["counters"])
+        try:
+            if json_path:
+                with open(json_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(report, ensure_ascii=False) + "\n")
+            if prom_path:
+                # textfile collectorが書きかけを読まないよう一時ファイル経由で置き換える
+                with open(f"{prom_path}.tmp", "w", encoding="utf-8") as f:
+                    f.write(self.prometheus(report))
+                os.replace(f"{prom_path}.tmp", prom_path)
+        except OSError as e:
+            logging.error(f"Error writing run report: {e}")
+        return report
+
+
+metrics = RunMetrics()
+
+
+LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS anapay (
+    message_id TEXT PRIMARY KEY,
+    email_date TEXT NOT NULL,
+    date_of_use TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    store TEXT NOT NULL,
+    mf_status TEXT NOT NULL DEFAULT '',
+    sheet_name TEXT NOT NULL DEFAULT '',
+    sheet_row INTEGER,
+    sheet_status TEXT NOT NULL DEFAULT '',
+    UNIQUE (sheet_name, sheet_row)
+);
+CREATE INDEX IF NOT EXISTS anapay_email_date ON anapay (email_date);
+CREATE INDEX IF NOT EXISTS anapay_mf_pending ON anapay (email_date) WHERE mf_status != 'done';
+CREATE INDEX IF NOT EXISTS anapay_unmirrored ON anapay (email_date) WHERE sheet_row IS NULL;
+CREATE INDEX IF NOT EXISTS anapay_sheet_unsynced ON anapay (sheet_name, sheet_row)
+    WHERE sheet_row IS NOT NULL AND sheet_status != mf_status;
+CREATE TABLE IF NOT EXISTS mf_journal (
+    message_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mf_journal_submitting ON mf_journal (message_id) WHERE state = 'submitting';
+"""
+LEDGER_VERSION = 2  # PRAGMA user_version (1: email_date のUNIQUEをなくし、Message-IDがなければ内容のハッシュをキーにする、
+                    # 2: 行番号をシート名 (SHEET_PARTITION で分けたシート) と組で持つ)
+
+
+class Ledger:
+    """
+    ANA Payの利用記録を保持するローカルのSQLite台帳
+    重複チェックとマネーフォワード未登録の検索はインデックスで行い、
+    スプレッドシートには差分だけを書き込む (スプレッドシートは台帳のミラー)
+    重複はMessage-ID (なければ利用日時・金額・店舗のハッシュ) の主キーで判定するので、
+    同じ秒に届いた通知も区別でき、新しいメールの件数分の検索で済む
+    """
+
+    def __init__(self, path: str = LEDGER_DB):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        # 登録の意図と結果を1件ずつコミットするため、WALにしてコミットごとのfsyncを減らす
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] < LEDGER_VERSION:
+            self._migrate()
+        self.conn.executescript(LEDGER_SCHEMA)
+
+    def _migrate(self) -> None:
+        """古いバージョンの台帳を作り直す (途中で止まっても次回に続きから行える)"""
+        tables = {row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if "anapay_v0" not in tables:
+            if "anapay" in tables:
+                self.conn.execute("ALTER TABLE anapay RENAME TO anapay_v0")
+                for index in ("anapay_email_date", "anapay_mf_pending", "anapay_unmirrored", "anapay_sheet_unsynced"):
+                    self.conn.execute(f"DROP INDEX IF EXISTS {index}")
+                self.conn.commit()
+            else:
+                self.conn.execute(f"PRAGMA user_version = {LEDGER_VERSION}")
+                return
+        self.conn.executescript(LEDGER_SCHEMA)
+        rows = []
+        occurrences = Counter()
+        for record in self.conn.execute("SELECT * FROM anapay_v0 ORDER BY rowid"):
+            key = record["message_id"]
+            if key.startswith("date:"):
+                key = self.content_key(record["date_of_use"], record["amount"], record["store"])
+                occurrences[key] += 1
+                key = self.content_key(record["date_of_use"], record["amount"], record["store"],
+                                       occurrences[key] - 1)
+            sheet_name = record["sheet_name"] if "sheet_name" in record.keys() else ""
+            rows.append((key, record["email_date"], record["date_of_use"], record["amount"], record["store"],
+                         record["mf_status"], sheet_name, record["sheet_row"], record["sheet_status"]))
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO anapay (message_id, email_date, date_of_use, amount, store,"
+                " mf_status, sheet_name, sheet_row, sheet_status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.execute("DROP TABLE anapay_v0")
+            self.conn.execute(f"PRAGMA user_version = {LEDGER_VERSION}")
+        logging.info("Ledger migrated to version %d: %d records", LEDGER_VERSION, len(rows))
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM anapay").fetchone()[0]
+
+    @staticmethod
+    def content_key(date_of_use: str, amount, store: str, occurrence: int = 0) -> str:
+        """
+        Message-IDがわからない記録のキー (利用日時・金額・店舗のハッシュ)
+        同じ秒に同じ金額・店舗で複数回利用した記録は、2件目から "#1", "#2", ... を付けて区別する
+        """
+        digest = hashlib.sha1(f"{date_of_use}\t{int(amount)}\t{store}".encode("utf-8")).hexdigest()
+        return f"hash:{digest}#{occurrence}" if occurrence else f"hash:{digest}"
+
+    def _content_key_count(self, key: str) -> int:
+        """content_key が key (とその "#n") の記録の数"""
+        return self.conn.execute("SELECT COUNT(*) FROM anapay WHERE message_id = ? OR message_id GLOB ?",
+                                 (key, f"{key}#*")).fetchone()[0]
+
+    @classmethod
+    def key(cls, ana_pay: ANAPay) -> str:
+        """台帳のキー (Message-IDがなければ内容のハッシュで代用する)"""
+        return ana_pay.message_id or ana_pay.ledger_key or \
+            cls.content_key(ana_pay.date_of_use_str, ana_pay.amount, ana_pay.store)
+
+    def _next_content_key(self, ana_pay: ANAPay) -> str:
+        """同じ内容の記録でまだ使われていない番号の content_key"""
+        key = self.content_key(ana_pay.date_of_use_str, ana_pay.amount, ana_pay.store)
+        used = {row[0] for row in self.conn.execute(
+            "SELECT message_id FROM anapay WHERE message_id = ? OR message_id GLOB ?", (key, f"{key}#*"))}
+        occurrence = 0
+        while self.content_key(ana_pay.date_of_use_str, ana_pay.amount, ana_pay.store, occurrence) in used:
+            occurrence += 1
+        return self.content_key(ana_pay.date_of_use_str, ana_pay.amount, ana_pay.store, occurrence)
+
+    def import_records(self, records: list[dict[str, str]], sheet_name: str = "") -> int:
+        """既存のスプレッドシートの行を台帳に取り込む (台帳が空のときに一度だけ使う)"""
+        rows = []
+        occurrences = {}  # 同じ内容の行が何件目か (ほかのシートから取り込んだ分も数える)
+        for row, record in enumerate(records, start=2):  # ヘッダー行の分を足す
+            email_date = f"{parse_iso_datetime(str(record['email_date'])):%Y-%m-%d %H:%M:%S}"
+            date_of_use = f"{parse_iso_datetime(str(record['date_of_use'])):%Y-%m-%d %H:%M:%S}"
+            status = "done" if record["mf"] == "done" else ""
+            key = self.content_key(date_of_use, record["amount"], record["store"])
+            if key not in occurrences:
+                occurrences[key] = self._content_key_count(key)
+            rows.append((self.content_key(date_of_use, record["amount"], record["store"], occurrences[key]),
+                         email_date, date_of_use, int(record["amount"]), record["store"], status, sheet_name, row,
+                         status))
+            occurrences[key] += 1
+        with self.conn:
+            cursor = self.conn.executemany(
+                "INSERT OR IGNORE INTO anapay (message_id, email_date, date_of_use, amount, store,"
+                " mf_status, sheet_name, sheet_row, sheet_status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return cursor.rowcount
+
+    def last_email_date(self) -> Optional[datetime]:
+        row = self.conn.execute("SELECT MAX(email_date) FROM anapay").fetchone()
+        return datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S") if row[0] else None
+
+    def add(self, ana_pay_list: list[ANAPay]) -> list[ANAPay]:
+        """
+        台帳にない利用記録を追加し、追加できたものを返す
+        Message-IDが既にあれば重複として無視する。スプレッドシートから取り込んだ記録など
+        Message-IDのない同じ内容の記録があれば、そのキーをMessage-IDに置き換えて重複とする
+        同じ内容の記録が複数あれば、まだ置き換えていない最初の1件だけを置き換える
+        Message-IDのない通知は、同じ内容・受信日時の記録の数だけ取得し直したものとして無視し、
+        それを超える分は同じ秒の同じ内容の利用として "#n" を付けたキーで追加する
+        """
+        added = []
+        seen = Counter()  # Message-IDのない通知が、この呼び出しで同じ内容・受信日時の何件目か
+        inserted = Counter()  # そのうち、この呼び出しで追加したもの
+        with self.conn:
+            for ana_pay in ana_pay_list:
+                content_key = self.content_key(ana_pay.date_of_use_str, ana_pay.amount, ana_pay.store)
+                if ana_pay.message_id:
+                    cursor = self.conn.execute(
+                        "UPDATE OR IGNORE anapay SET message_id = ? WHERE message_id = (SELECT message_id FROM anapay"
+                        " WHERE message_id = ? OR message_id GLOB ? ORDER BY rowid LIMIT 1)",
+                        (ana_pay.message_id, content_key, f"{content_key}#*"))
+                    if cursor.rowcount:
+                        continue
+                else:
+                    same = (content_key, ana_pay.email_date_str)
+                    existing = self.conn.execute(
+                        "SELECT COUNT(*) FROM anapay WHERE (message_id = ? OR message_id GLOB ?) AND email_date = ?",
+                        (content_key, f"{content_key}#*", ana_pay.email_date_str)).fetchone()[0]
+                    seen[same] += 1
+                    if seen[same] <= existing - inserted[same]:
+                        continue
+                    ana_pay.ledger_key = self._next_content_key(ana_pay)
+                    inserted[same] += 1
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO anapay (message_id, email_date, date_of_use, amount, store)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (self.key(ana_pay), ana_pay.email_date_str, ana_pay.date_of_use_str, ana_pay.amount,
+                     ana_pay.store))
+                if cursor.rowcount:
+                    added.append(ana_pay)
+        return added
+
+    def pending_mf(self) -> list[sqlite3.Row]:
+        """マネーフォワードに未登録の記録を古い順に返す (登録中に止まって結果がわからないものは除く)"""
+        return self.conn.execute(
+            "SELECT * FROM anapay WHERE mf_status != 'done' AND message_id NOT IN"
+            " (SELECT message_id FROM mf_journal WHERE state = 'submitting') ORDER BY email_date").fetchall()
+
+    def in_doubt_mf(self) -> list[sqlite3.Row]:
+        """登録を始めたまま結果が書き込まれていない記録を返す (前回の実行が登録中に止まったもの)"""
+        return self.conn.execute(
+            "SELECT anapay.*, mf_journal.attempts, mf_journal.updated_at FROM anapay"
+            " JOIN mf_journal USING (message_id)"
+            " WHERE mf_journal.state = 'submitting' AND anapay.mf_status != 'done'"
+            " ORDER BY email_date").fetchall()
+
+    def _journal_mf(self, message_id: str, state: str, attempt: int = 0) -> None:
+        self.conn.execute(
+            "INSERT INTO mf_journal (message_id, state, attempts, updated_at) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (message_id) DO UPDATE SET state = excluded.state,"
+            " attempts = attempts + excluded.attempts, updated_at = excluded.updated_at",
+            (message_id, state, attempt, f"{datetime.now():%Y-%m-%d %H:%M:%S}"))
+
+    def begin_mf(self, message_id: str) -> None:
+        """マネーフォワードへの登録を始める前に意図を書き込む (登録より先にコミットする)"""
+        with self.conn:
+            self._journal_mf(message_id, "submitting", 1)
+
+    def mark_mf_done(self, message_id: str) -> None:
+        with self.conn:
+            self.conn.execute("UPDATE anapay SET mf_status = 'done' WHERE message_id = ?", (message_id,))
+            self._journal_mf(message_id, "done")
+
+    def mark_mf_failed(self, message_id: str) -> None:
+        """登録できなかったことを書き込む (次回の実行で再試行される)"""
+        with self.conn:
+            self._journal_mf(message_id, "failed")
+
+    def unmirrored(self) -> list[sqlite3.Row]:
+        """スプレッドシートにまだ書き込んでいない記録を古い順に返す"""
+        return self.conn.execute(
+            "SELECT * FROM anapay WHERE sheet_row IS NULL ORDER BY email_date").fetchall()
+
+    def unsynced(self) -> list[sqlite3.Row]:
+        """スプレッドシートの "mf" 列が台帳と異なる記録を返す"""
+        return self.conn.execute(
+            "SELECT * FROM anapay WHERE sheet_row IS NOT NULL AND sheet_status != mf_status"
+            " ORDER BY sheet_name, sheet_row").fetchall()
+
+    def set_sheet_rows(self, appended: list[tuple[str, int]], sheet_name: str = "") -> None:
+        """スプレッドシートに追加した記録の (キー, 行番号) を保存する ("mf" 列は台帳の値で書き込んでいる)"""
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE anapay SET sheet_name = ?, sheet_row = ?, sheet_status = mf_status WHERE message_id = ?",
+                [(sheet_name, row, key) for key, row in appended])
+
+    def mark_sheet_done(self, rows: list[int], sheet_name: str = "") -> None:
+        """スプレッドシートの "mf" 列に "done" を書き込めた行を保存する"""
+        with self.conn:
+            self.conn.executemany("UPDATE anapay SET sheet_status = 'done' WHERE sheet_name = ? AND sheet_row = ?",
+                                  [(sheet_name, row) for row in rows])
+
+
+DATE_HEADER_FORMAT = "%a, %d %b %Y %H:%M:%S +0900 (JST)"  # ANA Payの通知メールのDateヘッダー
+NOTICE_LINE_RE = re.compile(r"^ご利用(日時|金額|店舗)：([^\r\n]*)", re.MULTILINE)
+
+
+def parse_email_date(value: str) -> datetime:
+    """Dateヘッダーを解析する (固定書式で読めなければdateutilにフォールバック)"""
+    try:
+        return datetime.strptime(value, DATE_HEADER_FORMAT)
+    except ValueError:
+        return parser.parse(value.replace(" +0900 (JST)", ""))
+
+
+def parse_iso_datetime(value: str) -> datetime:
+    """ご利用日時やスプレッドシートの日時を解析する (ISO形式で読めなければdateutilにフォールバック)"""
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return parser.parse(value)
+
+
+def parse_anapay_notice(date_value: str, message_id: str, body: str, email_id) -> ANAPay:
     """
-    1件のメールからANA Payの利用情報を取得して返す
+    ANA Pay利用通知のDateヘッダーと本文から利用情報を取り出す
+    ヘッダーのリストを作らず、事前コンパイルした正規表現で得る
     """
-    ana_pay = ANAPay(email_id=email_id)
-    for header in msg["headers"]:
-        if header["name"] == "Date":
-            date_str = header["value"].replace(" +0900 (JST)", "")
-            ana_pay.email_date = parser.parse(date_str)
+    ana_pay = ANAPay(email_id=email_id, message_id=(message_id or "").strip())
+    if date_value:
+        ana_pay.email_date = parse_email_date(date_value)
+    for key, value in NOTICE_LINE_RE.findall(body):
+        if key == "日時":
+            ana_pay.date_of_use = parse_iso_datetime(value)
+        elif key == "金額":
+            ana_pay.amount = int(value.replace(",", "").replace("円", ""))
+        else:
+            ana_pay.store = value
+    return ana_pay
+
 
-    # 本文から日時、金額、店舗を取り出す
-    body = msg["body"]
-    for line in body.splitlines():
-        if line.startswith("ご利用"):
-            key, value = line.split("：")
-            if key == "ご利用日時":
-                ana_pay.date_of_use = parser.parse(value)
-            elif key == "ご利用金額":
-                ana_pay.amount = int(value.replace(",", "").replace("円", ""))
-            elif key == "ご利用店舗":
-                ana_pay.store = value
+def parse_anapay_message(raw: bytes, email_id) -> Optional[ANAPay]:
+    """
+    RFC822形式のメール1件を解析してANA Payの利用情報を返す
+    ANA Payの利用通知でなければNoneを返す
+    """
+    with metrics.span("parse"):
+        ana_pay = _parse_anapay_message(raw, email_id)
+    if ana_pay:
+        metrics.count("parsed")
     return ana_pay
 
 
-def get_anapay_info(imap_server, username, password, after: str) -> List[ANAPay]:
+def is_anapay_subject(value: Optional[str]) -> bool:
+    """件名をデコードしてANA Payの利用通知か確認する"""
+    if value is None:
+        return False
+    subject, encoding = decode_header(value)[0]
+    if isinstance(subject, bytes):
+        subject = subject.decode(encoding if encoding else 'utf-8')
+    return "［ANA Pay］ご利用のお知らせ" in subject
+
+
+def _parse_anapay_message(raw: bytes, email_id) -> Optional[ANAPay]:
+    msg = email.message_from_bytes(raw)
+
+    # 件名をデコードして確認
+    if not is_anapay_subject(msg['Subject']):
+        return None
+
+    # 本文をデコードして「ご利用日時」を含むか確認
+    if msg.is_multipart():
+        parts = [part for part in msg.walk() if part.get_content_type() == "text/plain"]
+    else:
+        parts = [msg]
+    for part in parts:
+        body = part.get_payload(decode=True).decode(part.get_content_charset())
+        if "ご利用日時" in body:
+            return parse_anapay_notice(msg["Date"], msg["Message-ID"], body, email_id)
+    return None
+
+
+FETCH_UID_RE = re.compile(rb"UID (\d+)")
+
+
+def parse_fetch_response(data) -> dict[bytes, bytes]:
     """
-    IMAPを使用してGmailからANA Payの利用履歴を取得する
+    UID FETCHのレスポンスを {UID: RFC822} に変換する
+    UIDはリテラルの前 (b'1 (UID 5 RFC822 {n}') にも後 (b' UID 5)') にも来うるため両方を見る
+    """
+    messages = {}
+    pending = None
+    for item in data:
+        if isinstance(item, tuple):
+            match = FETCH_UID_RE.search(item[0])
+            if match:
+                messages[match.group(1)] = item[1]
+                pending = None
+            else:
+                pending = item[1]
+        elif isinstance(item, bytes) and pending is not None:
+            match = FETCH_UID_RE.search(item)
+            if match:
+                messages[match.group(1)] = pending
+            pending = None
+    return messages
+
+
+def fetch_messages(mail, uids: list[bytes], batch_size: int = IMAP_FETCH_BATCH_SIZE):
+    """
+    UIDセットをbatch_size件ずつまとめてFETCHし、(uid, RFC822) を順に返す
+    1件ずつFETCHすると件数分のラウンドトリップが発生するため、チャンク単位で取得する
+    """
+    batch_size = max(1, batch_size)
+    for start in range(0, len(uids), batch_size):
+        chunk = uids[start:start + batch_size]
+        try:
+            with metrics.span("imap.fetch"):
+                result, data = mail.uid("FETCH", b",".join(chunk), "(UID RFC822)")
+        except Exception as e:
+            logging.error(f"IMAP fetch exception: {e}")
+            continue
+        if result != 'OK':
+            logging.error(f"IMAP fetch failed with result: {result}, data: {data}")
+            continue
+
+        messages = parse_fetch_response(data)
+        metrics.count("fetched", len(messages))
+        metrics.count("imap_bytes", fetched_size(data))
+
+        # 要求した順序で返す
+        for uid in chunk:
+            raw = messages.get(uid)
+            if raw is None:
+                logging.warning(f"IMAP fetch returned no body for UID: {uid}")
+                continue
+            yield uid, raw
+
+
+def fetched_size(data) -> int:
+    """FETCHの応答のバイト数 (リテラルを含む)"""
+    size = 0
+    for item in data:
+        for piece in item if isinstance(item, tuple) else (item,):
+            if isinstance(piece, bytes):
+                size += len(piece)
+    return size
+
+
+IMAP_TOKEN_RE = re.compile(rb'[()]|"(?:[^"\\]|\\.)*"|\{\d+\}|[^\s()"\[]+(?:\[[^\]]*\][^\s()]*)?')
+_OPEN, _CLOSE = object(), object()
+
+
+def _imap_tokens(data) -> Iterator:
+    """imaplibのFETCHの応答 (bytesと (前置き, リテラル) のタプルの並び) をトークンに分ける"""
+    for item in data:
+        prefix, literal = item if isinstance(item, tuple) else (item, None)
+        for match in IMAP_TOKEN_RE.finditer(prefix if isinstance(prefix, bytes) else b""):
+            token = match.group()
+            if token == b"(":
+                yield _OPEN
+            elif token == b")":
+                yield _CLOSE
+            elif token.startswith(b'"'):
+                yield re.sub(rb'\\(.)', rb'\1', token[1:-1])
+            elif token.upper() == b"NIL":
+                yield None
+            elif not token.startswith(b"{"):  # リテラルの長さ (中身はタプルの2つ目で渡される)
+                yield token
+        if literal is not None:
+            yield literal
+
+
+def parse_fetch_items(data) -> dict[bytes, dict[bytes, object]]:
+    """
+    UID FETCHの応答を {UID: {項目名: 値}} に変換する
+    括弧はlist、文字列とリテラルはbytes、NILはNoneになる (BODYSTRUCTUREは入れ子のlist)
     """
-    ana_pay_list = []
-    mail = imaplib.IMAP4_SSL(imap_server)
+    stack = [[]]
+    for token in _imap_tokens(data):
+        if token is _OPEN:
+            stack.append([])
+        elif token is _CLOSE:
+            if len(stack) > 1:
+                closed = stack.pop()
+                stack[-1].append(closed)
+        else:
+            stack[-1].append(token)
+    messages = {}
+    for response in stack[0]:
+        if not isinstance(response, list):
+            continue  # メッセージのシーケンス番号
+        items = {name.upper(): value for name, value in zip(response[::2], response[1::2])
+                 if isinstance(name, bytes)}
+        if isinstance(items.get(b"UID"), bytes):
+            messages[items[b"UID"]] = items
+    return messages
+
+
+@dataclass
+class TextPart:
+    """BODYSTRUCTUREで見つけたtext/plainの部分"""
+    section: str
+    encoding: str
+    charset: str
+
+
+def find_text_plain(structure, section: str = "") -> Optional[TextPart]:
+    """BODYSTRUCTUREから最初のtext/plainの部分 (添付ファイルを除く) を探す"""
+    if not isinstance(structure, list) or not structure:
+        return None
+    if isinstance(structure[0], list):
+        # multipart: 子の部分が先頭に並び、サブタイプ以降が続く
+        children = itertools.takewhile(lambda child: isinstance(child, list), structure)
+        for i, child in enumerate(children, start=1):
+            part = find_text_plain(child, f"{section}.{i}" if section else str(i))
+            if part:
+                return part
+        return None
+    if len(structure) < 7 or not isinstance(structure[0], bytes) or not isinstance(structure[1], bytes):
+        return None
+    if (structure[0].lower(), structure[1].lower()) != (b"text", b"plain"):
+        return None
+    # text の拡張データは lines, md5 の後に disposition が来る
+    if len(structure) > 9 and isinstance(structure[9], list) and structure[9] \
+            and isinstance(structure[9][0], bytes) and structure[9][0].lower() == b"attachment":
+        return None
+    params = structure[2] if isinstance(structure[2], list) else []
+    params = {key.lower(): value for key, value in zip(params[::2], params[1::2]) if isinstance(key, bytes)}
+    charset = params.get(b"charset") or b"utf-8"
+    encoding = structure[5] if isinstance(structure[5], bytes) else b"7bit"
+    # multipartでないメールは本文全体がセクション1
+    return TextPart(section or "1", encoding.decode().lower(), charset.decode())
+
+
+def decode_part(data: bytes, part: TextPart) -> str:
+    """Content-Transfer-Encodingとcharsetに従って部分の本文をデコードする"""
+    if part.encoding == "base64":
+        data = binascii.a2b_base64(data)
+    elif part.encoding == "quoted-printable":
+        data = binascii.a2b_qp(data)
+    return data.decode(part.charset)
+
+
+@dataclass
+class NoticeParts:
+    """部分取得したメール (ヘッダーとtext/plainの部分の本文だけ)"""
+    date: Optional[str]
+    message_id: Optional[str]
+    body: bytes
+    part: TextPart
+
 
+NOTICE_HEADER_FIELDS = "BODY.PEEK[HEADER.FIELDS (SUBJECT DATE MESSAGE-ID)]"
+
+
+def uid_fetch_items(mail, uids: list[bytes], message_parts: str,
+                    span: str = "imap.fetch") -> Optional[dict[bytes, dict[bytes, object]]]:
+    """UID FETCHを1回送り、parse_fetch_items で変換した結果を返す。失敗したらNone"""
     try:
-        mail.login(username, password)
-        mail.select(MAILBOX)
+        with metrics.span(span):
+            result, data = mail.uid("FETCH", b",".join(uids), message_parts)
+    except Exception as e:
+        logging.error(f"IMAP fetch exception: {e}")
+        return None
+    if result != 'OK':
+        logging.error(f"IMAP fetch failed with result: {result}, data: {data}")
+        return None
+    metrics.count("imap_bytes", fetched_size(data))
+    return parse_fetch_items(data)
+
+
+def fetch_notice_parts(mail, uids: list[bytes], batch_size: int = IMAP_FETCH_BATCH_SIZE):
+    """
+    BODYSTRUCTUREと件名・Date・Message-IDのヘッダーだけを先に取得し、ANA Payの通知だけ
+    text/plainの部分を BODY.PEEK[n] で取得して (uid, NoticeParts) を順に返す
+    HTMLや画像は転送せず、PEEKなので既読にもならない
+    text/plainが見つからないメールはRFC822全体を取得して (uid, RFC822) を、
+    ANA Payの通知でないメールは (uid, None) を返す
+    """
+    batch_size = max(1, batch_size)
+    header_parser = BytesHeaderParser()
+    for chunk in batched(uids, batch_size):
+        items = uid_fetch_items(mail, chunk, f"(UID BODYSTRUCTURE {NOTICE_HEADER_FIELDS})", "imap.fetch_structure")
+        if items is None:
+            continue
+        notices = {}
+        full = []
+        skipped = set()
+        for uid in chunk:
+            item = items.get(uid)
+            if item is None:
+                logging.warning(f"IMAP fetch returned no structure for UID: {uid}")
+                continue
+            header = next((value for name, value in item.items() if name.startswith(b"BODY[HEADER.FIELDS")), None)
+            headers = header_parser.parsebytes(header if isinstance(header, bytes) else b"")
+            if not is_anapay_subject(headers["Subject"]):
+                skipped.add(uid)
+                continue
+            part = find_text_plain(item.get(b"BODYSTRUCTURE"))
+            if part is None:
+                full.append(uid)
+            else:
+                notices[uid] = (headers, part)
+
+        # 通知はふつう同じ構造なので、セクション番号ごとに1回のFETCHで本文を取得する
+        bodies = {}
+        for section in sorted({part.section for _, part in notices.values()}):
+            section_uids = [uid for uid, (_, part) in notices.items() if part.section == section]
+            fetched = uid_fetch_items(mail, section_uids, f"(UID BODY.PEEK[{section}])") or {}
+            for uid, item in fetched.items():
+                bodies[uid] = item.get(f"BODY[{section}]".encode())
+        raws = dict(fetch_messages(mail, full, batch_size)) if full else {}
+
+        # 要求した順序で返す
+        for uid in chunk:
+            if uid in skipped:
+                yield uid, None
+            elif uid in raws:
+                yield uid, raws[uid]
+            elif uid in notices:
+                body = bodies.get(uid)
+                if not isinstance(body, bytes):
+                    logging.warning(f"IMAP fetch returned no body for UID: {uid}")
+                    continue
+                headers, part = notices[uid]
+                metrics.count("fetched")
+                yield uid, NoticeParts(headers["Date"], headers["Message-ID"], body, part)
+
+
+def fetch_notices(mail, uids: list[bytes], batch_size: int = IMAP_FETCH_BATCH_SIZE):
+    """IMAP_FETCH_MODE に従ってメールを取得し、(uid, 取得結果) を順に返す (parse_fetched で解析する)"""
+    if IMAP_FETCH_MODE == "full":
+        return fetch_messages(mail, uids, batch_size)
+    return fetch_notice_parts(mail, uids, batch_size)
+
+
+def parse_fetched(fetched, email_id) -> Optional[ANAPay]:
+    """fetch_notices の取得結果 (RFC822全体またはNoticeParts) を解析する"""
+    if fetched is None:
+        return None
+    if not isinstance(fetched, NoticeParts):
+        return parse_anapay_message(fetched, email_id)
+    with metrics.span("parse"):
+        body = decode_part(fetched.body, fetched.part)
+        ana_pay = None
+        if "ご利用日時" in body:
+            ana_pay = parse_anapay_notice(fetched.date, fetched.message_id, body, email_id)
+    if ana_pay:
+        metrics.count("parsed")
+    return ana_pay
+
+
+def get_uidvalidity(mail) -> Optional[int]:
+    """
+    SELECT時にサーバーが返したUIDVALIDITYを返す
+    imaplibの response() は読んだ応答を消すため、最初に読んだ値を接続に保存して使い回す
+    (常駐モードでは同じ接続で何度も検索する)
+    """
+    if not hasattr(mail, "anapay_uidvalidity"):
+        _, data = mail.response("UIDVALIDITY")
+        mail.anapay_uidvalidity = int(data[0]) if data and data[0] else None
+    return mail.anapay_uidvalidity
+
+
+def connect_imap(imap_server, username, password):
+    """
+    IMAPにログインしてMAILBOXを選択した接続を返す
+    ログインまたは選択に失敗した場合はNoneを返す
+    """
+    with metrics.span("imap.login"):
+        mail = imaplib.IMAP4_SSL(imap_server)
+        try:
+            mail.login(username, password)
+            mail.select(MAILBOX)
+            get_uidvalidity(mail)
+        except Exception as e:
+            logging.error(f"IMAP login/select exception: {e}")
+            return None
+    return mail
+
 
+def disconnect_imap(mail):
+    """選択中のメールボックスを閉じてログアウトする"""
+    try:
+        mail.close()
     except Exception as e:
-        logging.error(f"IMAP login/select exception: {e}")
-        return ana_pay_list
+        logging.error(f"IMAP close exception: {e}")
+    finally:
+        mail.logout()
 
-    # 日付をIMAPの検索形式に変換
-    since_date = datetime.strptime(after, "%d-%b-%Y")
-    since_str = since_date.strftime("%d-%b-%Y")
 
-    # 検索条件を設定（件名に「[ANA Pay]」を含む）
-    query = f'(FROM "payinfo@121.ana.co.jp" SUBJECT "[ANA Pay]" SINCE {since_str})'
+IMAP_EXISTS_RE = re.compile(rb"^\* \d+ EXISTS")
+
+
+def imap_readable(mail) -> bool:
+    """
+    応答をすぐに読めるかを待たずに返す
+    imaplibはソケットをバッファ付きで読むため、バッファに残っている行はselectでは検知できない
+    ソケットを一時的にノンブロッキングにして、バッファ (とSSLのバッファ) をpeekで確認する
+    """
+    sock = mail.socket()
+    timeout = sock.gettimeout()
+    sock.settimeout(0.0)
+    try:
+        return bool(mail.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+def imap_idle(mail, timeout: float = IMAP_IDLE_TIMEOUT, stop: Optional[threading.Event] = None) -> bool:
+    """
+    IDLEで選択中のメールボックスを待ち受け、新着メール (EXISTS) が届いたらTrueを返す
+    timeout 秒経つかstopがセットされたらIDLEを終了してFalseを返す
+    imaplibはIDLEに対応していないため、コマンドを直接送受信する
+    """
+    tag = mail._new_tag()
+    mail.send(tag + b" IDLE\r\n")
+    line = mail.readline()
+    if not line.startswith(b"+"):
+        raise imaplib.IMAP4.error(f"IDLE rejected: {line!r}")
+
+    sock = mail.socket()
+    deadline = time.monotonic() + timeout
+    arrived = False
+    while not arrived and time.monotonic() < deadline and not (stop and stop.is_set()):
+        # 読み込みバッファに残っている分はselectでは検知できないので先に読む
+        if not imap_readable(mail) and not select.select([sock], [], [], min(1.0, deadline - time.monotonic()))[0]:
+            continue
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed during IDLE")
+        arrived = bool(IMAP_EXISTS_RE.match(line))
+
+    mail.send(b"DONE\r\n")
+    while True:
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed during IDLE")
+        if line.startswith(tag):
+            if not line[len(tag):].strip().startswith(b"OK"):
+                raise imaplib.IMAP4.error(f"IDLE failed: {line!r}")
+            return arrived
+        arrived = arrived or bool(IMAP_EXISTS_RE.match(line))
+
+
+def get_anapay_info(imap_server, username, password, after: str,
+                    batch_size: int = IMAP_FETCH_BATCH_SIZE,
+                    checkpoint: Optional[IMAPCheckpoint] = None) -> List[ANAPay]:
+    """
+    IMAPを使用してGmailからANA Payの利用履歴を取得する
+    """
+    mail = connect_imap(imap_server, username, password)
+    if mail is None:
+        return []
+    try:
+        return search_anapay_info(mail, after, batch_size, checkpoint)
+    finally:
+        disconnect_imap(mail)
+
+
+def search_anapay_info(mail, after: str,
+                       batch_size: int = IMAP_FETCH_BATCH_SIZE,
+                       checkpoint: Optional[IMAPCheckpoint] = None) -> List[ANAPay]:
+    """
+    ログイン済みのIMAP接続からANA Payの利用履歴を取得する
+    """
+    uids = search_anapay_uids(mail, after, checkpoint)
+    handled = set()
+    records = list(iter_anapay_info(mail, uids, batch_size, handled))
+    if checkpoint is not None:
+        checkpoint.advance(uids, handled)
+    return records
+
+
+def iter_anapay_info(mail, uids: list[bytes], batch_size: int = IMAP_FETCH_BATCH_SIZE,
+                     handled: Optional[set] = None) -> Iterator[ANAPay]:
+    """
+    指定したUIDのメールを取得・解析し、ANA Payの利用情報を順に返す
+    handled を渡すと、取得できたUIDを入れる (解析に失敗したメールはログに出して処理済みとして飛ばす)
+    """
+    for uid, fetched in fetch_notices(mail, uids, batch_size):
+        ana_pay = None
+        try:
+            ana_pay = parse_fetched(fetched, uid)
+        except Exception as e:
+            # 取得し直しても同じ結果になるため、処理済みとして飛ばす
+            logging.error(f"Error parsing email {uid}, skipped: {e}")
+            metrics.count("parse_errors")
+        if handled is not None:
+            handled.add(uid)
+        if ana_pay:
+            yield ana_pay
+
+
+def search_anapay_uids(mail, after: str, checkpoint: Optional[IMAPCheckpoint] = None) -> list[bytes]:
+    """
+    ANA Payの利用通知のUIDを新しい順に返す
+    checkpointを渡すと処理済みUIDより新しいメールだけを検索する
+    チェックポイントがまだない場合はafterの日付以降を検索する
+    UIDVALIDITYが変わっていた場合は日付で絞らずに全件を再同期し、checkpointをリセットする
+    checkpointは取得・解析が済んでから IMAPCheckpoint.advance で進める
+    """
+    uidvalidity = get_uidvalidity(mail)
+    incremental = (checkpoint is not None and checkpoint.last_uid > 0
+                   and uidvalidity is not None and checkpoint.uidvalidity == uidvalidity)
+
+    if incremental:
+        # 処理済みUIDより新しいメールのみ検索
+        min_uid = checkpoint.last_uid + 1
+        query = f'(UID {min_uid}:* FROM "payinfo@121.ana.co.jp" SUBJECT "[ANA Pay]")'
+    elif checkpoint is not None and checkpoint.last_uid > 0:
+        # UIDが振り直されたため、日付で絞らずにすべての通知を取得し直す (重複は台帳で除く)
+        logging.info(f"UIDVALIDITY changed ({checkpoint.uidvalidity} -> {uidvalidity}), full resync")
+        min_uid = 1
+        query = '(UID 1:* FROM "payinfo@121.ana.co.jp" SUBJECT "[ANA Pay]")'
+    else:
+        min_uid = 1
+        # 日付をIMAPの検索形式に変換
+        since_date = datetime.strptime(after, "%d-%b-%Y")
+        since_str = since_date.strftime("%d-%b-%Y")
+
+        # 検索条件を設定（件名に「[ANA Pay]」を含む）
+        query = f'(FROM "payinfo@121.ana.co.jp" SUBJECT "[ANA Pay]" SINCE {since_str})'
     logging.info(f"IMAP search query: {query}")
 
     try:
-        result, data = mail.search(None,query)
+        with metrics.span("imap.search"):
+            result, data = mail.uid("SEARCH", None, query)
         logging.info(f"IMAP search result: {result}, data: {data}")
     except Exception as e:
         logging.error(f"IMAP search exception: {e}")
-        return ana_pay_list
+        return []
 
     if result != 'OK':
         logging.error(f"IMAP search failed with result: {result}, data: {data}")
-        return ana_pay_list
+        return []
+
+    # "n:*" は該当がなくても最大UIDのメールを1件返すため、処理済みのUIDを除外する
+    uids = [uid for uid in data[0].split() if int(uid) >= min_uid]
+    uids.reverse()
+
+    if checkpoint is not None and not incremental:
+        # UIDVALIDITYがわからない場合は0にして、次回も全件を再同期する
+        checkpoint.uidvalidity = uidvalidity or 0
+        checkpoint.last_uid = 0
 
-    email_ids = data[0].split()
+    return uids
 
-    for email_id in reversed(email_ids):
-        result, msg_data = mail.fetch(email_id, "(RFC822)")
-        msg = email.message_from_bytes(msg_data[0][1])
 
-        # 件名をデコードして確認
-        subject, encoding = decode_header(msg['Subject'])[0]
-        if isinstance(subject, bytes):
-            subject = subject.decode(encoding if encoding else 'utf-8')
-        if "［ANA Pay］ご利用のお知らせ" not in subject:
+_STREAM_END = object()
+
+
+def batched(iterable, size: int) -> Iterator[list]:
+    """iterableをsize件ずつのリストに分けて返す (最後は端数)"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    """停止が要求されるまでキューに入れる (キューが満杯なら空くまで待つ)"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
             continue
+    return False
 
-        # 本文をデコードして「ご利用日時」を含むか確認
-        if msg.is_multipart():
-            for part in msg.walk():
-                if part.get_content_type() == "text/plain":
-                    body = part.get_payload(decode=True).decode(part.get_content_charset())
-                    if "ご利用日時" in body:
-                        email_data = {
-                            "headers": [{"name": k, "value": v} for k, v in msg.items()],
-                            "body": body,
-                        }
-                        ana_pay = get_mail_info(email_data, email_id)
-                        if ana_pay:
-                            ana_pay_list.append(ana_pay)
-                        break
-        else:
-            body = msg.get_payload(decode=True).decode(msg.get_content_charset())
-            if "ご利用日時" in body:
-                email_data = {
-                    "headers": [{"name": k, "value": v} for k, v in msg.items()],
-                    "body": body,
-                }
-                ana_pay = get_mail_info(email_data, email_id)
-                if ana_pay:
-                    ana_pay_list.append(ana_pay)
 
-    mail.close()
-    mail.logout()
-    return ana_pay_list
+def stream_anapay_info(mail, uids: list[bytes], batch_size: int = IMAP_FETCH_BATCH_SIZE,
+                       queue_size: int = PIPELINE_QUEUE_SIZE, handled: Optional[set] = None) -> Iterator[ANAPay]:
+    """
+    取得と解析をそれぞれ別スレッドで動かし、解析できたANA Payの利用情報を1件ずつ返す
+    ステージ間のキューは queue_size 件までで、後段が詰まると前段は待つ
+    handled を渡すと、取得できたUIDを入れる (iter_anapay_info と同じ)
+    """
+    raw_queue = queue.Queue(maxsize=max(1, queue_size))
+    record_queue = queue.Queue(maxsize=max(1, queue_size))
+    stop = threading.Event()
 
+    def fetch_stage():
+        try:
+            for item in fetch_notices(mail, uids, batch_size):
+                if not _put(raw_queue, item, stop):
+                    return
+        except Exception as e:
+            _put(raw_queue, e, stop)
+        _put(raw_queue, _STREAM_END, stop)
 
+    def parse_stage():
+        while not stop.is_set():
+            try:
+                item = raw_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _STREAM_END or isinstance(item, Exception):
+                _put(record_queue, item, stop)
+                return
+            uid, fetched = item
+            ana_pay = None
+            try:
+                ana_pay = parse_fetched(fetched, uid)
+            except Exception as e:
+                logging.error(f"Error parsing email {uid}, skipped: {e}")
+                metrics.count("parse_errors")
+            if handled is not None:
+                handled.add(uid)
+            if ana_pay and not _put(record_queue, ana_pay, stop):
+                return
 
+    threads = [threading.Thread(target=fetch_stage, name="imap-fetch", daemon=True),
+               threading.Thread(target=parse_stage, name="mail-parse", daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = record_queue.get()
+            if item is _STREAM_END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # 途中で打ち切られた場合もスレッドを止める
+        stop.set()
+        for thread in threads:
+            thread.join()
 
 
-def get_last_email_date(records: list[dict[str, str]]):
+def get_last_email_date(last_email_date: Optional[datetime]):
     """get last email date for gmail search"""
     after = "20-Mar-2024"
-    if records:
-        last_email_date = parser.parse(records[-1]["email_date"])
+    if last_email_date:
         after = f"{last_email_date.strftime('%d-%b-%Y')}"
     return after
 
 
-def gmail2spredsheet(worksheet):
-    """IMAPからANA Payの利用履歴を取得しスプレッドシートに書き込む"""
-    # get all records from spreadsheet
-    records = worksheet.get_all_records()
-    logging.info("Records in spreadsheet: %d", len(records))
+SHEETS_RETRY_STATUS = {429, 500, 502, 503, 504}
 
-    # get last day from records
-    after = get_last_email_date(records)
-    logging.info("Last day on spreadsheet: %s", after)
-    email_date_set = set(parser.parse(r["email_date"]) for r in records)
 
-    # get ANA Pay email from IMAP
-    ana_pay_list = get_anapay_info("imap.gmail.com", EMAIL, EMAIL_PASSWORD, after)
-    logging.info("ANA Pay emails: %d", len(ana_pay_list))
+class SheetsRateLimiter:
+    """
+    Google Sheets APIの呼び出しをトークンバケットで毎分 per_minute 回までに抑える
+    429/5xx と接続エラーはジッター付きの指数バックオフで再試行する (再送すると重複する追記は 429 のみ)
+    待った時間は sheets.throttled (バケット待ち) と sheets.backoff (再試行待ち) として記録する
+    """
 
-    # add ANA Pay record to spreadsheet
-    count = 0
-    for ana_pay in ana_pay_list:
-        # メールの日付が存在しない場合はレコードを追加
-        if ana_pay.email_date not in email_date_set:
+    def __init__(self, per_minute: float = SHEETS_REQUESTS_PER_MINUTE, burst: int = SHEETS_BURST,
+                 max_retries: int = SHEETS_MAX_RETRIES, backoff_max: float = SHEETS_BACKOFF_MAX):
+        self.rate = per_minute / 60
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.max_retries = max_retries
+        self.backoff_max = backoff_max
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            metrics.observe("sheets.throttled", wait)
+            time.sleep(wait)
+
+    @staticmethod
+    def retryable(e: Exception) -> bool:
+        if isinstance(e, gspread.exceptions.APIError):
+            return getattr(e.response, "status_code", None) in SHEETS_RETRY_STATUS
+        return isinstance(e, (requests.ConnectionError, requests.Timeout))
+
+    @staticmethod
+    def rejected(e: Exception) -> bool:
+        """リクエストが適用されずに拒否されたことが確かなエラー (429) か"""
+        return isinstance(e, gspread.exceptions.APIError) and getattr(e.response, "status_code", None) == 429
+
+    def call(self, fn, *args, **kwargs):
+        """fn(*args, **kwargs) を上限内で呼ぶ。再試行しても失敗した場合は最後の例外を送出する"""
+        return self._call(fn, args, kwargs, self.retryable)
+
+    def call_non_idempotent(self, fn, *args, **kwargs):
+        """
+        append_rows など、2回送ると2回適用される呼び出し用の call
+        5xx や接続エラー・タイムアウトは適用されたかどうか分からないため再試行せず、429 だけを再試行する
+        """
+        return self._call(fn, args, kwargs, self.rejected)
+
+    def _call(self, fn, args, kwargs, retryable):
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
             try:
-                worksheet.append_row(ana_pay.values(), value_input_option="USER_ENTERED")
-                count += 1
-                logging.info("Record added to spreadsheet: %s", ana_pay.values())
-                time.sleep(1)
+                return fn(*args, **kwargs)
             except Exception as e:
-                logging.error(f"Error adding record to spreadsheet: {e}")
-    logging.info("Records added to spreadsheet: %d", count)
+                if attempt == self.max_retries or not retryable(e):
+                    raise
+                delay = random.uniform(0, min(self.backoff_max, 2 ** attempt))
+                logging.warning(f"Sheets API call failed ({e}), retrying in {delay:.1f}s")
+                metrics.count("sheets_retries")
+                metrics.observe("sheets.backoff", delay)
+                time.sleep(delay)
+
+
+sheets_limiter = SheetsRateLimiter()
+
 
-    # 既読にするメールのIDをリストアップ
-    email_ids_to_mark_read = [ana_pay.email_id for ana_pay in ana_pay_list if ana_pay.email_date not in email_date_set]
+A1_ROW_RE = re.compile(r"[A-Z]+(\d+)(?::[A-Z]+\d+)?$")
+A1_FIRST_ROW_RE = re.compile(r"![A-Z]+(\d+)")
+MF_STATUS_COL = 5  # "mf" 列
+
+
+class SheetWriteBuffer:
+    """
+    スプレッドシートへの書き込みをためてまとめて送るバッファ
+    行の追加は append_rows、"done" の書き込みは batch_update で1回のAPI呼び出しにまとめる
+    max_rows件たまるか、前回の書き込みからmax_seconds経過すると書き込む
+    失敗した場合は書き込めなかった行だけを残し、次のflushで送る (再試行は sheets_limiter に任せる)
+    追記が適用されたか分からない失敗では、シートの末尾を読み直して書き込めたかを確かめてから残す
+    on_appended には追加できた行の (キー, 行番号)、on_updated には "done" を書き込めた行番号が渡される
+    """
 
-    # メールを既読にする
-    for email_id in email_ids_to_mark_read:
+    def __init__(self, worksheet, max_rows: int = SHEET_FLUSH_ROWS, max_seconds: float = SHEET_FLUSH_SECONDS,
+                 on_appended=None, on_updated=None):
+        self.worksheet = worksheet
+        self.on_appended = on_appended
+        self.on_updated = on_updated
+        self.max_rows = max(1, max_rows)
+        self.max_seconds = max_seconds
+        self.pending_rows: list[tuple[object, tuple]] = []
+        self.pending_done: list[int] = []
+        self.appended = 0
+        self.updated = 0
+        self.last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+    def __len__(self):
+        return len(self.pending_rows) + len(self.pending_done)
+
+    def append(self, values: tuple, key=None) -> None:
+        """シートの末尾に追加する行をためる"""
+        self.pending_rows.append((key, values))
+        self._maybe_flush()
+
+    def mark_done(self, row: int) -> None:
+        """指定行の "mf" 列を "done" にする更新をためる"""
+        self.pending_done.append(row)
+        self._maybe_flush()
+
+    def _maybe_flush(self) -> None:
+        if len(self) >= self.max_rows or time.monotonic() - self.last_flush >= self.max_seconds:
+            self.flush()
+
+    def flush(self) -> bool:
+        """
+        ためている書き込みを送る。すべて書き込めたらTrueを返す
+        失敗した行は残るため、次のflushで再試行される
+        """
+        self._flush_rows()
+        self._flush_done()
+        self.last_flush = time.monotonic()
+        if self:
+            logging.error("Sheet writes still pending: rows=%d, done=%d", len(self.pending_rows), len(self.pending_done))
+        return not self
+
+    def _flush_rows(self) -> None:
+        if not self.pending_rows:
+            return
+        rows = self.pending_rows
+        try:
+            with metrics.span("sheets.append_rows"):
+                response = sheets_limiter.call_non_idempotent(self.worksheet.append_rows,
+                                                              [values for _, values in rows],
+                                                              value_input_option="USER_ENTERED")
+        except Exception as e:
+            logging.error(f"Error adding records to spreadsheet: {e}")
+            if not sheets_limiter.rejected(e):
+                self._reconcile_rows(rows)
+            return
+        # 追加は先頭から行われるため、書き込めた行数分だけ取り除く
+        updates = response.get("updates", {}) if response else {}
+        landed = updates.get("updatedRows", len(rows))
+        match = A1_FIRST_ROW_RE.search(updates.get("updatedRange", ""))
+        self._appended(rows, landed, int(match.group(1)) if match else None)
+
+    def _appended(self, rows: list, landed: int, first_row: Optional[int]) -> None:
+        for _, values in rows[:landed]:
+            logging.info("Record added to spreadsheet: %s", values)
+        if self.on_appended and first_row:
+            self.on_appended([(key, first_row + i) for i, (key, _) in enumerate(rows[:landed])])
+        self.pending_rows = rows[landed:]
+        self.appended += landed
+        metrics.count("appended", landed)
+
+    def _reconcile_rows(self, rows: list) -> None:
+        """
+        応答が返らなかった追記が適用されたかを、シート末尾の amount/store 列と比べて確かめる
+        適用されていれば書き込めたものとして扱い、されていなければ残して次のflushで送る
+        確かめられない場合は重複を避けるため送らずに捨てる (台帳には未反映として残り、次回の実行で追記される)
+        """
         try:
-            mark_as_read("imap.gmail.com", EMAIL, EMAIL_PASSWORD, email_id)
-            logging.info("Email marked as read: %s", email_id)
+            with metrics.span("sheets.reconcile"):
+                values = sheets_limiter.call(self.worksheet.get, "C:D", value_render_option="UNFORMATTED_VALUE")
         except Exception as e:
-            logging.error(f"Error marking email as read: {e}")
+            logging.error(f"Could not check whether {len(rows)} records were added, leaving them to the ledger: {e}")
+            self.pending_rows = []
+            return
+        sent = [[str(values[2]), str(values[3])] for _, values in rows]
+        tail = [[str(cell) for cell in (row + ["", ""])[:2]] for row in values[-len(rows):]]
+        if len(values) > len(rows) and tail == sent:
+            logging.info("Records were added despite the error: %d rows", len(rows))
+            self._appended(rows, len(rows), len(values) - len(rows) + 1)
+            self.appended += len(rows)
+            metrics.count("appended", len(rows))
+
+    def _flush_done(self) -> None:
+        if not self.pending_done:
+            return
+        rows = self.pending_done
+        data = [{"range": rowcol_to_a1(row, MF_STATUS_COL), "values": [["done"]]} for row in rows]
+        try:
+            with metrics.span("sheets.batch_update"):
+                response = sheets_limiter.call(self.worksheet.batch_update, data, value_input_option="USER_ENTERED")
+        except Exception as e:
+            logging.error(f"Error updating cells for records {rows}: {e}")
+            return
+        if response and "responses" in response:
+            landed = set()
+            for r in response["responses"]:
+                match = A1_ROW_RE.search(r.get("updatedRange", ""))
+                if match:
+                    landed.add(int(match.group(1)))
+        else:
+            landed = set(rows)
+        logging.info("Updated cells for records: %s", sorted(landed))
+        if self.on_updated:
+            self.on_updated(sorted(landed))
+        self.pending_done = [row for row in rows if row not in landed]
+        self.updated += len(landed)
+
+
+SHEET_HEADER = ["email_date", "date_of_use", "amount", "store", "mf"]
+
+
+class SheetPartitions:
+    """
+    ANAPayシートと、利用日時の年 (year) または月 (month) ごとに分けたシート ("ANAPay_2024-03" など)
+    台帳はシート名 (分けていないANAPayシートは "") と行番号の組で行を指すため、行を移さずに済む
+    シートの一覧は最初に必要になったときに1回だけ取得し、ないシートはヘッダー行を付けて作る
+    """
+
+    def __init__(self, worksheet, mode: str = SHEET_PARTITION):
+        self.base = worksheet
+        self.mode = mode
+        self.worksheets: Optional[dict] = None
+        self.headerless: set[str] = set()  # 追加したがヘッダー行をまだ書けていないシート
+        self.lock = threading.Lock()
+
+    @classmethod
+    def of(cls, worksheet) -> "SheetPartitions":
+        """ANAPayシートを SheetPartitions にする (既に SheetPartitions ならそのまま返す)"""
+        return worksheet if isinstance(worksheet, cls) else cls(worksheet)
+
+    def name_for(self, date_of_use: str) -> str:
+        """利用日時 (YYYY-MM-DD HH:MM:SS) の行を追加するシート名"""
+        if self.mode == "year":
+            return f"{self.base.title}_{date_of_use[:4]}"
+        if self.mode == "month":
+            return f"{self.base.title}_{date_of_use[:7]}"
+        return ""
+
+    def _worksheets(self) -> dict:
+        if self.worksheets is None:
+            with metrics.span("sheets.worksheets"):
+                worksheets = sheets_limiter.call(self.base.spreadsheet.worksheets)
+            self.worksheets = {worksheet.title: worksheet for worksheet in worksheets}
+        return self.worksheets
+
+    def partitions(self) -> dict:
+        """既にある分けたシートを {シート名: シート} で返す"""
+        pattern = re.compile(re.escape(self.base.title) + r"_\d{4}(?:-\d{2})?")
+        with self.lock:
+            return {title: worksheet for title, worksheet in self._worksheets().items()
+                    if pattern.fullmatch(title)}
+
+    def get(self, name: str):
+        """シート名のシートを返す。"" ならANAPayシート"""
+        if not name:
+            return self.base
+        with self.lock:
+            worksheet = self._worksheets().get(name)
+            if worksheet is None:
+                worksheet = self._add(name)
+            if name in self.headerless:
+                # 1行目に書くので、失敗しても次に使うときにそのまま書き直せる
+                with metrics.span("sheets.batch_update"):
+                    sheets_limiter.call(worksheet.batch_update, [{"range": "A1", "values": [SHEET_HEADER]}],
+                                        value_input_option="RAW")
+                self.headerless.discard(name)
+        return worksheet
+
+    def _add(self, name: str):
+        """
+        シートを追加して一覧に入れる (ヘッダー行は get で書く)
+        追加に失敗しても、応答が返らなかっただけで追加されていることがあるため、一覧を取得し直して確かめる
+        """
+        try:
+            with metrics.span("sheets.add_worksheet"):
+                worksheet = sheets_limiter.call_non_idempotent(self.base.spreadsheet.add_worksheet, name,
+                                                               rows=1, cols=len(SHEET_HEADER))
+        except Exception as e:
+            self.worksheets = None
+            worksheet = self._worksheets().get(name)
+            if worksheet is None:
+                raise
+            logging.warning(f"Worksheet {name} already exists after failed add: {e}")
+        else:
+            logging.info("Worksheet added: %s", name)
+        self.worksheets[name] = worksheet
+        self.headerless.add(name)
+        return worksheet
 
 
-def mark_as_read(imap_server, username, password, email_id):
+class PartitionedSheetWriter:
     """
-    指定したメールを既読にする
+    行をシートごとの SheetWriteBuffer に振り分ける
+    on_appended / on_updated には SheetWriteBuffer と同じ引数に加えてシート名が渡される
     """
-    mail = imaplib.IMAP4_SSL(imap_server)
+
+    def __init__(self, sheets: SheetPartitions, on_appended=None, on_updated=None, **kwargs):
+        self.sheets = sheets
+        self.on_appended = on_appended
+        self.on_updated = on_updated
+        self.kwargs = kwargs
+        self.max_rows = max(1, kwargs.get("max_rows", SHEET_FLUSH_ROWS))
+        self.max_seconds = kwargs.get("max_seconds", SHEET_FLUSH_SECONDS)
+        self.buffers: dict[str, SheetWriteBuffer] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+    def __len__(self):
+        return sum(len(buffer) for buffer in self.buffers.values())
+
+    @property
+    def appended(self) -> int:
+        return sum(buffer.appended for buffer in self.buffers.values())
+
+    @property
+    def updated(self) -> int:
+        return sum(buffer.updated for buffer in self.buffers.values())
+
+    def buffer(self, name: str) -> SheetWriteBuffer:
+        buffer = self.buffers.get(name)
+        if buffer is None:
+            on_appended = self.on_appended and (lambda appended: self.on_appended(appended, name))
+            on_updated = self.on_updated and (lambda rows: self.on_updated(rows, name))
+            buffer = self.buffers[name] = SheetWriteBuffer(self.sheets.get(name), on_appended=on_appended,
+                                                           on_updated=on_updated, **self.kwargs)
+        return buffer
+
+    def append(self, values: tuple, key=None, name: str = "") -> None:
+        """シート name の末尾に追加する行をためる"""
+        self.buffer(name).append(values, key)
+
+    def mark_done(self, row: int, name: str = "") -> None:
+        """シート name の指定行の "mf" 列を "done" にする更新をためる"""
+        self.buffer(name).mark_done(row)
+
+    def flush(self) -> bool:
+        """すべてのシートのためている書き込みを送る。すべて書き込めたらTrueを返す"""
+        results = [buffer.flush() for buffer in self.buffers.values() if buffer]
+        return all(results)
+
+
+class BackgroundSheetWriter:
+    """
+    PartitionedSheetWriter を別スレッドで動かし、呼び出し側がSheets APIの応答を待たないようにする
+    台帳のSQLite接続はスレッドをまたいで使えないため、"done" を書き込めた (シート名, 行番号) は close() で返す
+    """
+
+    def __init__(self, sheets: SheetPartitions, **kwargs):
+        self.updated_rows: list[tuple[str, int]] = []
+        self.writer = PartitionedSheetWriter(sheets, on_updated=self._updated, **kwargs)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, name="sheet-writer", daemon=True)
+        self.thread.start()
+
+    def _updated(self, rows: list[int], name: str) -> None:
+        self.updated_rows.extend((name, row) for row in rows)
+
+    def mark_done(self, row: int, name: str = "") -> None:
+        self.queue.put((name, row))
+
+    def _loop(self) -> None:
+        while True:
+            try:
+                item = self.queue.get(timeout=self.writer.max_seconds)
+            except queue.Empty:
+                # 新しい更新がなくても、たまっている分は max_seconds ごとに書き込む
+                if self.writer:
+                    self.writer.flush()
+                continue
+            if item is None:
+                break
+            name, row = item
+            try:
+                self.writer.mark_done(row, name)
+            except Exception as e:
+                # シートを作れなかった場合など。台帳は "done" のままなので次回の sync_sheet で書き込まれる
+                logging.error(f"Error updating cell for record {name or 'ANAPay'}!{row}: {e}")
+        self.writer.flush()
+
+    def close(self) -> list[tuple[str, int]]:
+        """残りを書き込んでスレッドを止め、"done" を書き込めた (シート名, 行番号) を返す"""
+        self.queue.put(None)
+        self.thread.join()
+        return self.updated_rows
+
+
+def gmail2spredsheet(worksheet, ledger: Ledger, mail=None):
+    """
+    IMAPからANA Payの利用履歴を取得して台帳に追加し、スプレッドシートに反映する
+    mail を渡した場合はその接続を使い、切断しない
+    """
+    seed_ledger(worksheet, ledger)
+
+    # get last day from ledger
+    after = get_last_email_date(ledger.last_email_date())
+    logging.info("Last day in ledger: %s", after)
+
+    if mail is not None:
+        ingest_anapay_mails(worksheet, ledger, mail, after)
+        return
+
+    # 取得と既読化で同じIMAP接続を使う
+    mail = connect_imap("imap.gmail.com", EMAIL, EMAIL_PASSWORD)
+    if mail is None:
+        return
+    try:
+        ingest_anapay_mails(worksheet, ledger, mail, after)
+    finally:
+        disconnect_imap(mail)
+
+
+def seed_ledger(worksheet, ledger: Ledger) -> None:
+    """台帳が空なら既存のスプレッドシートを一度だけ取り込む"""
+    if not len(ledger):
+        sheets = SheetPartitions.of(worksheet)
+        with metrics.span("sheets.get_all_records"):
+            records = sheets_limiter.call(sheets.base.get_all_records)
+        imported = ledger.import_records(records)
+        if sheets.mode:
+            for name, partition in sorted(sheets.partitions().items()):
+                with metrics.span("sheets.get_all_records"):
+                    records = sheets_limiter.call(partition.get_all_records)
+                imported += ledger.import_records(records, name)
+        logging.info("Records imported from spreadsheet: %d", imported)
+    logging.info("Records in ledger: %d", len(ledger))
+
+
+def add_anapay_records(worksheet, ledger: Ledger, records) -> list[ANAPay]:
+    """台帳にないものだけを追加し、スプレッドシートへの書き込みバッファに流す。追加したものを返す"""
+    new_list = []
+    sheets = SheetPartitions.of(worksheet)
+    with PartitionedSheetWriter(sheets, on_appended=ledger.set_sheet_rows,
+                                on_updated=ledger.mark_sheet_done) as writer:
+        for chunk in batched(records, writer.max_rows):
+            with metrics.span("ledger.add"):
+                added = ledger.add(chunk)
+            metrics.count("deduped", len(chunk) - len(added))
+            for ana_pay in added:
+                writer.append(ana_pay.values(), key=Ledger.key(ana_pay),
+                              name=sheets.name_for(ana_pay.date_of_use_str))
+            new_list.extend(added)
+    return new_list
+
+
+def ingest_anapay_mails(worksheet, ledger: Ledger, mail, after: str):
+    """ログイン済みのIMAP接続から新しい利用通知を取得して台帳とスプレッドシートに書き込み、既読にする"""
+    # get ANA Pay email from IMAP (チェックポイント以降のUIDのみ)
+    checkpoint = load_checkpoint()
+    uids = search_anapay_uids(mail, after, checkpoint)
+    logging.info("ANA Pay emails: %d", len(uids))
+    handled = set()
+    if INGEST_STREAMING:
+        records = stream_anapay_info(mail, uids, handled=handled)
+    else:
+        records = iter_anapay_info(mail, uids, handled=handled)
+
+    # 台帳にないものだけを追加し、スプレッドシートへの書き込みバッファに流す
+    new_uids = [added.email_id for added in add_anapay_records(worksheet, ledger, records)]
+    logging.info("Records added to ledger: %d", len(new_uids))
+
+    # 台帳に入ればスプレッドシートへの反映は次回でも再試行できるためチェックポイントを進める
+    # 取得に失敗したUIDより先には進めず、次回そこから取得し直す
+    checkpoint.advance(uids, handled)
+    if len(handled) < len(uids):
+        logging.warning("IMAP checkpoint held at UID %d: %d emails not fetched",
+                        checkpoint.last_uid, len(uids) - len(handled))
+    try:
+        save_checkpoint(checkpoint)
+    except OSError as e:
+        logging.error(f"Error saving IMAP checkpoint: {e}")
+
+    # 書き込めなかった行などの差分を反映する
+    sync_sheet(worksheet, ledger)
+
+    # 新しく追加したメールをまとめて既読にする
+    results = mark_as_read(mail, new_uids)
+    for uid, success in results.items():
+        if success:
+            logging.info("Email marked as read: %s", uid)
+        else:
+            logging.error("Error marking email as read: %s", uid)
+
+
+def sync_sheet(worksheet, ledger: Ledger) -> None:
+    """台帳の差分 (未追加の行と "mf" 列の変更) だけをスプレッドシートに書き込む"""
+    sheets = SheetPartitions.of(worksheet)
+    with PartitionedSheetWriter(sheets, on_appended=ledger.set_sheet_rows,
+                                on_updated=ledger.mark_sheet_done) as writer:
+        for record in ledger.unmirrored():
+            writer.append((record["email_date"], record["date_of_use"], record["amount"], record["store"],
+                           record["mf_status"]), key=record["message_id"],
+                          name=sheets.name_for(record["date_of_use"]))
+        for record in ledger.unsynced():
+            if record["mf_status"] == "done":
+                writer.mark_done(record["sheet_row"], record["sheet_name"])
+    logging.info("Records added to spreadsheet: %d, updated: %d", writer.appended, writer.updated)
+
+
+def mark_as_read(mail, uids: list[bytes]) -> dict[bytes, bool]:
+    """
+    指定したUIDのメールを1回のUID STOREでまとめて既読にする
+    UIDごとの成否を返す (STOREの応答にFLAGSが返ってきたUIDを成功とみなす)
+    """
+    results = {uid: False for uid in uids}
+    if not uids:
+        return results
     try:
-        mail.login(username, password)
-        mail.select("inbox")
-        mail.store(email_id, '+FLAGS', '\\Seen')
+        with metrics.span("imap.store"):
+            result, data = mail.uid("STORE", b",".join(uids), '+FLAGS', '(\\Seen)')
     except Exception as e:
         logging.error(f"IMAP mark as read exception: {e}")
-    finally:
-        mail.close()
-        mail.logout()
+        return results
+    if result != 'OK':
+        logging.error(f"IMAP mark as read failed with result: {result}, data: {data}")
+        return results
+
+    for item in data:
+        if isinstance(item, bytes):
+            match = FETCH_UID_RE.search(item)
+            if match and match.group(1) in results:
+                results[match.group(1)] = True
+    return results
+
+
+ANAPAY_SENDER = b"payinfo@121.ana.co.jp"
+HEADER_END_RE = re.compile(rb"\r?\n\r?\n")
+
+
+def iter_mbox(path: str) -> Iterator[tuple[str, bytes]]:
+    """
+    mbox (Google Takeoutなど) をメモリマップして1通ずつ (ID, RFC822) を返す
+    ファイル全体を読み込まないので、数GBのmboxでも使うメモリは1通分で済む
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)  # 読み終えたページは先に解放してよいとOSに伝える
+            start = 0 if mm[:5] == b"From " else mm.find(b"\nFrom ") + 1
+            if start == 0 and mm[:5] != b"From ":
+                return
+            index = 0
+            while True:
+                end = mm.find(b"\nFrom ", start)
+                stop = len(mm) if end < 0 else end + 1
+                body_start = mm.find(b"\n", start) + 1  # "From " の区切り行を除く
+                yield f"{path}:{index}", mm[body_start:stop]
+                if end < 0:
+                    return
+                index += 1
+                start = stop
+
+
+def iter_export_messages(path: str) -> Iterator[tuple[str, bytes]]:
+    """mboxファイル、Maildir (cur/new)、.emlファイルまたはそれを含むディレクトリから1通ずつ返す"""
+    if os.path.isfile(path):
+        if path.endswith(".eml"):
+            with open(path, "rb") as f:
+                yield path, f.read()
+        else:
+            yield from iter_mbox(path)
+        return
+    if os.path.isdir(os.path.join(path, "cur")) or os.path.isdir(os.path.join(path, "new")):
+        names = [os.path.join(path, sub, name) for sub in ("cur", "new") if os.path.isdir(os.path.join(path, sub))
+                 for name in sorted(os.listdir(os.path.join(path, sub)))]
+    else:
+        names = sorted(os.path.join(root, name) for root, _, files in os.walk(path)
+                       for name in files if name.endswith(".eml"))
+    for name in names:
+        with open(name, "rb") as f:
+            yield name, f.read()
+
+
+def is_anapay_sender(raw: bytes) -> bool:
+    """ヘッダー部分に送信元のアドレスがあるか (解析プロセスに送る前の絞り込み)"""
+    match = HEADER_END_RE.search(raw)
+    return ANAPAY_SENDER in (raw[:match.start()] if match else raw)
+
+
+def parse_export_chunk(chunk: list[tuple[str, bytes]]) -> list[ANAPay]:
+    """解析プロセスで実行する。ANA Payの利用通知だけを解析して返す"""
+    results = []
+    for email_id, raw in chunk:
+        try:
+            ana_pay = _parse_anapay_message(raw, email_id)
+        except Exception as e:
+            logging.warning(f"Error parsing {email_id}: {e}")
+            continue
+        if ana_pay:
+            results.append(ana_pay)
+    return results
+
+
+def iter_backfill(paths: list[str], workers: int = BACKFILL_WORKERS,
+                  chunk_size: int = BACKFILL_CHUNK_SIZE) -> Iterator[ANAPay]:
+    """
+    エクスポートしたメールを読み、ANA Payの利用通知をプロセスプールで解析して読んだ順に返す
+    解析待ちのチャンクは workers の2倍までに抑えるので、メールの総量によらずメモリ使用量は一定
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    def chunks():
+        chunk = []
+        for path in paths:
+            for email_id, raw in iter_export_messages(path):
+                metrics.count("scanned")
+                if not is_anapay_sender(raw):
+                    continue
+                chunk.append((email_id, raw))
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk in chunks():
+            pending.append(executor.submit(parse_export_chunk, chunk))
+            while len(pending) >= workers * 2:
+                yield from _backfill_results(pending.popleft())
+        while pending:
+            yield from _backfill_results(pending.popleft())
+
+
+def _backfill_results(future) -> list[ANAPay]:
+    results = future.result()
+    metrics.count("parsed", len(results))
+    return results
+
+
+def backfill(worksheet, ledger: Ledger, paths: list[str]) -> None:
+    """エクスポートしたメールから台帳とスプレッドシートに過去の利用履歴を取り込む (IMAPは使わない)"""
+    seed_ledger(worksheet, ledger)
+    with metrics.span("backfill"):
+        added = add_anapay_records(worksheet, ledger, iter_backfill(paths))
+    logging.info("Records added to ledger: %d", len(added))
+    sync_sheet(worksheet, ledger)
+
+
+class Diagnostics:
+    """
+    スクリーンショットによる診断情報の保存
+    level が "off" なら保存しない、"on-failure" なら失敗時のみ、"trace" なら各ステップでも保存する
+    ファイルは <directory>/<実行ID>/<レコード>/<連番>_<名前> に置き、ディスクへの書き込みは
+    バックグラウンドのスレッドで行う。実行ごとのディレクトリは新しい keep_runs 個だけ残す
+    常駐モードでは new_run() で処理ごとに実行IDを変える
+    レコードと連番はスレッドごとに持つので、複数のブラウザから並行して保存できる
+    """
+
+    LEVELS = ("off", "on-failure", "trace")
+
+    def __init__(self, level: str = DIAGNOSTICS_LEVEL, directory: str = SCREENSHOT_DIR,
+                 keep_runs: int = DIAGNOSTICS_KEEP_RUNS, queue_size: int = 32):
+        if level not in self.LEVELS:
+            logging.warning(f"Unknown DIAGNOSTICS_LEVEL: {level}, using on-failure")
+            level = "on-failure"
+        self.level = level
+        self.directory = directory
+        self.keep_runs = max(1, keep_runs)
+        self.run_id = ""
+        self.runs = 0
+        self.records = 0
+        self.pruned = False
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.writer = None
+        self.new_run()
+
+    def new_run(self) -> None:
+        """以降のスクリーンショットを新しい実行のディレクトリに保存する (古い実行は次の保存時に削除する)"""
+        with self.lock:
+            self.runs += 1
+            run_id = f"{datetime.now():%Y%m%d-%H%M%S}"
+            # 同じ秒に始めた実行とディレクトリを分ける
+            self.run_id = run_id if not self.run_id.startswith(run_id) else f"{run_id}-{self.runs}"
+            self.records = 0
+            self.pruned = False
+
+    def next_record(self, label: str) -> None:
+        """以降のスクリーンショットを新しいレコードのディレクトリに保存する"""
+        with self.lock:
+            self.records += 1
+            records = self.records
+        self.local.record = f"{records:04d}_{label}"
+        self.local.seq = 0
+
+    def trace(self, driver, name: str) -> None:
+        if self.level == "trace":
+            self._capture(driver, name)
+
+    def failure(self, driver, name: str) -> None:
+        if self.level != "off":
+            self._capture(driver, name)
+
+    def _capture(self, driver, name: str) -> None:
+        record = getattr(self.local, "record", "login")
+        self.local.seq = getattr(self.local, "seq", 0) + 1
+        path = os.path.join(self.directory, self.run_id, record, f"{self.local.seq:03d}_{name}")
+        try:
+            png = driver.get_screenshot_as_png()
+        except Exception as e:
+            logging.error(f"Error capturing screenshot {path}: {e}")
+            return
+        with self.lock:
+            if not self.pruned:
+                self._prune()
+                self.pruned = True
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write_loop, name="screenshot-writer", daemon=True)
+                self.writer.start()
+        try:
+            self.queue.put_nowait((path, png))
+        except queue.Full:
+            logging.warning(f"Screenshot dropped (writer busy): {path}")
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            path, png = item
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as f:
+                    f.write(png)
+                logging.info(f"スクリーンショットを保存しました: {path}")
+            except OSError as e:
+                logging.error(f"Error saving screenshot {path}: {e}")
+
+    def _prune(self) -> None:
+        """古い実行のディレクトリを削除し、今回の分を含めて keep_runs 個に収める (今回の分は削除しない)"""
+        try:
+            runs = sorted(d for d in os.listdir(self.directory)
+                          if d != self.run_id and os.path.isdir(os.path.join(self.directory, d)))
+        except FileNotFoundError:
+            return
+        for run in runs[:max(0, len(runs) - self.keep_runs + 1)]:
+            shutil.rmtree(os.path.join(self.directory, run), ignore_errors=True)
+
+    def close(self) -> None:
+        """書き込み待ちのスクリーンショットをすべて書き込む"""
+        with self.lock:
+            writer, self.writer = self.writer, None
+        if writer is not None:
+            self.queue.put(None)
+            writer.join()
+
+
+diagnostics = Diagnostics()
 
 
 def save_screenshot(driver, filename):
-    path = os.path.join("/app/screenshots", filename)
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    driver.save_screenshot(path)
-    logging.info(f"スクリーンショットを保存しました: {path}")
+    """失敗時のスクリーンショットを保存する (DIAGNOSTICS_LEVEL が off 以外のとき)"""
+    diagnostics.failure(driver, filename)
+
+
+def trace_screenshot(driver, filename):
+    """途中経過のスクリーンショットを保存する (DIAGNOSTICS_LEVEL が trace のときのみ)"""
+    diagnostics.trace(driver, filename)
+
+
+MF_ENTRY_SAVED_TEXT = "続けて入力する"  # 手入力フォームの保存後に表示されるボタン (HTTPでPOSTした応答にも含まれる)
+MF_PAGE_STATES = {
+    # 複数の画面が同時に該当する場合はこの順で判定する
+    # ロケーターの種類はseleniumを読み込まずに済むよう By.XPATH などと同じ文字列で書く
+    "kakeibo": ("xpath", "//*[@id='kakeibo']/section/div[1]/div[1]/div/button"),
+    "account_chooser": ("xpath", "/html/body/main/div/div/div[2]/div/section/h1[normalize-space()='アカウントを選択する']"),
+    "password_form": ("name", "mfid_user[password]"),
+    "email_form": ("name", "mfid_user[email]"),
+    "top_page": ("xpath", "//*[@id='cf-manual-entry']/h2[normalize-space()='カンタン入力']"),
+    "logged_in": ("xpath", "//div[contains(@class, 'container-large')]"),
+    # 手入力フォームの保存後
+    "entry_saved": ("xpath", "//*[self::button or self::a or self::input]"
+                             f"[normalize-space()='{MF_ENTRY_SAVED_TEXT}' or @value='{MF_ENTRY_SAVED_TEXT}']"),
+    "entry_error": ("css selector", ".modal .alert-danger"),
+}
+MF_LOGIN_STATES = ("kakeibo", "account_chooser", "password_form", "email_form", "top_page", "logged_in")
+MF_ACCOUNT_BUTTON_XPATH = "/html/body/main/div/div/div[2]/div/section/div/div/form/button"
+MF_LOGIN_MAX_VISITS = 3  # 同じ画面がこれより多く表示されたらログインを諦める
+
+
+def detect_page_state(driver, states=MF_LOGIN_STATES) -> Optional[str]:
+    """states のうち現在表示されている最初の画面を返す (待たない)"""
+    from selenium.common.exceptions import WebDriverException
+
+    for state in states:
+        try:
+            if driver.find_elements(*MF_PAGE_STATES[state]):
+                return state
+        except WebDriverException:
+            return None
+    return None
+
+
+def wait_for_page_state(driver, states=MF_LOGIN_STATES, timeout: float = MF_WAIT_TIMEOUT,
+                        expected: Optional[str] = None) -> Optional[str]:
+    """
+    states のいずれかの画面が表示されるまで待ち、その画面を返す (タイムアウトならNone)
+    expected 以外の画面で抜けた場合は、expected だけを待っていたら費やしていた時間を
+    mf.wait_saved として記録する
+    """
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    start = time.perf_counter()
+    try:
+        state = WebDriverWait(driver, timeout, poll_frequency=MF_WAIT_POLL).until(
+            lambda d: detect_page_state(d, states))
+    except TimeoutException:
+        state = None
+    elapsed = time.perf_counter() - start
+    metrics.observe(f"mf.wait.{state or 'timeout'}", elapsed)
+    if expected and state and state != expected:
+        metrics.observe("mf.wait_saved", timeout - elapsed)
+        logging.info(f"{expected} ではなく {state} を検出しました ({timeout - elapsed:.1f}秒短縮)")
+    return state
+
+
+def wait_for_staleness(driver, element, timeout: float = MF_WAIT_TIMEOUT) -> bool:
+    """
+    送信した画面の要素が消える (次の画面に遷移する) まで待つ
+    すぐに画面を判定すると送信前の画面がまだ残っていて、同じフォームに入力し直してしまうため
+    """
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    start = time.perf_counter()
+    try:
+        WebDriverWait(driver, timeout, poll_frequency=MF_WAIT_POLL).until(EC.staleness_of(element))
+        return True
+    except TimeoutException:
+        logging.warning(f"送信後も画面が遷移しませんでした ({timeout:.0f}秒)")
+        return False
+    finally:
+        metrics.observe("mf.wait.submitted", time.perf_counter() - start)
+
+
+def save_mf_session(driver, path: str = MF_SESSION_FILE) -> None:
+    """ログイン後のmoneyforward.comのCookieを保存する (本人以外が読めないよう0600で作成する)"""
+    tmp_path = f"{path}.tmp"
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(driver.get_cookies(), f)
+        os.replace(tmp_path, path)
+        logging.info(f"Moneyforward session saved: {path}")
+    except OSError as e:
+        logging.error(f"Error saving moneyforward session: {e}")
+
+
+def restore_mf_session(driver, path: str = MF_SESSION_FILE) -> bool:
+    """
+    保存したCookieをブラウザに戻し、/cf を1回読み込んでセッションが有効か確認する
+    有効なら /cf を開いた状態でTrueを返す
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            cookies = json.load(f)
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError) as e:
+        logging.warning(f"Invalid moneyforward session {path}: {e}")
+        return False
+
+    # Cookieを追加するには同じドメインのページを開いておく必要がある
+    driver.get("https://moneyforward.com/robots.txt")
+    for cookie in cookies:
+        try:
+            driver.add_cookie(cookie)
+        except Exception as e:
+            logging.warning(f"Cookie not restored: {cookie.get('name')}: {e}")
+
+    driver.get("https://moneyforward.com/cf")
+    # ログイン画面が出ればタイムアウトを待たずに無効と判断する
+    if wait_for_page_state(driver, timeout=MF_SESSION_CHECK_TIMEOUT, expected="kakeibo") != "kakeibo":
+        logging.info("保存したセッションは無効でした。ログインします")
+        # 常駐ブラウザのCookieは同じ実行のほかのブラウザと共有しているので消さない (ログインで上書きする)
+        if not getattr(driver, "anapay2mf_attached", False):
+            driver.delete_all_cookies()
+        return False
+    logging.info("保存したセッションでログインしました")
+    return True
+
+
+# ChromeDriverが起動するChromeと browser コマンドで常駐させるChromeに共通の引数
+MF_CHROME_ARGS = [
+    "--no-sandbox",
+    "--disable-dev-shm-usage",
+    "--disable-gpu",
+    "--window-size=1920,1080",
+    "--disable-extensions",
+    "--disable-software-rasterizer",
+    "--headless",
+    "--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3",
+    "--lang=ja-JP",
+]
+
+
+def browser_health(address: str, path: str = "/json/version", timeout: float = 3) -> Optional[object]:
+    """起動済みのChromeのDevTools HTTPエンドポイントに問い合わせ、応答 (JSON) を返す。応答がなければNone"""
+    try:
+        response = requests.get(f"http://{address}{path}", timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+    except (requests.RequestException, ValueError):
+        return None
+
+
+def _webdriver(options):
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service as ChromeService
+
+    if MF_WEBDRIVER_URL:
+        return webdriver.Remote(command_executor=MF_WEBDRIVER_URL, options=options)
+    return webdriver.Chrome(service=ChromeService(executable_path='/usr/bin/chromedriver'), options=options)
+
+
+warm_browser_cleared = threading.Event()  # この実行で常駐ブラウザのCookieを消したか
+
+
+def start_mf_driver(debug_port: int = 9222):
+    """
+    MF_BROWSER_ADDRESS のChromeが応答すればそこに新しいタブを開いて接続し、なければChromeを起動する
+    接続した場合は、前の実行 (別のアカウントかもしれない) のCookieを最初の接続でだけ消す
+    Cookieはタブ間で共有されるため、2つ目以降 (MF_CONCURRENCY) で消すと先にログインしたタブがログアウトされる
+    """
+    from selenium.common.exceptions import WebDriverException
+    from selenium.webdriver.chrome.options import Options
+
+    if MF_BROWSER_ADDRESS:
+        if browser_health(MF_BROWSER_ADDRESS) is None:
+            logging.warning(f"Warm browser {MF_BROWSER_ADDRESS} is not responding, starting a new browser")
+        else:
+            options = Options()
+            options.debugger_address = MF_BROWSER_ADDRESS
+            driver = None
+            try:
+                driver = _webdriver(options)
+                driver.anapay2mf_attached = True
+                driver.switch_to.new_window("tab")
+                if not warm_browser_cleared.is_set():
+                    if hasattr(driver, "execute_cdp_cmd"):
+                        driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+                    else:
+                        # リモートのWebDriverではCDPを使えないため、moneyforward.comのCookieだけを消す
+                        driver.get("https://moneyforward.com/robots.txt")
+                        driver.delete_all_cookies()
+                    warm_browser_cleared.set()
+                metrics.count("mf_browser_attached")
+                return driver
+            except WebDriverException as e:
+                logging.warning(f"Attaching to warm browser {MF_BROWSER_ADDRESS} failed, starting a new browser: {e}")
+                if driver is not None:
+                    release_mf_driver(driver)
+
+    # SeleniumでChromiumを使用する設定
+    options = Options()
+    for argument in MF_CHROME_ARGS:
+        options.add_argument(argument)
+    options.add_argument(f"--remote-debugging-port={debug_port}")
+    return _webdriver(options)
 
 
-def login_mf():
-    """login moneyforward sbi"""
+def release_mf_driver(driver) -> None:
+    """ブラウザを閉じる。起動済みのChromeに接続していた場合は開いたタブだけを閉じ、Chromeは残す"""
+    try:
+        if getattr(driver, "anapay2mf_attached", False) and len(driver.window_handles) > 1:
+            driver.close()
+        driver.quit()
+    except Exception as e:
+        logging.warning(f"Error closing browser: {e}")
+
+
+def add_browser_records(count: int, path: str = MF_BROWSER_STATE_FILE) -> None:
+    """browser コマンドの状態ファイルに、常駐しているChromeで登録した件数を足す (なければなにもしない)"""
+    import fcntl
+
+    try:
+        with open(path, "r+", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            state = json.load(f)
+            state["records"] = state.get("records", 0) + count
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logging.warning(f"Error updating browser state {path}: {e}")
 
 
+def login_mf(debug_port: int = 9222):
+    """
+    login moneyforward sbi
+    ログインして家計簿 (/cf) を開いたブラウザを返す。ログインできなければNone
+    """
+    from selenium.common.exceptions import WebDriverException
+    from selenium.webdriver.common.by import By
+
     if not EMAIL_MF or not PASSWORD:
         logging.error("MoneyforwadのログインEMAILまたはPASSWORDが設定されていません。")
         return
@@ -258,213 +2218,180 @@ def login_mf():
     logging.info(f"使用するEMAIL: {EMAIL_MF}")
     logging.info(f"使用するPASSWORD: {'*' * len(PASSWORD)}")
 
-    # SeleniumでChromiumを使用する設定
-    options = Options()
-    options.headless = True
-    options.add_argument("--no-sandbox")
-    options.add_argument("--disable-dev-shm-usage")
-    options.add_argument("--disable-gpu")
-    options.add_argument("--window-size=1920,1080")
-    options.add_argument("--remote-debugging-port=9222")
-    options.add_argument("--disable-extensions")
-    options.add_argument("--disable-software-rasterizer")
-    options.add_argument("--headless")
-    options.add_argument(
-        "--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3")
-    options.add_argument("--lang=ja-JP")
-    service = ChromeService(executable_path='/usr/bin/chromedriver')
-
-    driver = webdriver.Chrome(service=service, options=options)
+    steps = metrics.steps("mf.login")
+    driver = start_mf_driver(debug_port)
+    steps.mark("start_browser")
+
+    # 保存したセッションが有効ならログインを省略する
+    restored = restore_mf_session(driver)
+    steps.mark("restore_session")
+    if restored:
+        return driver
 
     logging.info("Login to moneyfoward")
     driver.get("https://id.moneyforward.com/sign_in")
 
+    # 表示された画面に応じて操作し、家計簿 (/cf) の「手入力」ボタンが出るまで進める
+    expected = "email_form"
+    visits = {}
+    passwords_sent = 0
     try:
-        logging.info("ログインID入力ページを待機中")
-        # ログインIDを入力してログインボタンをクリック
-        email_input = WebDriverWait(driver, 30).until(
-            EC.presence_of_element_located((By.NAME, "mfid_user[email]"))
-        )
-        email_input.send_keys(EMAIL_MF)
-        logging.info(f"メールアドレスを入力: {EMAIL_MF}")
-        login_button = driver.find_element(By.ID, "submitto")
-        login_button.click()
-
-        logging.info("パスワード入力ページを待機中")
-        # パスワード入力ページが読み込まれるのを待つ
-        save_screenshot(driver, "before_password.png")
-        try:
-            WebDriverWait(driver, 30).until(
-                EC.presence_of_element_located((By.NAME, "mfid_user[password]"))
-            )
-        except TimeoutException:
-            logging.error("パスワード入力ページの読み込みがタイムアウトしました")
-            save_screenshot(driver, "password_page_timeout.png")
-            return
+        while True:
+            state = wait_for_page_state(driver, expected=expected)
+            steps.mark(state or "timeout")
+            if state is None:
+                logging.error(f"ログイン中の画面の読み込みがタイムアウトしました (待機していた画面: {expected})")
+                save_screenshot(driver, "timeout_error.png")
+                release_mf_driver(driver)
+                return None
+            visits[state] = visits.get(state, 0) + 1
+            if visits[state] > MF_LOGIN_MAX_VISITS:
+                logging.error(f"ログイン中に同じ画面が繰り返し表示されました: {state}")
+                save_screenshot(driver, f"login_loop_{state}.png")
+                release_mf_driver(driver)
+                return None
+            trace_screenshot(driver, f"login_{state}.png")
+
+            if state == "kakeibo":
+                logging.info("「手入力」ボタンをクリック")
+                driver.find_element(*MF_PAGE_STATES["kakeibo"]).click()
+                # トップ画面に遷移した場合は再度 /cf を開く
+                if detect_page_state(driver, ("top_page",)):
+                    logging.info("トップ画面が表示されました。再度指定されたURLに遷移します")
+                    driver.get("https://moneyforward.com/cf")
+                    continue
+                break
+            elif state == "email_form":
+                field = driver.find_element(*MF_PAGE_STATES["email_form"])
+                field.send_keys(EMAIL_MF)
+                logging.info(f"メールアドレスを入力: {EMAIL_MF}")
+                driver.find_element(By.ID, "submitto").click()
+                wait_for_staleness(driver, field)
+                expected = "password_form"
+            elif state == "password_form":
+                field = driver.find_element(*MF_PAGE_STATES["password_form"])
+                field.send_keys(PASSWORD)
+                logging.info("パスワードを入力")
+                driver.find_element(By.ID, "submitto").click()
+                wait_for_staleness(driver, field)
+                passwords_sent += 1
+                expected = "logged_in" if passwords_sent == 1 else "kakeibo"
+            elif state == "account_chooser":
+                logging.info("アカウント選択画面が表示されました")
+                button = driver.find_element(By.XPATH, MF_ACCOUNT_BUTTON_XPATH)
+                button.click()
+                wait_for_staleness(driver, button)
+                expected = "password_form"
+            else:
+                # ログイン後のページまたはトップ画面から家計簿に遷移
+                logging.info("指定されたURLに遷移中")
+                driver.get("https://moneyforward.com/cf")
+                expected = "kakeibo"
+    except WebDriverException as e:
+        logging.error(f"ログイン中の操作に失敗しました: {e}")
+        save_screenshot(driver, "login_error.png")
+        release_mf_driver(driver)
+        return None
 
-        logging.info("パスワード入力中")
-        # パスワードを入力してログインボタンをクリック
-        password_input = driver.find_element(By.NAME, "mfid_user[password]")
-        password_input.send_keys(PASSWORD)
-        logging.info("パスワードを入力")
-        login_button = driver.find_element(By.ID, "submitto")
-        login_button.click()
+    save_mf_session(driver)
+    return driver
 
-        logging.info("ログイン後のページを待機中")
-        try:
-            WebDriverWait(driver, 30).until(
-                EC.presence_of_element_located((By.XPATH, "//div[contains(@class, 'container-large')]"))
-            )
-            save_screenshot(driver, "after_login.png")
-        except TimeoutException:
-            logging.info("ページの読み込みが完了しませんでしたが、処理を続行します")
-            save_screenshot(driver, "after_login_timeout.png")
-
-        # 指定されたURLに遷移
-        logging.info("指定されたURLに遷移中")
-        driver.get("https://moneyforward.com/cf")
-
-        logging.info("パスワード入力中")
-        # パスワードを入力してログインボタンをクリック
-        try:
-            password_input = WebDriverWait(driver, 30).until(
-                EC.presence_of_element_located((By.NAME, "mfid_user[password]"))
-            )
-            password_input.send_keys(PASSWORD)
-            logging.info("パスワードを再入力")
-            login_button = driver.find_element(By.ID, "submitto")
-            login_button.click()
-        except TimeoutException:
-            logging.error("パスワード入力要素が見つかりませんでした")
-            save_screenshot(driver, "password_input_not_found.png")
-            # アカウント選択画面が表示されているか確認
-            try:
-                account_selection = driver.find_element(By.XPATH, "/html/body/main/div/div/div[2]/div/section/h1")
-                if account_selection and account_selection.text == "アカウントを選択する":
-                    logging.info("アカウント選択画面が表示されました")
-                    save_screenshot(driver, "account_selection.png")
-                    account_button = driver.find_element(By.XPATH,
-                                                         "/html/body/main/div/div/div[2]/div/section/div/div/form/button")
-                    account_button.click()
-                    try:
-                        WebDriverWait(driver, 30).until(
-                            EC.presence_of_element_located((By.NAME, "mfid_user[password]"))
-                        )
-                        password_input = driver.find_element(By.NAME, "mfid_user[password]")
-                        password_input.send_keys(PASSWORD)
-                        logging.info("パスワードを再入力")
-                        login_button = driver.find_element(By.ID, "submitto")
-                        login_button.click()
-                        WebDriverWait(driver, 30).until(
-                            EC.presence_of_element_located((By.XPATH, "//div[contains(@class, 'container-large')]"))
-                        )
-                        save_screenshot(driver, "after_account_selection.png")
-                    except TimeoutException:
-                        logging.info("アカウント選択後のパスワード入力要素が見つかりませんでしたが、処理を続行します")
-                        save_screenshot(driver, "account_password_input_not_found.png")
-                        driver.get("https://moneyforward.com/cf")
-            except NoSuchElementException:
-                logging.error("アカウント選択画面も表示されていませんでした")
-                return
 
-        logging.info("「手入力」ボタンを待機中")
-        try:
-            WebDriverWait(driver, 30).until(
-                EC.presence_of_element_located((By.XPATH, "//*[@id='kakeibo']/section/div[1]/div[1]/div/button"))
-            )
-            save_screenshot(driver, "before_button_click.png")
-
-            logging.info("「手入力」ボタンをクリック")
-            button = driver.find_element(By.XPATH, "//*[@id='kakeibo']/section/div[1]/div[1]/div/button")
-            button.click()
-        except TimeoutException:
-            logging.info("「手入力」ボタンが見つかりませんでしたが、処理を続行します")
-            save_screenshot(driver, "button_not_found.png")
-        except NoSuchElementException:
-            logging.info("「手入力」ボタンが見つかりませんでしたが、処理を続行します")
-            save_screenshot(driver, "button_not_found.png")
-            try:
-                account_selection = driver.find_element(By.XPATH, "/html/body/main/div/div/div[2]/div/section/h1")
-                if account_selection and account_selection.text == "アカウントを選択する":
-                    logging.info("アカウント選択画面が表示されました")
-                    save_screenshot(driver, "account_selection.png")
-                    account_button = driver.find_element(By.XPATH,
-                                                         "/html/body/main/div/div/div[2]/div/section/div/div/form/button")
-                    account_button.click()
-                    WebDriverWait(driver, 30).until(
-                        EC.presence_of_element_located((By.NAME, "mfid_user[password]"))
-                    )
-                    password_input = driver.find_element(By.NAME, "mfid_user[password]")
-                    password_input.send_keys(PASSWORD)
-                    logging.info("パスワードを再入力")
-                    login_button = driver.find_element(By.ID, "submitto")
-                    login_button.click()
-                    WebDriverWait(driver, 30).until(
-                        EC.presence_of_element_located((By.XPATH, "//div[contains(@class, 'container-large')]"))
-                    )
-                    save_screenshot(driver, "after_account_selection.png")
-            except Exception as e:
-                logging.error(f"アカウント選択後の操作に失敗しました: {e}")
-                save_screenshot(driver, "account_selection_error.png")
-        except Exception as e:
-            logging.error(f"手入力ボタンのクリックに失敗しました: {e}")
-            save_screenshot(driver, "button_click_error.png")
+def click_text(driver, text: str, timeout: float = MF_WAIT_TIMEOUT) -> None:
+    """表示テキスト (またはvalue) がtextのボタン・リンクがクリックできるようになるまで待ってクリックする"""
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.ui import WebDriverWait
 
-        # トップ画面に遷移した場合の処理
-        try:
-            top_page_indicator = driver.find_element(By.XPATH, "//*[@id='cf-manual-entry']/h2")
-            if (top_page_indicator and top_page_indicator.text == "カンタン入力"):
-                logging.info("トップ画面が表示されました。再度指定されたURLに遷移します")
-                save_screenshot(driver, "top_page_detected.png")
-                driver.get("https://moneyforward.com/cf")
-                WebDriverWait(driver, 30).until(
-                    EC.presence_of_element_located((By.XPATH, "//*[@id='kakeibo']/section/div[1]/div[1]/div/button"))
-                )
-                save_screenshot(driver, "before_button_click_after_redirect.png")
-                button = driver.find_element(By.XPATH, "//*[@id='kakeibo']/section/div[1]/div[1]/div/button")
-                button.click()
-        except NoSuchElementException:
-            logging.info("トップ画面ではありません。処理を続行します")
-        except TimeoutException:
-            logging.info("指定されたURLに遷移後、ボタンが見つかりませんでしたが、処理を続行します")
-            save_screenshot(driver, "button_not_found_after_redirect.png")
-
-    except TimeoutException as e:
-        logging.error(f"ログインプロセスがタイムアウトしました: {e}")
-        save_screenshot(driver, "timeout_error.png")
-        return
+    xpath = (f"//*[self::button or self::a or self::input or self::label]"
+             f"[normalize-space()='{text}' or @value='{text}']")
+    WebDriverWait(driver, timeout, poll_frequency=MF_WAIT_POLL).until(
+        EC.element_to_be_clickable((By.XPATH, xpath))
+    ).click()
 
-    helium.set_driver(driver)
+
+def read_manual_entry_form(driver) -> Optional["ManualEntryForm"]:
+    """ブラウザで開いている /cf のHTMLから手入力フォームの選択肢 (カテゴリーのID) を読み取る"""
+    try:
+        form_parser = ManualEntryFormParser()
+        form_parser.feed(driver.page_source)
+    except Exception as e:
+        logging.warning(f"Manual entry form not read: {e}")
+        return None
+    if not form_parser.form.large_categories:
+        logging.warning("Categories not found on /cf, selecting them from the dropdown")
+        return None
+    logging.info(f"Categories read: {len(form_parser.form.middle_categories)}")
+    return form_parser.form
+
+
+SET_CATEGORY_SCRIPT = """
+var large = document.getElementsByName("user_asset_act[large_category_id]")[0];
+var middle = document.getElementsByName("user_asset_act[middle_category_id]")[0];
+if (!large || !middle) { return false; }
+large.value = arguments[0];
+middle.value = arguments[1];
+var selected = [[document.getElementById("js-large-category-selected"), arguments[2]],
+                [document.getElementById("js-middle-category-selected"), arguments[3]]];
+for (var i = 0; i < selected.length; i++) {
+  if (selected[i][0]) { selected[i][0].textContent = selected[i][1]; }
+}
+return true;
+"""
+
+
+def set_category_ids(driver, form: Optional["ManualEntryForm"], large: str, middle: str) -> bool:
+    """読み取り済みのIDでカテゴリーの隠しフィールドを直接設定する。IDがわからなければFalse"""
+    if form is None:
+        return False
+    large_id = form.large_categories.get(large)
+    middle_id = form.middle_categories.get((large, middle))
+    if large_id is None or middle_id is None:
+        return False
+    return bool(driver.execute_script(SET_CATEGORY_SCRIPT, large_id, middle_id, large, middle))
 
 
-def add_mf_record(dt: datetime, amount: int, store: str, store_info: Optional[dict]):
+def add_mf_record(driver, dt: datetime, amount: int, store: str, store_info: Optional[dict],
+                  form: Optional["ManualEntryForm"] = None):
     """
     add record to moneyfoward
+    form (read_manual_entry_form の結果) があればカテゴリーはドロップダウンを開かずIDで設定する
     """
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import Select
+
+    diagnostics.next_record(f"{dt:%Y%m%d}_{amount}")
+    steps = metrics.steps("mf.add")
     try:
-        driver = helium.get_driver()
         # 「手入力」ボタンをクリック
-        helium.click("手入力")
+        click_text(driver, "手入力")
         logging.info(f"手入力をクリック")
-        save_screenshot(helium.get_driver(), "clicked_manual_input.png")
+        steps.mark("click_manual_input")
+        trace_screenshot(driver, "clicked_manual_input.png")
 
         # 日付を入力
         date_input = driver.find_element(By.NAME, "user_asset_act[updated_at]")
         date_input.clear()
         date_input.send_keys(f"{dt:%Y/%m/%d}")
         logging.info("日付を入力")
-        save_screenshot(driver, "added_date_input.png")
+        steps.mark("input_date")
+        trace_screenshot(driver, "added_date_input.png")
 
         # カレンダーポップアップを閉じるために指定された要素をクリック
         popup_closer = driver.find_element(By.XPATH, "//*[@id=\"important\"]/label")
         popup_closer.click()
         logging.info(f"カレンダーポップアップを閉じるために指定された要素をクリック")
-        save_screenshot(driver, "closed_calendar_popup.png")
+        steps.mark("close_calendar")
+        trace_screenshot(driver, "closed_calendar_popup.png")
 
         # 支出金額を入力
-        helium.write(amount, into="支出金額")
+        amount_input = driver.find_element(By.NAME, "user_asset_act[amount]")
+        amount_input.clear()
+        amount_input.send_keys(str(amount))
         logging.info(f"支出金額を入力")
-        save_screenshot(helium.get_driver(), "added_expense_amount_input.png")
+        steps.mark("input_amount")
+        trace_screenshot(driver, "added_expense_amount_input.png")
 
         # ANA Payの選択
         payment_select = driver.find_element(By.ID, "user_asset_act_sub_account_id_hash")
@@ -473,17 +2400,20 @@ def add_mf_record(dt: datetime, amount: int, store: str, store_info: Optional[di
             if option.text.startswith("ANA Pay"):
                 select.select_by_visible_text(option.text)
                 break
+        steps.mark("select_payment")
 
-        if store_info:
+        if store_info and set_category_ids(driver, form, store_info["大項目"], store_info["中項目"]):
+            trace_screenshot(driver, "selected_category.png")
+        elif store_info:
             # カテゴリー選択
             l_category = driver.find_element(By.CSS_SELECTOR, "#js-large-category-selected")
             l_category.click()
-            save_screenshot(driver, "cliked_large_category.png")
+            trace_screenshot(driver, "cliked_large_category.png")
 
             l_category_option = driver.find_element(By.XPATH,
                                                     f"//a[@class='l_c_name' and text()='{store_info['大項目']}']")
             l_category_option.click()
-            save_screenshot(driver, "selected_large_category.png")
+            trace_screenshot(driver, "selected_large_category.png")
 
             m_category = driver.find_element(By.CSS_SELECTOR, "#js-middle-category-selected")
             m_category.click()
@@ -491,6 +2421,7 @@ def add_mf_record(dt: datetime, amount: int, store: str, store_info: Optional[di
                                                     f"//a[@class='m_c_name' and text()='{store_info['中項目']}']")
             m_category_option.click()
 
+        if store_info:
             # 店名を入力
             store_name = store_info.get("店名") or store
             content_input = driver.find_element(By.NAME, "user_asset_act[content]")
@@ -500,81 +2431,920 @@ def add_mf_record(dt: datetime, amount: int, store: str, store_info: Optional[di
             content_input = driver.find_element(By.NAME, "user_asset_act[content]")
             content_input.clear()
             content_input.send_keys(store)
+        steps.mark("input_category_content")
 
         # 保存ボタンをクリック
-        helium.click("保存する")
+        click_text(driver, "保存する")
         logging.info(f"Record added to moneyforward: {dt:%Y/%m/%d}, {amount}, {store}")
-
-        # 「続けて入力する」ボタンを待機してクリック
-        helium.wait_until(helium.Button("続けて入力する").exists)
-        helium.click("続けて入力する")
+        steps.mark("save")
+
+        # 「続けて入力する」ボタンかエラーのどちらかが表示されるまで待つ
+        state = wait_for_page_state(driver, ("entry_saved", "entry_error"), timeout=MF_SAVE_TIMEOUT,
+                                    expected="entry_saved")
+        if state != "entry_saved":
+            raise TimeoutException(f"保存後の画面: {state or 'timeout'}")
+        driver.find_element(*MF_PAGE_STATES["entry_saved"]).click()
+        steps.mark("continue")
         return True
     except Exception as e:
         logging.error(f"Error adding record to moneyforward: {e}")
-        save_screenshot(helium.get_driver(), "add_record_error.png")
+        save_screenshot(driver, "add_record_error.png")
         return False
 
 
-def spreadsheet2mf(worksheet, store_dict: dict[str, dict[str, str]]) -> None:
-    """スプレッドシートからmoneyfowardに書き込む"""
+class SeleniumBackend:
+    """Seleniumで手入力フォームを操作してマネーフォワードに登録する (1インスタンスにつきブラウザ1つ)"""
+
+    def __init__(self, debug_port: int = 9222):
+        self.debug_port = debug_port
+        self.driver = None
+        self.form = None  # カテゴリーのID (ログインごとに1回読み取る)
+        self.records = 0
+
+    def login(self) -> bool:
+        self.driver = login_mf(self.debug_port)
+        if self.driver is None:
+            return False
+        self.form = read_manual_entry_form(self.driver)
+        return True
+
+    def submit(self, dt: datetime, amount: int, store: str, store_info: Optional[dict]) -> bool:
+        if self.driver is None:
+            logging.error("Not logged in to moneyforward")
+            return False
+        success = add_mf_record(self.driver, dt, amount, store, store_info, self.form)
+        if success:
+            self.records += 1
+        return success
+
+    def close(self) -> None:
+        if self.driver is not None:
+            if getattr(self.driver, "anapay2mf_attached", False):
+                add_browser_records(self.records)
+            release_mf_driver(self.driver)
+            self.driver = None
+            self.records = 0
+        diagnostics.close()
+
 
-    records = worksheet.get_all_records()
+@dataclass
+class ManualEntryForm:
+    """/cf の手入力フォームから読み取った送信先と選択肢"""
+    action: str = ""
+    csrf_token: str = ""
+    hidden: dict[str, str] = field(default_factory=dict)
+    sub_accounts: dict[str, str] = field(default_factory=dict)  # 表示名 -> sub_account_id_hash
+    large_categories: dict[str, str] = field(default_factory=dict)  # 大項目 -> id
+    middle_categories: dict[tuple[str, str], str] = field(default_factory=dict)  # (大項目, 中項目) -> id
+
+    def ana_pay_account(self) -> Optional[str]:
+        for text, value in self.sub_accounts.items():
+            if text.startswith("ANA Pay"):
+                return value
+        return None
+
+
+class ManualEntryFormParser(HTMLParser):
+    """/cf のHTMLから手入力フォーム (user_asset_act[updated_at] を含むform) を読み取る"""
+
+    def __init__(self):
+        super().__init__()
+        self.form = ManualEntryForm()
+        self._form_action = None
+        self._form_hidden = {}
+        self._in_sub_account = False
+        self._option_value = None
+        self._category = None  # ("l_c_name" or "m_c_name", id)
+        self._large = None
+        self._text = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "meta" and attrs.get("name") == "csrf-token":
+            self.form.csrf_token = attrs.get("content", "")
+        elif tag == "form":
+            self._form_action = attrs.get("action", "")
+            self._form_hidden = {}
+        elif tag == "input" and self._form_action is not None:
+            if attrs.get("type") == "hidden" and attrs.get("name"):
+                self._form_hidden[attrs["name"]] = attrs.get("value", "")
+            if attrs.get("name") == "user_asset_act[updated_at]":
+                self.form.action = self._form_action
+        elif tag == "select" and attrs.get("name") == "user_asset_act[sub_account_id_hash]":
+            self._in_sub_account = True
+        elif tag == "option" and self._in_sub_account:
+            self._option_value = attrs.get("value", "")
+            self._text = []
+        elif tag == "a" and attrs.get("class") in ("l_c_name", "m_c_name"):
+            self._category = (attrs["class"], attrs.get("id", ""))
+            self._text = []
+
+    def handle_data(self, data):
+        if self._option_value is not None or self._category is not None:
+            self._text.append(data)
+
+    def handle_endtag(self, tag):
+        if tag == "form" and self._form_action is not None:
+            if self.form.action == self._form_action:
+                self.form.hidden = self._form_hidden
+            self._form_action = None
+        elif tag == "select":
+            self._in_sub_account = False
+        elif tag == "option" and self._option_value is not None:
+            self.form.sub_accounts["".join(self._text).strip()] = self._option_value
+            self._option_value = None
+        elif tag == "a" and self._category is not None:
+            kind, category_id = self._category
+            name = "".join(self._text).strip()
+            if kind == "l_c_name":
+                self._large = name
+                self.form.large_categories[name] = category_id
+            else:
+                self.form.middle_categories[(self._large, name)] = category_id
+            self._category = None
+
+
+class HTTPFormBackend:
+    """
+    ブラウザでログインしたセッションのCookieとCSRFトークンを使い、
+    手入力フォームをHTTPで直接POSTしてマネーフォワードに登録する
+    POSTできなかったレコードはfallback (Selenium) で登録する
+    """
+
+    def __init__(self, session: Optional[requests.Session] = None, base_url: str = MF_BASE_URL,
+                 fallback: Optional[SeleniumBackend] = None):
+        self.session = session or requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.base_url = base_url.rstrip("/")
+        self.fallback = fallback
+        self.form: Optional[ManualEntryForm] = None
+
+    def login(self) -> bool:
+        """fallbackのブラウザでログインし、そのCookieをHTTPセッションに引き継ぐ"""
+        if self.fallback is None or not self.fallback.login():
+            return False
+        self.use_driver_session(self.fallback.driver)
+        if not self.load_form():
+            logging.warning("Manual entry form not loaded, submitting with selenium only")
+        return True
+
+    def use_driver_session(self, driver) -> None:
+        for cookie in driver.get_cookies():
+            self.session.cookies.set(cookie["name"], cookie["value"],
+                                     domain=cookie.get("domain"), path=cookie.get("path", "/"))
+        self.session.headers["User-Agent"] = driver.execute_script("return navigator.userAgent")
+
+    def load_form(self) -> bool:
+        """/cf を読み込んで手入力フォームの送信先・CSRFトークン・選択肢を取得する"""
+        try:
+            response = self.session.get(f"{self.base_url}/cf", timeout=30)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            logging.error(f"Error loading manual entry form: {e}")
+            return False
+        form_parser = ManualEntryFormParser()
+        form_parser.feed(response.text)
+        form = form_parser.form
+        if not form.action or not form.csrf_token:
+            logging.error("Manual entry form not found on /cf")
+            return False
+        self.form = form
+        return True
+
+    def form_data(self, dt: datetime, amount: int, store: str, store_info: Optional[dict]) -> Optional[dict]:
+        """POSTするフォームの値を作る。必要な選択肢が見つからなければNone"""
+        data = dict(self.form.hidden)
+        data.setdefault("authenticity_token", self.form.csrf_token)
+        data["user_asset_act[updated_at]"] = f"{dt:%Y/%m/%d}"
+        data["user_asset_act[amount]"] = str(amount)
+        data["user_asset_act[content]"] = store
+        account = self.form.ana_pay_account()
+        if account is None:
+            logging.error("ANA Pay is not in the sub account options")
+            return None
+        data["user_asset_act[sub_account_id_hash]"] = account
+        if store_info:
+            large = self.form.large_categories.get(store_info["大項目"])
+            middle = self.form.middle_categories.get((store_info["大項目"], store_info["中項目"]))
+            if large is None or middle is None:
+                logging.error(f"Category not found: {store_info['大項目']} / {store_info['中項目']}")
+                return None
+            data["user_asset_act[large_category_id]"] = large
+            data["user_asset_act[middle_category_id]"] = middle
+            data["user_asset_act[content]"] = store_info.get("店名") or store
+        return data
+
+    def post(self, data: dict) -> bool:
+        try:
+            response = self.session.post(
+                f"{self.base_url}{self.form.action}", data=data, timeout=30, allow_redirects=False,
+                headers={"X-CSRF-Token": self.form.csrf_token, "X-Requested-With": "XMLHttpRequest"})
+        except requests.RequestException as e:
+            logging.error(f"Error posting manual entry form: {e}")
+            return False
+        # ログイン切れの場合はサインインページへのリダイレクトが返る
+        if response.status_code != 200:
+            logging.error(f"Manual entry form returned {response.status_code}")
+            return False
+        # 入力エラーでも200が返るため、保存後の画面 (「続けて入力する」) が返ったときだけ成功とする
+        if MF_ENTRY_SAVED_TEXT.encode() not in response.content:
+            logging.error(f"Manual entry form was not saved: {response.content[:200].decode(errors='replace')!r}")
+            return False
+        return True
+
+    def submit(self, dt: datetime, amount: int, store: str, store_info: Optional[dict]) -> bool:
+        data = self.form_data(dt, amount, store, store_info) if self.form else None
+        if data is not None and self.post(data):
+            logging.info(f"Record added to moneyforward: {dt:%Y/%m/%d}, {amount}, {store}")
+            return True
+        if self.fallback is None:
+            return False
+        logging.info("Falling back to selenium")
+        return self.fallback.submit(dt, amount, store, store_info)
+
+    def close(self) -> None:
+        self.session.close()
+        if self.fallback is not None:
+            self.fallback.close()
+
+
+def normalize_store(name: str) -> str:
+    """店名の表記ゆれ (全角/半角、大文字/小文字、空白) をそろえる"""
+    return re.sub(r"\s+", "", unicodedata.normalize("NFKC", name)).casefold()
+
+
+class StoreMatcher:
+    """
+    ANAPayStore シートのルールで店名からカテゴリーを引く
+    store 列は完全一致 (表記ゆれは normalize_store でそろえる) のほか、末尾が * なら前方一致、
+    /.../ で囲めば正規表現として扱う。完全一致、長い前方一致、シートの上の正規表現の順に優先する
+    結果は店名ごとに覚えておく
+    """
+
+    def __init__(self, records: list[dict]):
+        self.exact: dict[str, dict] = {}
+        self.prefixes: list[tuple[str, dict]] = []
+        self.patterns: list[tuple[re.Pattern, dict]] = []
+        self.cache: dict[str, Optional[dict]] = {}
+        for record in records:
+            rule = str(record.get("store", "")).strip()
+            if len(rule) > 2 and rule.startswith("/") and rule.endswith("/"):
+                try:
+                    self.patterns.append((re.compile(unicodedata.normalize("NFKC", rule[1:-1]), re.IGNORECASE), record))
+                except re.error as e:
+                    logging.warning(f"Invalid store pattern {rule}: {e}")
+            elif rule.endswith("*") and len(rule) > 1:
+                self.prefixes.append((normalize_store(rule[:-1]), record))
+            elif rule:
+                self.exact.setdefault(normalize_store(rule), record)
+        self.prefixes.sort(key=lambda item: len(item[0]), reverse=True)
+
+    def get(self, store: str) -> Optional[dict]:
+        if store not in self.cache:
+            self.cache[store] = self._match(store)
+        return self.cache[store]
+
+    def _match(self, store: str) -> Optional[dict]:
+        key = normalize_store(store)
+        if key in self.exact:
+            return self.exact[key]
+        for prefix, record in self.prefixes:
+            if key.startswith(prefix):
+                return record
+        text = unicodedata.normalize("NFKC", store)
+        for pattern, record in self.patterns:
+            if pattern.search(text):
+                return record
+        return None
+
+
+def load_store_matcher(store_sheet) -> StoreMatcher:
+    with metrics.span("sheets.get_stores"):
+        return StoreMatcher(sheets_limiter.call(store_sheet.get_all_records))
+
+
+def create_mf_backend(name: str = MF_BACKEND, debug_port: int = 9222):
+    """MF_BACKEND に応じた登録方法を返す"""
+    if name == "http":
+        return HTTPFormBackend(fallback=SeleniumBackend(debug_port))
+    if name != "selenium":
+        logging.warning(f"Unknown MF_BACKEND: {name}, using selenium")
+    return SeleniumBackend(debug_port)
+
+
+def login_mf_backends(concurrency: int) -> list:
+    """
+    ログイン済みの登録方法を最大 concurrency 個返す
+    1つ目のログインでセッションを保存し、2つ目以降はそのセッションを引き継いでログインする
+    """
+    backends = []
+    for i in range(max(1, concurrency)):
+        backend = create_mf_backend(debug_port=MF_DEBUG_PORT + i)
+        with metrics.span("mf.login"):
+            logged_in = backend.login()
+        if not logged_in:
+            logging.error(f"Login to moneyforward failed (session {i + 1}/{concurrency})")
+            backend.close()
+            break
+        backends.append(backend)
+    return backends
+
+
+def resolve_in_doubt_mf(ledger: Ledger, policy: str = MF_IN_DOUBT) -> None:
+    """
+    前回の実行が登録中に止まり、マネーフォワードに保存できたかわからない記録を扱う
+    hold: そのまま残して登録しない (二重登録を避ける)、retry: もう一度登録する、done: 登録済みとみなす
+    """
+    records = ledger.in_doubt_mf()
+    if not records:
+        return
+    for record in records:
+        logging.error("Submission interrupted at %s: %s %s %s円 (attempts: %d)", record["updated_at"],
+                      record["date_of_use"], record["store"], record["amount"], record["attempts"])
+        if policy == "retry":
+            ledger.mark_mf_failed(record["message_id"])
+        elif policy == "done":
+            ledger.mark_mf_done(record["message_id"])
+    metrics.count("mf_in_doubt", len(records))
+    if policy == "hold":
+        logging.error("Check these records on moneyforward and rerun with MF_IN_DOUBT=done or MF_IN_DOUBT=retry")
+
+
+def spreadsheet2mf(worksheet, stores: StoreMatcher, ledger: Ledger,
+                   backends: Optional[list] = None) -> None:
+    """
+    台帳の未登録分をmoneyfowardに書き込み、スプレッドシートの "mf" 列に反映する
+    登録の前後に台帳へ意図と結果を書き込むので、途中で止まっても次回は続きから登録する
+    ログイン済みの backends を渡した場合はそれを使い、閉じない
+    """
+
+    resolve_in_doubt_mf(ledger)
+    records = ledger.pending_mf()
 
     # すべてmoneyforwardに登録済みならなにもしない
-    if all(record["mf"] == "done" for record in records):
+    if not records:
         logging.error(f"Done. all records are finished")
         return
 
-    login_mf()  # login to moneyfoward
+    # login to moneyfoward (レコード数より多くは開かない)
+    owned = backends is None
+    if owned:
+        backends = login_mf_backends(min(MF_CONCURRENCY, len(records)))
+    if not backends:
+        return
+
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    def submit(backend, record) -> bool:
+        date_of_use = parse_iso_datetime(record["date_of_use"])
+        store = record["store"]
+        with metrics.span("mf.submit"):
+            return backend.submit(date_of_use, int(record["amount"]), store, stores.get(store))
+
+    # 登録はワーカースレッド、スプレッドシートへの反映は書き込みスレッドで行い、
+    # 台帳への書き込み (SQLite) はすべてこのスレッドで行う
     added = 0
-    for count, record in enumerate(records):
-        if record["mf"] != "done":
-            date_of_use = parser.parse(record["date_of_use"])
-            amount = int(record["amount"])
-            store = record["store"]
-            success = add_mf_record(date_of_use, amount, store, store_dict.get(store))
-            logging.info(f"add_mf_record returned: {success}")
-            if success:
-                try:
+    queued = deque(records)
+    idle = list(backends)
+    running = {}
+    writer = BackgroundSheetWriter(SheetPartitions.of(worksheet))
+    try:
+        with ThreadPoolExecutor(max_workers=len(backends), thread_name_prefix="mf-submit") as executor:
+            while queued or running:
+                # 空いたブラウザに次の記録を渡す。渡す前に登録の意図を台帳にコミットする
+                while queued and idle:
+                    record = queued.popleft()
+                    backend = idle.pop()
+                    ledger.begin_mf(record["message_id"])
+                    running[executor.submit(submit, backend, record)] = (record, backend)
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    record, backend = running.pop(future)
+                    idle.append(backend)
+                    try:
+                        success = future.result()
+                    except Exception as e:
+                        logging.error(f"Error submitting record {record['message_id']}: {e}")
+                        success = False
+                    logging.info(f"add_mf_record returned: {success}")
+                    metrics.count("submitted" if success else "submit_failed")
+                    if not success:
+                        ledger.mark_mf_failed(record["message_id"])
+                        continue
+                    ledger.mark_mf_done(record["message_id"])
                     # update spread sheets for "done" message
-                    row = count + 2  # Adjust for 0-based index and header row
-                    logging.info(f"Updating cell for record {row}")
-                    worksheet.update_cell(row, 5, "done")
+                    if record["sheet_row"]:
+                        writer.mark_done(record["sheet_row"], record["sheet_name"])
                     added += 1
-                    time.sleep(1)  # Wait for 1 second to avoid rate limiting
-                except Exception as e:
-                    logging.error(f"Error updating cell for record {row}: {e}")
-    helium.kill_browser()
+    finally:
+        updated = defaultdict(list)
+        for name, row in writer.close():
+            updated[name].append(row)
+        for name, rows in updated.items():
+            ledger.mark_sheet_done(rows, name)
+        if owned:
+            for backend in backends:
+                backend.close()
 
     logging.info(f"Records added to moneyforward: {added}")
 
 
-def main():
+def process_new_mails(anapay_sheet, store_sheet, ledger: Ledger, mail, warm: list) -> None:
+    """
+    常駐時の1回分の処理 (取得・登録・レポート出力)
+    warm にはDAEMON_KEEP_BROWSER のときに次回へ残すログイン済みのブラウザが入る
+    """
+    metrics.reset()
+    diagnostics.new_run()
+    try:
+        gmail2spredsheet(anapay_sheet, ledger, mail)
+        if not ledger.pending_mf():
+            return
+        stores = load_store_matcher(store_sheet)
+        if not DAEMON_KEEP_BROWSER:
+            spreadsheet2mf(anapay_sheet, stores, ledger)
+            return
+        if not warm:
+            warm.extend(login_mf_backends(MF_CONCURRENCY))
+        spreadsheet2mf(anapay_sheet, stores, ledger, warm)
+        # 登録できなかったものがあればセッション切れの可能性があるので、次回はログインし直す
+        if ledger.pending_mf():
+            close_backends(warm)
+    finally:
+        metrics.write_report()
+
+
+def close_backends(backends: list) -> None:
+    for backend in backends:
+        backend.close()
+    backends.clear()
+
+
+def run_daemon(anapay_sheet, store_sheet, ledger: Ledger) -> None:
+    """
+    IMAPの接続を保ったままIDLEで新着メールを待ち受け、届くたびに取得・登録する
+    gspreadのクライアントは呼び出し元のものを使い回し、接続が切れたら指数バックオフで再接続する
+    想定外の例外もログに出して同じように再接続する
+    SIGTERM/SIGINTで現在の処理を終えてから終了する
+    """
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+
+    warm = []
+    backoff = 1.0
+    try:
+        while not stop.is_set():
+            mail = connect_imap("imap.gmail.com", EMAIL, EMAIL_PASSWORD)
+            if mail is None:
+                logging.error(f"IMAP connection failed, retrying in {backoff:.0f}s")
+                stop.wait(backoff)
+                backoff = min(backoff * 2, DAEMON_RECONNECT_MAX)
+                continue
+            try:
+                # 接続中に届いた分を取りこぼさないよう、接続直後に一度処理してから待ち受ける
+                process_new_mails(anapay_sheet, store_sheet, ledger, mail, warm)
+                backoff = 1.0
+                while not stop.is_set():
+                    if imap_idle(mail, stop=stop):
+                        logging.info("New mail arrived")
+                        process_new_mails(anapay_sheet, store_sheet, ledger, mail, warm)
+            except (imaplib.IMAP4.abort, imaplib.IMAP4.error, OSError, gspread.exceptions.APIError) as e:
+                logging.error(f"Connection lost: {e}, reconnecting in {backoff:.0f}s")
+                stop.wait(backoff)
+                backoff = min(backoff * 2, DAEMON_RECONNECT_MAX)
+            except Exception:
+                # 想定外のエラーでも常駐は止めない (KeyboardInterrupt などは止める)
+                # ブラウザの状態もわからないため、次回はログインし直す
+                logging.exception(f"Unexpected error, reconnecting in {backoff:.0f}s")
+                close_backends(warm)
+                stop.wait(backoff)
+                backoff = min(backoff * 2, DAEMON_RECONNECT_MAX)
+            finally:
+                try:
+                    disconnect_imap(mail)
+                except Exception as e:
+                    logging.error(f"IMAP logout exception: {e}")
+    finally:
+        close_backends(warm)
+    logging.info("Daemon stopped")
+
+
+class WarmBrowser:
+    """
+    browser コマンドで常駐させるChrome (MF_BROWSER_ADDRESS で各実行から接続して使う)
+    応答しなくなったとき、登録件数が MF_BROWSER_MAX_RECORDS に達したとき、プロセス全体のメモリが
+    MF_BROWSER_MAX_RSS_MB を超えたときに、開いているタブがなくなるのを待って起動し直す
+    """
+
+    def __init__(self, port: int = MF_DEBUG_PORT, binary: str = MF_BROWSER_BINARY,
+                 state_file: str = MF_BROWSER_STATE_FILE, busy_timeout: float = ACCOUNTS_TIMEOUT):
+        self.port = port
+        self.binary = binary
+        self.state_file = state_file
+        self.busy_timeout = busy_timeout  # タブが閉じられないまま残っていても、この秒数で起動し直す
+        self.address = f"127.0.0.1:{port}"
+        self.process = None
+        self.profile_dir = None
+        self.busy_since = None
+
+    def start(self) -> bool:
+        """Chromeを起動し、デバッグポートが応答するまで待つ"""
+        import tempfile
+
+        # プロフィール (キャッシュなど) は起動ごとに作り直す
+        self.profile_dir = tempfile.mkdtemp(prefix="anapay2mf-chrome-")
+        self.process = subprocess.Popen(
+            [self.binary, *MF_CHROME_ARGS, f"--remote-debugging-port={self.port}",
+             f"--remote-debugging-address={MF_BROWSER_LISTEN}", f"--user-data-dir={self.profile_dir}", "about:blank"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.busy_since = None
+        with open(self.state_file, "w", encoding="utf-8") as f:
+            json.dump({"pid": self.process.pid, "started_at": f"{datetime.now():%Y-%m-%d %H:%M:%S}", "records": 0}, f)
+        deadline = time.monotonic() + MF_WAIT_TIMEOUT
+        while time.monotonic() < deadline and self.process.poll() is None:
+            if browser_health(self.address, timeout=1) is not None:
+                logging.info(f"Warm browser started: pid={self.process.pid}, port={self.port}")
+                return True
+            time.sleep(MF_WAIT_POLL)
+        logging.error(f"Warm browser did not start: {self.binary}")
+        return False
+
+    def stop(self) -> None:
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+        if self.profile_dir:
+            shutil.rmtree(self.profile_dir, ignore_errors=True)
+            self.profile_dir = None
+
+    def rss(self) -> int:
+        """Chromeとその子プロセス (レンダラーなど) のRSSの合計 (バイト)"""
+        children = {}
+        rss = {}
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        for pid in filter(str.isdigit, os.listdir("/proc")):
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    stat = f.read()
+                with open(f"/proc/{pid}/statm") as f:
+                    rss[int(pid)] = int(f.read().split()[1]) * page_size
+            except OSError:
+                continue
+            # comm に空白や括弧が入ることがあるため、最後の ")" の後から読む
+            ppid = int(stat[stat.rindex(")") + 2:].split()[1])
+            children.setdefault(ppid, []).append(int(pid))
+        total = 0
+        pending = [self.process.pid]
+        while pending:
+            pid = pending.pop()
+            total += rss.get(pid, 0)
+            pending.extend(children.get(pid, []))
+        return total
+
+    def records(self) -> int:
+        try:
+            with open(self.state_file, encoding="utf-8") as f:
+                return json.load(f).get("records", 0)
+        except (OSError, ValueError):
+            return 0
+
+    def busy(self) -> bool:
+        """起動時のタブ以外に開いているタブがあれば使用中とみなす"""
+        targets = browser_health(self.address, "/json/list") or []
+        pages = [target for target in targets if isinstance(target, dict) and target.get("type") == "page"]
+        if len(pages) <= 1:
+            self.busy_since = None
+            return False
+        if self.busy_since is None:
+            self.busy_since = time.monotonic()
+        return time.monotonic() - self.busy_since < self.busy_timeout
+
+    def recycle_reason(self) -> Optional[str]:
+        if self.process is None or self.process.poll() is not None:
+            return "exited"
+        if browser_health(self.address) is None:
+            return "not responding"
+        records = self.records()
+        if MF_BROWSER_MAX_RECORDS and records >= MF_BROWSER_MAX_RECORDS:
+            return f"{records} records"
+        rss = self.rss()
+        if MF_BROWSER_MAX_RSS_MB and rss > MF_BROWSER_MAX_RSS_MB * 2 ** 20:
+            return f"{rss / 2 ** 20:.0f} MiB"
+        return None
+
+    def run(self, stop: threading.Event) -> None:
+        """stop が設定されるまでChromeを動かし続ける"""
+        self.start()
+        try:
+            while not stop.wait(MF_BROWSER_CHECK_SECONDS):
+                reason = self.recycle_reason()
+                if reason is None:
+                    continue
+                # 応答しない・終了した場合以外は、使用中のタブを閉じてから起動し直す
+                if reason not in ("exited", "not responding") and self.busy():
+                    logging.info(f"Warm browser needs recycling ({reason}), waiting until idle")
+                    continue
+                logging.info(f"Recycling warm browser: {reason}")
+                self.stop()
+                self.start()
+        finally:
+            self.stop()
+
+
+def run_warm_browser() -> None:
+    """browser コマンド: SIGTERM/SIGINTまでChromeを常駐させる"""
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+    WarmBrowser().run(stop)
+
+
+# アカウントごとに分ける環境変数 (プロフィールになければ空にして、.env の値を使わせない)
+ACCOUNT_ENV_VARS = ["SHEET_ID", "EMAIL", "EMAIL_PASSWORD", "EMAILMF", "PASSWORD"]
+# アカウントごとの状態ファイル (プロフィールで指定しなければ ACCOUNTS_DIR/<name>/ に置く)
+ACCOUNT_STATE_FILES = {
+    "LEDGER_DB": "anapay_ledger.sqlite3",
+    "IMAP_CHECKPOINT_FILE": "imap_checkpoint.json",
+    "MF_SESSION_FILE": "mf_session.json",
+    "METRICS_REPORT_FILE": "run_report.jsonl",
+    "METRICS_PROM_FILE": "anapay2mf.prom",
+    "SCREENSHOT_DIR": "screenshots",
+}
+ACCOUNT_NAME_RE = re.compile(r"[\w.-]+")
+ACCOUNT_PORT_STRIDE = 100  # ブラウザ用プールの枠ごとにずらすデバッグポートの幅 (MF_CONCURRENCYはこれ未満)
+
+
+@dataclass
+class Account:
+    """accounts コマンドで実行する1アカウント分のプロフィール"""
+    name: str
+    env: dict[str, str]
+    directory: str
+
+    @property
+    def can_submit(self) -> bool:
+        return bool(self.env.get("EMAILMF") and self.env.get("PASSWORD"))
+
+    def environ(self, extra: Optional[dict[str, str]] = None) -> dict[str, str]:
+        """子プロセスに渡す環境変数"""
+        env = dict(os.environ)
+        env.update({key: "" for key in ACCOUNT_ENV_VARS})
+        env.update(self.env)
+        env.update(extra or {})
+        return env
+
+
+def load_accounts(path: str = ACCOUNTS_FILE, directory: str = ACCOUNTS_DIR) -> list[Account]:
+    """
+    複数アカウントのプロフィールを読み込む
+    JSONの配列で、各要素は "name" と環境変数名をキーにした設定 (SHEET_ID, EMAIL など) を持つ
+    """
+    with open(path, encoding="utf-8") as f:
+        profiles = json.load(f)
+    accounts = []
+    for profile in profiles:
+        name = str(profile.get("name", ""))
+        if not ACCOUNT_NAME_RE.fullmatch(name) or any(account.name == name for account in accounts):
+            raise ValueError(f"Invalid or duplicate account name: {name!r}")
+        account_dir = os.path.join(directory, name)
+        env = {key: str(value) for key, value in profile.items() if key != "name"}
+        for key, filename in ACCOUNT_STATE_FILES.items():
+            env.setdefault(key, os.path.join(account_dir, filename))
+        accounts.append(Account(name, env, account_dir))
+    return accounts
+
+
+def kill_process_group(process: subprocess.Popen, grace: float = ACCOUNTS_KILL_GRACE) -> None:
+    """
+    start_new_session で起動した子プロセスを、その子孫 (chromedriverやChrome) ごと終了させる
+    SIGTERMを送って grace 秒まで待ち、残っているプロセスにはSIGKILLを送る
+    """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    deadline = time.monotonic() + grace
+    try:
+        process.wait(timeout=grace)
+    except subprocess.TimeoutExpired:
+        pass
+    # 子プロセスが先に終了しても、孫 (Chromeなど) が終了するまで grace 秒までは待つ
+    while time.monotonic() < deadline:
+        try:
+            os.killpg(process.pid, 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.1)
+    # 子プロセスが終了しても孫が残っていることがあるので、グループ全体に送る
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+def run_account_command(account: Account, command: str, extra_env: Optional[dict[str, str]] = None) -> bool:
+    """
+    アカウントの設定で command (ingest / submit) を別プロセスで実行し、成功したらTrueを返す
+    状態とモジュールの設定はプロセスごとに分かれ、出力はアカウントのディレクトリのログに追記する
+    """
+    os.makedirs(account.directory, exist_ok=True)
+    start = time.perf_counter()
+    with open(os.path.join(account.directory, "anapay2mf.log"), "a", encoding="utf-8") as log:
+        # 子プロセスが起動したchromedriverやChromeもまとめて終了できるよう、別のプロセスグループで起動する
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), command],
+                                   env=account.environ(extra_env), stdout=log, stderr=subprocess.STDOUT,
+                                   start_new_session=True)
+        try:
+            returncode = process.wait(timeout=ACCOUNTS_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logging.error("[%s] %s timed out after %.0fs", account.name, command, ACCOUNTS_TIMEOUT)
+            kill_process_group(process)
+            return False
+        except BaseException:
+            kill_process_group(process)
+            raise
+    metrics.observe(f"accounts.{command}", time.perf_counter() - start)
+    if returncode:
+        logging.error("[%s] %s failed (exit code %d)", account.name, command, returncode)
+        return False
+    logging.info("[%s] %s finished in %.1fs", account.name, command, time.perf_counter() - start)
+    return True
+
+
+def account_has_pending(account: Account) -> bool:
+    """アカウントの台帳にマネーフォワード未登録の記録があるか"""
+    path = account.env["LEDGER_DB"]
+    if not os.path.exists(path):
+        return False
+    ledger = Ledger(path)
+    try:
+        return bool(ledger.pending_mf())
+    finally:
+        ledger.close()
+
+
+def run_accounts_once(accounts: list[Account]) -> dict[str, str]:
+    """
+    全アカウントの ingest を共有のスレッドプールで並行して実行し、取り込みが終わったアカウントのうち
+    未登録分があるものだけ submit をブラウザ用のプール (ACCOUNTS_BROWSER_WORKERS) に回す
+    アカウントごとの結果を返す。1つのアカウントの失敗はほかのアカウントに影響しない
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    results = {}
+    # ブラウザ用のプールの枠ごとにChromeのデバッグポートを分ける
+    slots = queue.Queue()
+    for slot in range(max(1, ACCOUNTS_BROWSER_WORKERS)):
+        slots.put(slot)
+    # 常駐ブラウザ (MF_BROWSER_ADDRESS) はCookieを全タブで共有し、接続時に消すため、
+    # 同じ常駐ブラウザを使うアカウントの submit は1つずつ実行する
+    addresses = {account.environ().get("MF_BROWSER_ADDRESS", "") for account in accounts}
+    browser_locks = {address: threading.Lock() for address in addresses if address}
+
+    def submit(account: Account) -> None:
+        with browser_locks.get(account.environ().get("MF_BROWSER_ADDRESS", ""), nullcontext()):
+            _submit(account)
+
+    def _submit(account: Account) -> None:
+        slot = slots.get()
+        try:
+            port = MF_DEBUG_PORT + slot * ACCOUNT_PORT_STRIDE
+            success = run_account_command(account, "submit", {"MF_DEBUG_PORT": str(port)})
+            results[account.name] = "submitted" if success else "submit_failed"
+        except Exception as e:
+            logging.error(f"[{account.name}] Error running submit: {e}")
+            results[account.name] = "submit_failed"
+        finally:
+            slots.put(slot)
+
+    def ingest(account: Account) -> None:
+        try:
+            if not run_account_command(account, "ingest"):
+                results[account.name] = "ingest_failed"
+                return
+            results[account.name] = "ingested"
+            if account.can_submit and account_has_pending(account):
+                browser_pool.submit(submit, account)
+        except Exception as e:
+            logging.error(f"[{account.name}] Error running ingest: {e}")
+            results[account.name] = "ingest_failed"
+
+    # 取り込み用のプールを先に閉じ (すべての ingest が submit を登録し終えてから)、次にブラウザ用を閉じる
+    with ThreadPoolExecutor(max_workers=max(1, ACCOUNTS_BROWSER_WORKERS), thread_name_prefix="account-submit") \
+            as browser_pool, \
+            ThreadPoolExecutor(max_workers=max(1, ACCOUNTS_INGEST_WORKERS), thread_name_prefix="account-ingest") \
+            as ingest_pool:
+        for account in accounts:
+            ingest_pool.submit(ingest, account)
+    for status in results.values():
+        metrics.count(f"accounts_{status}")
+    return results
+
+
+def run_accounts(accounts: list[Account], interval: float = ACCOUNTS_INTERVAL) -> None:
+    """
+    全アカウントを run_accounts_once で実行する。interval が正ならその間隔で繰り返す
+    SIGTERM/SIGINTで実行中の分を終えてから終了する
+    """
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+
+    while True:
+        metrics.reset()
+        try:
+            results = run_accounts_once(accounts)
+            logging.info("Accounts: %s", ", ".join(f"{name}={status}" for name, status in sorted(results.items())))
+        finally:
+            metrics.write_report()
+        if interval <= 0 or stop.wait(interval):
+            return
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    arg_parser = argparse.ArgumentParser(description="ANA Payの利用通知メールをマネーフォワードに登録する")
+    subparsers = arg_parser.add_subparsers(dest="command")
+    subparsers.add_parser("ingest", help="メールを取得して台帳とスプレッドシートに追加する (ブラウザは使わない)")
+    subparsers.add_parser("submit", help="台帳の未登録分をマネーフォワードに登録する")
+    subparsers.add_parser("run", help="ingest と submit を続けて行う (デフォルト、DAEMON=1 なら常駐する)")
+    backfill_parser = subparsers.add_parser("backfill", help="エクスポートしたメール (mbox / Maildir / .eml) から取り込む")
+    backfill_parser.add_argument("paths", nargs="+", help="mboxファイル、Maildir、.emlファイルまたはそのディレクトリ")
+    subparsers.add_parser("browser", help="ChromeをMF_DEBUG_PORTで常駐させる (MF_BROWSER_ADDRESS で接続して使う)")
+    accounts_parser = subparsers.add_parser("accounts", help="複数アカウントの ingest と submit をアカウントごとのプロセスで実行する")
+    accounts_parser.add_argument("--file", default=ACCOUNTS_FILE, help="アカウントのプロフィール (JSON)")
+    accounts_parser.add_argument("--interval", type=float, default=ACCOUNTS_INTERVAL,
+                                 help="繰り返す間隔 (秒、0なら1回だけ実行する)")
+    args = arg_parser.parse_args(argv)
+    args.command = args.command or "run"
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    command = args.command
+    check_env(command)
     try:
         # ログ設定
         logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
+        if command == "accounts":
+            run_accounts(load_accounts(args.file), args.interval)
+            return
+        if command == "browser":
+            run_warm_browser()
+            return
+
         # gspread クライアントの初期化
         creds = Credentials.from_service_account_file(GOOGLE_APPLICATION_CREDENTIALS, scopes=SCOPES)
         gc = gspread.authorize(creds)
 
-        sheet = gc.open_by_key(SHEET_ID)
-        anapay_sheet = sheet.worksheet("ANAPay")
-        store_sheet = sheet.worksheet("ANAPayStore")
-        store_dict = {store["store"]: store for store in store_sheet.get_all_records()}
+        sheet = sheets_limiter.call(gc.open_by_key, SHEET_ID)
+        # 分けたシートの一覧はこのプロセスで1回だけ取得する
+        anapay_sheet = SheetPartitions(sheets_limiter.call(sheet.worksheet, "ANAPay"))
 
-        # データの処理
-        gmail2spredsheet(anapay_sheet)
-        spreadsheet2mf(anapay_sheet, store_dict)
+        # データの処理 (台帳が正、スプレッドシートはミラー)
+        ledger = Ledger()
+        if command == "run" and DAEMON:
+            try:
+                run_daemon(anapay_sheet, sheets_limiter.call(sheet.worksheet, "ANAPayStore"), ledger)
+            finally:
+                ledger.close()
+                diagnostics.close()
+            return
+
+        try:
+            if command == "backfill":
+                backfill(anapay_sheet, ledger, args.paths)
+            if command in ("ingest", "run"):
+                gmail2spredsheet(anapay_sheet, ledger)
+            if command in ("submit", "run"):
+                stores = load_store_matcher(sheets_limiter.call(sheet.worksheet, "ANAPayStore"))
+                spreadsheet2mf(anapay_sheet, stores, ledger)
+        finally:
+            ledger.close()
+            diagnostics.close()
+            metrics.write_report()
 
     except gspread.exceptions.SpreadsheetNotFound as e:
         logging.error(f'Spreadsheet not found: {e}')
-    except HttpError as error:
+        return 1
+    except gspread.exceptions.APIError as error:
         logging.error(f'An error occurred with Google Sheets API: {error}')
+        return 1
     except Exception as e:
         logging.error(f'An unexpected error occurred: {e}')
         traceback.print_exc()  # 詳細なスタックトレースを表示する
+        return 1
 
 
 if __name__ == "__main__":
-    main()
+    # accounts コマンドは子プロセスの終了コードで成否を判定する
+    sys.exit(main())
@@ -0,0 +1,76 @@
+"""
+accounts コマンドでタイムアウトした処理の後始末を確かめるベンチマーク
+
+run_account_command が起動する子プロセスを、孫プロセス (chromedriverやChromeの代わり) を
+起動して止まるスクリプトに差し替える。孫の1つはSIGTERMを無視する。タイムアウト後に
+子と孫がすべて終了していることを確認し、制限時間を超えてから片付くまでの秒数を表示する。
+
+    python benchmarks/bench_account_timeout.py --grandchildren 3 --timeout 1 --grace 1
+"""
+import argparse
+import os
+import tempfile
+import textwrap
+import time
+
+import anapay2mf
+
+CHILD = textwrap.dedent("""
+    import os, signal, subprocess, sys, time
+    pids = []
+    for i in range(int(os.environ["GRANDCHILDREN"])):
+        # 最初の孫はSIGTERMを無視し、SIGKILLでしか終了しない
+        code = "import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); time.sleep(600)" if i == 0 \\
+            else "import time; time.sleep(600)"
+        pids.append(subprocess.Popen([sys.executable, "-c", code]).pid)
+    with open(os.environ["PID_FILE"], "w") as f:
+        f.write(" ".join(map(str, [os.getpid()] + pids)))
+    time.sleep(600)
+""")
+
+
+def alive(pid: int) -> bool:
+    """pidのプロセスが動いているか (ゾンビは終了したものとみなす)"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--grandchildren", type=int, default=3)
+    arg_parser.add_argument("--timeout", type=float, default=1.0)
+    arg_parser.add_argument("--grace", type=float, default=1.0)
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        script = os.path.join(tmp, "child.py")
+        with open(script, "w") as f:
+            f.write(CHILD)
+        pid_file = os.path.join(tmp, "pids")
+        anapay2mf.__file__ = script
+        anapay2mf.ACCOUNTS_TIMEOUT = args.timeout
+        anapay2mf.kill_process_group.__defaults__ = (args.grace,)
+        account = anapay2mf.Account("bench", {"GRANDCHILDREN": str(args.grandchildren), "PID_FILE": pid_file},
+                                    os.path.join(tmp, "bench"))
+
+        start = time.perf_counter()
+        assert not anapay2mf.run_account_command(account, "submit"), "timed-out command reported success"
+        elapsed = time.perf_counter() - start
+        with open(pid_file) as f:
+            pids = [int(pid) for pid in f.read().split()]
+        deadline = time.monotonic() + 5
+        while any(alive(pid) for pid in pids) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        survivors = [pid for pid in pids if alive(pid)]
+        for pid in survivors:
+            os.kill(pid, 9)
+        assert not survivors, f"processes left running after timeout: {survivors}"
+    print(f"child + {args.grandchildren} grandchildren terminated; "
+          f"cleanup took {elapsed - args.timeout:.2f}s after the {args.timeout:.0f}s timeout")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+取り込みからマネーフォワード登録までを通しで測るベンチマーク
+
+ローカルのスタンドイン (IMAPサーバー、gspread.Worksheet、マネーフォワードのサインイン画面と /cf)
+に対して gmail2spredsheet と spreadsheet2mf をそのまま実行し、規模ごとにステージ別の
+処理件数/秒、API呼び出し回数、ピークRSSを表示する。RSSを規模ごとに分けるため、
+各規模は別のプロセスで実行する。マネーフォワードへの登録は MF_BACKEND=http の経路を使う。
+--partition year/month で、利用日時の年/月ごとのシートに分けた場合を測る。
+
+    python benchmarks/bench_end_to_end.py --records 10 100 1000 10000 --sheet-latency-ms 100
+"""
+import argparse
+import imaplib
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+import synthetic
+import anapay2mf
+from bench_pipeline import FakeWorksheet
+from imap_standin import IMAPStandIn
+from mf_standin import MoneyForwardStandIn
+
+STORE_RECORDS = [
+    {"store": "セブン-イレブン*", "大項目": "食費", "中項目": "食料品", "店名": "セブンイレブン"},
+    {"store": "ローソン", "大項目": "食費", "中項目": "食料品", "店名": ""},
+    {"store": "/^スター?バックス/", "大項目": "食費", "中項目": "カフェ", "店名": ""},
+]
+
+
+class StandInBrowser:
+    """
+    HTTPFormBackend の fallback (SeleniumBackend) の代わり
+    ブラウザを起動せず、スタンドインのサインイン画面にHTTPでログインしてCookieを渡す
+    """
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.session = requests.Session()
+        self.driver = self  # HTTPFormBackend は fallback.driver からCookieを読む
+
+    def login(self) -> bool:
+        self.session.get(f"{self.base_url}/sign_in")
+        self.session.post(f"{self.base_url}/sign_in", data={"mfid_user[email]": "bench@example.com"})
+        response = self.session.post(f"{self.base_url}/sign_in", data={
+            "mfid_user[email]": "bench@example.com", "mfid_user[password]": "benchmark"})
+        return response.ok and response.url.endswith("/cf")
+
+    def get_cookies(self) -> list[dict]:
+        return [{"name": cookie.name, "value": cookie.value, "domain": cookie.domain, "path": cookie.path}
+                for cookie in self.session.cookies]
+
+    def execute_script(self, script: str) -> str:
+        return "anapay2mf-benchmark"
+
+    def submit(self, dt, amount, store, store_info) -> bool:
+        return False
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class RSSSampler:
+    """バックグラウンドでRSSを読み、mark() までの区間のピークを返す"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+        self.peak = self.rss()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def rss(self) -> int:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * self.page_size
+
+    def _loop(self):
+        while not self.stop.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def mark(self) -> int:
+        peak, self.peak = max(self.peak, self.rss()), self.rss()
+        return peak
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+
+def snapshot(imap: IMAPStandIn, worksheets: list[FakeWorksheet], mf: MoneyForwardStandIn) -> dict:
+    sheets = {}
+    for worksheet in worksheets:
+        for method, count in worksheet.api_calls.items():
+            sheets[method] = sheets.get(method, 0) + count
+    return {"imap": dict(imap.commands), "sheets": sheets, "mf": dict(mf.requests)}
+
+
+def diff(after: dict, before: dict) -> dict:
+    return {kind: {name: count - before[kind].get(name, 0) for name, count in counts.items()
+                   if count - before[kind].get(name, 0)}
+            for kind, counts in after.items()}
+
+
+def run(records: int, imap_latency: float, sheet_latency: float, mf_latency: float, concurrency: int,
+        sheets_rpm: float, partition: str = "") -> dict:
+    """1つの規模を実行し、ステージごとの結果を返す"""
+    messages = synthetic.make_corpus(records)
+    imap = IMAPStandIn(messages, imap_latency).start()
+    mf = MoneyForwardStandIn(mf_latency).start()
+    worksheet = FakeWorksheet(sheet_latency)
+    sheets = anapay2mf.SheetPartitions(worksheet, partition)
+    store_sheet = FakeWorksheet(sheet_latency, STORE_RECORDS)
+
+    anapay2mf.imaplib.IMAP4_SSL = lambda host: imaplib.IMAP4("127.0.0.1", imap.port)
+    anapay2mf.EMAIL, anapay2mf.EMAIL_PASSWORD, anapay2mf.MAILBOX = "bench@example.com", "benchmark", "INBOX"
+    anapay2mf.MF_CONCURRENCY = concurrency
+    anapay2mf.sheets_limiter = anapay2mf.SheetsRateLimiter(per_minute=sheets_rpm)
+    anapay2mf.create_mf_backend = lambda name=None, debug_port=None: anapay2mf.HTTPFormBackend(
+        base_url=mf.base_url, fallback=StandInBrowser(mf.base_url))
+
+    stages = {}
+    sampler = RSSSampler()
+    with tempfile.TemporaryDirectory() as tmp:
+        anapay2mf.load_checkpoint.__defaults__ = (os.path.join(tmp, "checkpoint.json"),)
+        anapay2mf.save_checkpoint.__defaults__ = (os.path.join(tmp, "checkpoint.json"),)
+        ledger = anapay2mf.Ledger(os.path.join(tmp, "ledger.sqlite3"))
+        try:
+            for stage in ("ingest", "submit"):
+                before = snapshot(imap, worksheet.spreadsheet.worksheets_ + [store_sheet], mf)
+                start = time.perf_counter()
+                if stage == "ingest":
+                    anapay2mf.gmail2spredsheet(sheets, ledger)
+                else:
+                    stores = anapay2mf.load_store_matcher(store_sheet)
+                    anapay2mf.spreadsheet2mf(sheets, stores, ledger)
+                elapsed = time.perf_counter() - start
+                stages[stage] = {"seconds": elapsed, "records_per_s": records / elapsed,
+                                 "peak_rss": sampler.mark(),
+                                 "calls": diff(snapshot(imap, worksheet.spreadsheet.worksheets_ + [store_sheet], mf),
+                                               before)}
+            written = sum(len(sheet.rows) for sheet in worksheet.spreadsheet.worksheets_)
+            assert written == records, "not every record was written to the sheet"
+            assert not ledger.unsynced(), "sheet left out of sync with the ledger"
+            assert len(mf.records) == records, "not every record was submitted"
+            assert not ledger.pending_mf(), "records left pending"
+            assert len(imap.seen) == records, "not every message was marked as read"
+        finally:
+            ledger.close()
+            sampler.close()
+            imap.stop()
+            mf.stop()
+    return stages
+
+
+def format_calls(calls: dict) -> str:
+    parts = []
+    for kind, counts in calls.items():
+        if counts:
+            parts.append(kind + "(" + ", ".join(f"{name}={count}" for name, count in sorted(counts.items())) + ")")
+    return " ".join(parts)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--records", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    arg_parser.add_argument("--imap-latency-ms", type=float, default=20.0)
+    arg_parser.add_argument("--sheet-latency-ms", type=float, default=100.0)
+    arg_parser.add_argument("--mf-latency-ms", type=float, default=5.0)
+    arg_parser.add_argument("--concurrency", type=int, default=1)
+    arg_parser.add_argument("--sheets-rpm", type=float, default=0,
+                            help="Sheets APIの1分あたりの上限 (0なら制限しない)")
+    arg_parser.add_argument("--partition", choices=["", "year", "month"], default="",
+                            help="利用日時の年/月ごとのシートに分ける (SHEET_PARTITION)")
+    arg_parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.child:
+        logging.basicConfig(level=logging.WARNING)
+        stages = run(args.records[0], args.imap_latency_ms / 1000, args.sheet_latency_ms / 1000,
+                     args.mf_latency_ms / 1000, args.concurrency, args.sheets_rpm, args.partition)
+        print(json.dumps(stages))
+        return
+
+    print(f"{'records':>8} {'stage':>7} {'seconds':>9} {'records/s':>10} {'peak MiB':>9}  API calls")
+    for records in args.records:
+        command = [sys.executable, __file__, "--child", "--records", str(records),
+                   "--imap-latency-ms", str(args.imap_latency_ms), "--sheet-latency-ms", str(args.sheet_latency_ms),
+                   "--mf-latency-ms", str(args.mf_latency_ms), "--concurrency", str(args.concurrency),
+                   "--sheets-rpm", str(args.sheets_rpm), "--partition", args.partition]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        for stage, result in json.loads(output.splitlines()[-1]).items():
+            print(f"{records:>8} {stage:>7} {result['seconds']:>9.2f} {result['records_per_s']:>10.0f} "
+                  f"{result['peak_rss'] / 2 ** 20:>9.1f}  {format_calls(result['calls'])}")
+
+
+if __name__ == "__main__":
+    main()
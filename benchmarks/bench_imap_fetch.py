@@ -0,0 +1,125 @@
+"""
+get_anapay_info のFETCHラウンドトリップ数を比較するベンチマーク
+
+ローカルのIMAPスタンドインに合成メールを置き、1件ずつのFETCH (batch_size=1) と
+メッセージセットによる一括FETCHを比較する。最後にUIDチェックポイント付きで再実行し、
+新着がなければ本文を1件も取得しないことを確認する。
+
+    python benchmarks/bench_imap_fetch.py --messages 2000 --latency-ms 20
+"""
+import argparse
+import re
+import time
+
+import synthetic
+import anapay2mf
+from imap_standin import fetch_items
+
+
+class FakeIMAP4:
+    """imaplib.IMAP4_SSL の必要最小限のスタンドイン (ラウンドトリップごとに遅延を入れる)"""
+
+    def __init__(self, messages: list[bytes], latency: float):
+        self.messages = messages
+        self.latency = latency
+        self.round_trips = 0
+        self.bytes_sent = 0
+
+    def _round_trip(self):
+        self.round_trips += 1
+        time.sleep(self.latency)
+
+    def login(self, username, password):
+        self._round_trip()
+        return "OK", [b"LOGIN completed"]
+
+    def select(self, mailbox=None):
+        self._round_trip()
+        return "OK", [str(len(self.messages)).encode()]
+
+    def response(self, code):
+        if code == "UIDVALIDITY":
+            return code, [b"1"]
+        return code, [None]
+
+    def uid(self, command, *args):
+        if command == "SEARCH":
+            return self.search(*args)
+        if command == "FETCH":
+            return self.fetch(*args)
+        if command == "STORE":
+            self._round_trip()
+            message_set = args[0].decode() if isinstance(args[0], bytes) else args[0]
+            return "OK", [f"{uid} (UID {uid} FLAGS (\\Seen))".encode() for uid in message_set.split(",")]
+        raise NotImplementedError(command)
+
+    def search(self, charset, *criteria):
+        # UIDはシーケンス番号と同じ (1始まり) とし、"UID n:*" だけを解釈する
+        self._round_trip()
+        match = re.search(r"UID (\d+):\*", " ".join(criteria))
+        start = int(match.group(1)) if match else 1
+        uids = range(min(start, len(self.messages)), len(self.messages) + 1)
+        return "OK", [b" ".join(str(i).encode() for i in uids)]
+
+    def fetch(self, message_set, message_parts):
+        self._round_trip()
+        if isinstance(message_set, bytes):
+            message_set = message_set.decode()
+        data = []
+        for uid in message_set.split(","):
+            # imaplib と同じく、リテラルごとに (前置き, 中身) のタプルにする
+            prefix = f"{uid} (UID {uid}"
+            for name, value in fetch_items(self.messages[int(uid) - 1], message_parts):
+                if isinstance(value, bytes):
+                    data.append((f"{prefix} {name} {{{len(value)}}}".encode(), value))
+                    self.bytes_sent += len(value)
+                    prefix = ""
+                else:
+                    prefix += f" {name} {value}"
+            data.append((prefix + ")").encode())
+        return "OK", data
+
+    def close(self):
+        self._round_trip()
+
+    def logout(self):
+        self._round_trip()
+
+
+def run(messages: list[bytes], latency: float, batch_size: int, checkpoint=None):
+    server = FakeIMAP4(messages, latency)
+    anapay2mf.imaplib.IMAP4_SSL = lambda host: server
+    start = time.perf_counter()
+    result = anapay2mf.get_anapay_info("imap.example.com", "user", "pass", "20-Mar-2024",
+                                       batch_size=batch_size, checkpoint=checkpoint)
+    elapsed = time.perf_counter() - start
+    return result, elapsed, server
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--messages", type=int, default=1000)
+    arg_parser.add_argument("--latency-ms", type=float, default=10.0)
+    arg_parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 50, 100, 500])
+    args = arg_parser.parse_args()
+
+    messages = synthetic.make_corpus(args.messages)
+    baseline = None
+    print(f"{'batch':>6} {'round-trips':>12} {'seconds':>9} {'msgs/s':>9}")
+    for batch_size in args.batch_sizes:
+        result, elapsed, server = run(messages, args.latency_ms / 1000, batch_size)
+        if baseline is None:
+            baseline = result
+        assert result == baseline, "batched fetch returned a different ANAPay list"
+        print(f"{batch_size:>6} {server.round_trips:>12} {elapsed:>9.2f} {len(result) / elapsed:>9.0f}")
+
+    # チェックポイント付きで2回実行し、2回目 (新着なし) で本文を1件も取得しないことを確認する
+    checkpoint = anapay2mf.IMAPCheckpoint()
+    run(messages, args.latency_ms / 1000, args.batch_sizes[-1], checkpoint)
+    result, elapsed, server = run(messages, args.latency_ms / 1000, args.batch_sizes[-1], checkpoint)
+    assert result == [] and server.bytes_sent == 0, "steady-state run fetched message bodies"
+    print(f"incremental re-run: {server.round_trips} round-trips, {server.bytes_sent} bytes, {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
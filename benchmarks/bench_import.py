@@ -0,0 +1,62 @@
+"""
+起動時間 (anapay2mf のインポート) を比較するベンチマーク
+
+毎回新しいPythonプロセスで anapay2mf を読み込み、ingest だけのとき (seleniumを読み込まない) と、
+submit と同じくseleniumまで読み込んだとき (以前はインポート時に常にこうなっていた) の時間を比べる。
+
+    python benchmarks/bench_import.py --runs 10
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+SNIPPET = """
+import sys, time
+start = time.perf_counter()
+import anapay2mf
+{extra}
+print(time.perf_counter() - start, "selenium" in sys.modules)
+"""
+
+# login_mf / add_mf_record が関数内で読み込むモジュール
+SELENIUM_IMPORTS = """
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chrome.service import Service as ChromeService
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import Select, WebDriverWait
+"""
+
+
+def measure(extra: str, runs: int) -> tuple[list[float], bool]:
+    code = SNIPPET.format(extra=extra)
+    times = []
+    loaded = False
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True,
+                             capture_output=True, text=True).stdout.split()
+        times.append(float(out[0]))
+        loaded = out[1] == "True"
+    return times, loaded
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--runs", type=int, default=10)
+    args = arg_parser.parse_args()
+
+    ingest, ingest_selenium = measure("", args.runs)
+    submit, submit_selenium = measure(SELENIUM_IMPORTS, args.runs)
+    print(f"ingest (lazy):          median {statistics.median(ingest) * 1000:7.1f} ms  selenium loaded: {ingest_selenium}")
+    print(f"submit / eager imports: median {statistics.median(submit) * 1000:7.1f} ms  selenium loaded: {submit_selenium}")
+    print(f"saved per ingest run:   {(statistics.median(submit) - statistics.median(ingest)) * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
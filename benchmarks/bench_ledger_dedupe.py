@@ -0,0 +1,74 @@
+"""
+Message-IDのない通知を台帳に追加するときの重複判定を確かめるベンチマーク
+
+同じ秒に同じ金額・店舗で2回利用した通知 (Message-IDなし、受信日時だけが違う) を含む
+通知を Ledger.add で追加し、2件とも別の記録になること、同じ通知を取得し直しても
+増えないこと (同じバッチ・別のバッチのどちらでも) を確認して、追加にかかった時間を表示する。
+
+    python benchmarks/bench_ledger_dedupe.py --notices 5000 --batch 100
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import anapay2mf
+
+
+def notices(n: int) -> list[anapay2mf.ANAPay]:
+    """n件の通知。10件ごとに、直前の通知と同じ秒・金額・店舗の通知を1件入れる"""
+    start = datetime(2024, 4, 1, 9)
+    result = []
+    for i in range(n):
+        if i % 10 == 9:
+            previous = result[-1]
+            result.append(anapay2mf.ANAPay(email_date=previous.email_date + timedelta(seconds=1),
+                                           date_of_use=previous.date_of_use, amount=previous.amount,
+                                           store=previous.store, email_id=str(i)))
+        else:
+            used_at = start + timedelta(minutes=i)
+            result.append(anapay2mf.ANAPay(email_date=used_at, date_of_use=used_at, amount=100 + i % 7,
+                                           store=f"STORE {i % 13}", email_id=str(i)))
+    return result
+
+
+def add(ledger: anapay2mf.Ledger, records: list[anapay2mf.ANAPay], batch: int) -> list[anapay2mf.ANAPay]:
+    added = []
+    for chunk in anapay2mf.batched(records, batch):
+        added.extend(ledger.add(chunk))
+    return added
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--notices", type=int, default=5000)
+    arg_parser.add_argument("--batch", type=int, default=100)
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ledger = anapay2mf.Ledger(os.path.join(tmp, "ledger.sqlite3"))
+        records = notices(args.notices)
+
+        # 同じバッチに同じ内容の通知が2件
+        pair = records[8:10]
+        added = ledger.add(pair)
+        assert len(added) == 2, f"identical notices without Message-ID merged: {len(added)} added"
+        assert len({anapay2mf.Ledger.key(ana_pay) for ana_pay in added}) == 2, "identical notices share a key"
+        assert not ledger.add(notices(args.notices)[8:10]), "re-fetched notices were added again"
+
+        start = time.perf_counter()
+        added = add(ledger, records, args.batch)
+        elapsed = time.perf_counter() - start
+        assert len(added) == args.notices - 2, f"{len(added)} of {args.notices - 2} new notices added"
+        assert len(ledger) == args.notices
+        # 取得し直した通知 (バッチの区切りが変わっても) は重複として無視する
+        assert not add(ledger, notices(args.notices), args.batch + 7), "re-fetched notices were added again"
+        assert len(ledger) == args.notices
+        ledger.close()
+    print(f"{args.notices} notices ({args.notices // 10} same-second pairs) added in {elapsed:.2f}s "
+          f"({args.notices / elapsed:.0f}/s); re-fetch added nothing")
+
+
+if __name__ == "__main__":
+    main()
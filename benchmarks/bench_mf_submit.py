@@ -0,0 +1,59 @@
+"""
+HTTPフォーム送信によるマネーフォワード登録のベンチマーク
+
+ローカルの /cf スタンドインに対して HTTPFormBackend で記録を登録し、
+送信されたフォームの内容と1件あたりの時間を確認する。
+
+    python benchmarks/bench_mf_submit.py --records 500 --latency-ms 50
+"""
+import argparse
+import time
+from datetime import timedelta
+
+import requests
+
+import synthetic
+import anapay2mf
+from mf_standin import MoneyForwardStandIn, SESSION_COOKIE, SESSION_ID
+
+STORE_DICT = {
+    "セブン-イレブン": {"store": "セブン-イレブン", "大項目": "食費", "中項目": "食料品", "店名": "セブンイレブン"},
+    "スターバックス": {"store": "スターバックス", "大項目": "食費", "中項目": "カフェ", "店名": ""},
+}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--records", type=int, default=200)
+    arg_parser.add_argument("--latency-ms", type=float, default=50.0)
+    args = arg_parser.parse_args()
+
+    server = MoneyForwardStandIn(args.latency_ms / 1000).start()
+    try:
+        session = requests.Session()
+        session.cookies.set(SESSION_COOKIE, SESSION_ID)
+        backend = anapay2mf.HTTPFormBackend(session, base_url=server.base_url)
+        assert backend.load_form(), "manual entry form not found"
+
+        start = time.perf_counter()
+        for i in range(args.records):
+            store = synthetic.STORES[i % len(synthetic.STORES)]
+            dt = synthetic.BASE_DATE + timedelta(minutes=17 * i)
+            assert backend.submit(dt, 100 + i, store, STORE_DICT.get(store)), f"record {i} failed"
+        elapsed = time.perf_counter() - start
+        backend.close()
+
+        assert len(server.records) == args.records
+        first = server.records[0]
+        assert first["user_asset_act[sub_account_id_hash]"] == "anapay0001"
+        assert first["user_asset_act[large_category_id]"] == "11"
+        assert first["user_asset_act[middle_category_id]"] == "41"
+        assert first["user_asset_act[content]"] == "セブンイレブン"
+        assert first["user_asset_act[updated_at]"] == f"{synthetic.BASE_DATE:%Y/%m/%d}"
+        print(f"{args.records} records in {elapsed:.2f}s ({elapsed / args.records * 1000:.1f} ms/record)")
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
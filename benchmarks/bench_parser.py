@@ -0,0 +1,98 @@
+"""
+ANA Pay通知の解析を比較するベンチマーク
+
+合成した通知のDateヘッダー・Message-ID・本文に対して、ヘッダーのリストを作って
+dateutilで解析する以前の get_mail_info (このファイルに残した写し) と、固定書式の parse_anapay_notice を比較する。
+
+    python benchmarks/bench_parser.py --messages 5000
+"""
+import argparse
+import email
+import time
+
+from dateutil import parser
+
+import synthetic
+import anapay2mf
+
+
+def get_mail_info(msg, email_id) -> anapay2mf.ANAPay:
+    """
+    以前の解析 (比較用に残した写し): ヘッダーのリストを1件ずつ見て、dateutilで日時を解析する
+    """
+    ana_pay = anapay2mf.ANAPay(email_id=email_id)
+    for header in msg["headers"]:
+        if header["name"] == "Date":
+            date_str = header["value"].replace(" +0900 (JST)", "")
+            ana_pay.email_date = parser.parse(date_str)
+        elif header["name"].lower() == "message-id":
+            ana_pay.message_id = header["value"].strip()
+
+    # 本文から日時、金額、店舗を取り出す
+    body = msg["body"]
+    for line in body.splitlines():
+        if line.startswith("ご利用"):
+            key, value = line.split("：")
+            if key == "ご利用日時":
+                ana_pay.date_of_use = parser.parse(value)
+            elif key == "ご利用金額":
+                ana_pay.amount = int(value.replace(",", "").replace("円", ""))
+            elif key == "ご利用店舗":
+                ana_pay.store = value
+    return ana_pay
+
+
+def extract(raw: bytes):
+    """RFC822から (Dateヘッダー, Message-ID, 全ヘッダー, 本文) を取り出す"""
+    msg = email.message_from_bytes(raw)
+    for part in msg.walk():
+        if part.get_content_type() == "text/plain":
+            body = part.get_payload(decode=True).decode(part.get_content_charset())
+            return msg["Date"], msg["Message-ID"], msg.items(), body
+
+
+def current_path(notices):
+    result = []
+    for i, (_, _, items, body) in enumerate(notices):
+        email_data = {
+            "headers": [{"name": k, "value": v} for k, v in items],
+            "body": body,
+        }
+        result.append(get_mail_info(email_data, i))
+    return result
+
+
+def fast_path(notices):
+    return [anapay2mf.parse_anapay_notice(date_value, message_id, body, i)
+            for i, (date_value, message_id, _, body) in enumerate(notices)]
+
+
+def timed(func, notices, repeat: int):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(notices)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--messages", type=int, default=5000)
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    args = arg_parser.parse_args()
+
+    notices = [extract(raw) for raw in synthetic.make_corpus(args.messages)]
+    baseline, baseline_elapsed = timed(current_path, notices, args.repeat)
+    result, elapsed = timed(fast_path, notices, args.repeat)
+    assert result == baseline, "fast-path parser returned a different ANAPay list"
+
+    print(f"{'parser':>14} {'seconds':>9} {'notices/s':>10}")
+    print(f"{'get_mail_info':>14} {baseline_elapsed:>9.3f} {len(notices) / baseline_elapsed:>10.0f}")
+    print(f"{'fast path':>14} {elapsed:>9.3f} {len(notices) / elapsed:>10.0f}")
+    print(f"speedup: {baseline_elapsed / elapsed:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+IMAPの部分取得 (IMAP_FETCH_MODE=partial) とRFC822全体の取得 (full) を比較するベンチマーク
+
+ローカルのIMAPスタンドインに合成メールを置き、iter_anapay_info をそれぞれのモードで実行して
+1通あたりの転送バイト数 (FETCHの応答、実行レポートの imap_bytes) と、1通を取得・解析する間に
+確保したメモリのピーク (tracemalloc) を表示する。--image-kb でHTML側にインライン画像を付けると、
+部分取得で転送しない分の差が大きくなる。スタンドインは別プロセスで動かす。
+
+    python benchmarks/bench_partial_fetch.py --messages 1000 --image-kb 0 20
+"""
+import argparse
+import imaplib
+import multiprocessing
+import time
+import tracemalloc
+
+import synthetic
+import anapay2mf
+from imap_standin import IMAPStandIn
+
+
+def serve(messages: list[bytes], latency: float, ports) -> None:
+    server = IMAPStandIn(messages, latency)
+    ports.put(server.port)
+    server.serve_forever()
+
+
+def start_server(messages: list[bytes], latency: float):
+    """スタンドインを別プロセスで起動する (サーバー側の確保がtracemallocに入らないように)"""
+    context = multiprocessing.get_context("fork")
+    ports = context.Queue()
+    process = context.Process(target=serve, args=(messages, latency, ports), daemon=True)
+    process.start()
+    return process, ports.get()
+
+
+def run(port: int, mode: str, samples: int) -> dict:
+    anapay2mf.IMAP_FETCH_MODE = mode
+    anapay2mf.metrics.reset()
+    mail = imaplib.IMAP4("127.0.0.1", port)
+    mail.login("bench@example.com", "benchmark")
+    mail.select("INBOX")
+    uids = anapay2mf.search_anapay_uids(mail, "20-Mar-2024")
+    start = time.perf_counter()
+    records = list(anapay2mf.iter_anapay_info(mail, uids))
+    elapsed = time.perf_counter() - start
+    transferred = anapay2mf.metrics.counters.get("imap_bytes", 0)
+
+    # 1通ずつ取得・解析したときに確保したメモリのピーク (応答の受信からMIMEの解析まで)
+    peaks = []
+    for uid in uids[:samples]:
+        tracemalloc.start()
+        list(anapay2mf.iter_anapay_info(mail, [uid], batch_size=1))
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    mail.logout()
+    return {"records": records, "seconds": elapsed, "bytes": transferred, "peak": sum(peaks) / len(peaks)}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--messages", type=int, default=1000)
+    arg_parser.add_argument("--image-kb", type=int, nargs="+", default=[0, 20])
+    arg_parser.add_argument("--latency-ms", type=float, default=0.0)
+    arg_parser.add_argument("--samples", type=int, default=50, help="メモリを測るメールの数")
+    args = arg_parser.parse_args()
+
+    print(f"{'image KiB':>9} {'mode':>8} {'seconds':>8} {'bytes/msg':>10} {'alloc KiB/msg':>14}")
+    for image_kb in args.image_kb:
+        messages = synthetic.make_corpus(args.messages, image_kb * 1024)
+        process, port = start_server(messages, args.latency_ms / 1000)
+        try:
+            baseline = None
+            for mode in ("full", "partial"):
+                result = run(port, mode, args.samples)
+                if baseline is None:
+                    baseline = result["records"]
+                assert result["records"] == baseline, "partial fetch returned a different ANAPay list"
+                n = len(result["records"])
+                print(f"{image_kb:>9} {mode:>8} {result['seconds']:>8.2f} {result['bytes'] / n:>10.0f} "
+                      f"{result['peak'] / 1024:>14.1f}")
+        finally:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+取り込み (IMAP取得 → 解析 → 台帳・スプレッドシート書き込み) の逐次実行とストリーミング実行を比較するベンチマーク
+
+IMAPとスプレッドシートのスタンドインにそれぞれ遅延を入れ、ingest_anapay_mails の
+経過時間とピークメモリ (tracemalloc) を測る。
+
+    python benchmarks/bench_pipeline.py --messages 2000 --imap-latency-ms 20 --sheet-latency-ms 200
+"""
+import argparse
+import collections
+import os
+import tempfile
+import time
+import tracemalloc
+
+import synthetic
+import anapay2mf
+from bench_imap_fetch import FakeIMAP4
+
+
+class FakeWorksheet:
+    """
+    gspread.Worksheet の読み込み・追記・一括更新のスタンドイン
+    API呼び出しごとに遅延を入れ、メソッドごとの回数を api_calls に数える
+    """
+
+    def __init__(self, latency: float, records: list[dict] = None, title: str = "ANAPay", spreadsheet=None):
+        self.latency = latency
+        self.title = title
+        self.spreadsheet = spreadsheet or FakeSpreadsheet(latency, [self])
+        self.rows = []
+        self.records = records or []
+        self.calls = 0
+        self.api_calls = collections.Counter()
+
+    def _call(self, method: str):
+        self.calls += 1
+        self.api_calls[method] += 1
+        time.sleep(self.latency)
+
+    def get_all_records(self):
+        self._call("get_all_records")
+        return list(self.records)
+
+    def append_rows(self, rows, value_input_option="RAW"):
+        self._call("append_rows")
+        start = len(self.rows) + 2
+        self.rows.extend(rows)
+        return {"updates": {"updatedRows": len(rows),
+                            "updatedRange": f"{self.title}!A{start}:E{start + len(rows) - 1}"}}
+
+    def append_row(self, values, value_input_option="RAW"):
+        # ヘッダー行 (1行目) として扱い、rows には含めない
+        self._call("append_row")
+
+    def batch_update(self, data, **kwargs):
+        self._call("batch_update")
+        return {"responses": [{"updatedRange": f"{self.title}!{d['range']}"} for d in data]}
+
+
+class FakeSpreadsheet:
+    """gspread.Spreadsheet のシート一覧・追加のスタンドイン (年/月ごとのシートに分ける場合に使う)"""
+
+    def __init__(self, latency: float, worksheets: list = None):
+        self.latency = latency
+        self.worksheets_ = worksheets or []
+
+    def worksheets(self):
+        time.sleep(self.latency)
+        return list(self.worksheets_)
+
+    def add_worksheet(self, title, rows, cols):
+        time.sleep(self.latency)
+        worksheet = FakeWorksheet(self.latency, title=title, spreadsheet=self)
+        self.worksheets_.append(worksheet)
+        return worksheet
+
+
+def run(messages: list[bytes], imap_latency: float, sheet_latency: float, streaming: bool, flush_rows: int):
+    server = FakeIMAP4(messages, imap_latency)
+    worksheet = FakeWorksheet(sheet_latency)
+    anapay2mf.INGEST_STREAMING = streaming
+    anapay2mf.sheets_limiter = anapay2mf.SheetsRateLimiter(per_minute=0)  # 遅延はスタンドインで入れる
+    anapay2mf.SheetWriteBuffer.__init__.__defaults__ = (flush_rows, 3600, None, None)
+    with tempfile.TemporaryDirectory() as tmp:
+        anapay2mf.load_checkpoint.__defaults__ = (os.path.join(tmp, "checkpoint.json"),)
+        anapay2mf.save_checkpoint.__defaults__ = (os.path.join(tmp, "checkpoint.json"),)
+        ledger = anapay2mf.Ledger(os.path.join(tmp, "ledger.sqlite3"))
+        tracemalloc.start()
+        start = time.perf_counter()
+        anapay2mf.ingest_anapay_mails(worksheet, ledger, server, "20-Mar-2024")
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        ledger.close()
+    return worksheet.rows, elapsed, peak
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--messages", type=int, default=1000)
+    arg_parser.add_argument("--imap-latency-ms", type=float, default=20.0)
+    arg_parser.add_argument("--sheet-latency-ms", type=float, default=200.0)
+    arg_parser.add_argument("--flush-rows", type=int, default=100)
+    args = arg_parser.parse_args()
+
+    messages = synthetic.make_corpus(args.messages)
+    baseline = None
+    print(f"{'mode':>10} {'seconds':>9} {'msgs/s':>9} {'peak MiB':>9}")
+    for streaming in (False, True):
+        rows, elapsed, peak = run(messages, args.imap_latency_ms / 1000, args.sheet_latency_ms / 1000,
+                                  streaming, args.flush_rows)
+        if baseline is None:
+            baseline = rows
+        assert rows == baseline, "streaming ingest wrote different rows"
+        mode = "streaming" if streaming else "sequential"
+        print(f"{mode:>10} {elapsed:>9.2f} {len(rows) / elapsed:>9.0f} {peak / 2 ** 20:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
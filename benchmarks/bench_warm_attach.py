@@ -0,0 +1,125 @@
+"""
+MF_CONCURRENCY個のブラウザを1つの常駐ブラウザ (MF_BROWSER_ADDRESS) に接続したときのベンチマーク
+
+Cookieをタブ間で共有する常駐ブラウザのスタンドインに login_mf_backends で接続し、
+後から接続したタブが先にログインしたタブをログアウトさせないこと (Cookieを消すのは
+最初の接続だけであること) を確認して、接続とログインにかかった時間を表示する。
+
+    python benchmarks/bench_warm_attach.py --concurrency 3
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import anapay2mf
+
+SESSION_COOKIE = {"name": "_moneybook_session", "value": "bench-session", "domain": "moneyforward.com", "path": "/"}
+
+
+class WarmBrowser:
+    """タブ間で共有するCookieと、Cookieを消した回数"""
+
+    def __init__(self):
+        self.cookies: dict[str, dict] = {}
+        self.clears = 0
+        self.tabs = 0
+
+
+class SwitchTo:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def new_window(self, kind):
+        self.driver.browser.tabs += 1
+
+
+class FakeDriver:
+    """常駐ブラウザに接続したChromeDriverのスタンドイン (1タブ)"""
+
+    def __init__(self, browser: WarmBrowser):
+        self.browser = browser
+        self.switch_to = SwitchTo(self)
+        self.url = ""
+        self.window_handles = ["main", "tab"]
+
+    def execute_cdp_cmd(self, command, params):
+        assert command == "Network.clearBrowserCookies"
+        self.browser.cookies.clear()
+        self.browser.clears += 1
+
+    def delete_all_cookies(self):
+        self.browser.cookies.clear()
+        self.browser.clears += 1
+
+    def get(self, url):
+        self.url = url
+
+    def add_cookie(self, cookie):
+        self.browser.cookies[cookie["name"]] = cookie
+
+    def get_cookies(self):
+        return list(self.browser.cookies.values())
+
+    def logged_in(self) -> bool:
+        return SESSION_COOKIE["name"] in self.browser.cookies
+
+    def find_elements(self, by, value):
+        # ログインしていれば /cf の「手入力」ボタンがある
+        return [value] if self.logged_in() and self.url.endswith("/cf") and \
+            value == anapay2mf.MF_PAGE_STATES["kakeibo"][1] else []
+
+    @property
+    def page_source(self):
+        return ""
+
+    def close(self):
+        self.browser.tabs -= 1
+
+    def quit(self):
+        pass
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--concurrency", type=int, default=2)
+    args = arg_parser.parse_args()
+
+    browser = WarmBrowser()
+    drivers = []
+    with tempfile.TemporaryDirectory() as tmp:
+        # 前の実行の (別のアカウントの) Cookieが残っている常駐ブラウザ
+        browser.cookies["other_account"] = {"name": "other_account", "value": "x"}
+        session_file = os.path.join(tmp, "mf_session.json")
+        with open(session_file, "w") as f:
+            json.dump([SESSION_COOKIE], f)
+
+        anapay2mf.MF_BROWSER_ADDRESS = "127.0.0.1:9222"
+        anapay2mf.EMAIL_MF, anapay2mf.PASSWORD = "bench@example.com", "benchmark"
+        anapay2mf.browser_health = lambda address, path="/json/version", timeout=3: {}
+        anapay2mf.restore_mf_session.__defaults__ = (session_file,)
+        anapay2mf.add_browser_records.__defaults__ = (os.path.join(tmp, "mf_browser.json"),)
+
+        def webdriver(options):
+            driver = FakeDriver(browser)
+            # 接続した時点で、先に接続したタブがログインしたままであること
+            assert all(d.logged_in() for d in drivers), "attaching logged out an earlier backend"
+            drivers.append(driver)
+            return driver
+
+        anapay2mf._webdriver = webdriver
+        start = time.perf_counter()
+        backends = anapay2mf.login_mf_backends(args.concurrency)
+        elapsed = time.perf_counter() - start
+        assert len(backends) == args.concurrency, "not every backend logged in"
+        assert all(driver.logged_in() for driver in drivers), "a backend was logged out"
+        assert "other_account" not in browser.cookies, "previous run's cookies were not cleared"
+        assert browser.clears == 1, f"cookies cleared {browser.clears} times"
+        anapay2mf.close_backends(backends)
+    print(f"{args.concurrency} backends attached to one warm browser in {elapsed:.2f}s; "
+          f"cookies cleared {browser.clears} time(s), all backends stayed logged in")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+IMAPのローカルスタンドインサーバー
+
+合成したメールを置いた1つのメールボックスを127.0.0.1の空きポートで公開する。
+imaplib.IMAP4 で接続でき、anapay2mf が使うコマンド (LOGIN, SELECT, UID SEARCH/FETCH/STORE,
+IDLE, CLOSE, LOGOUT) だけを実装する。FETCHは RFC822、BODYSTRUCTURE、
+BODY.PEEK[HEADER.FIELDS (...)]、BODY.PEEK[n] に対応する。UIDは1始まりの連番で、UIDVALIDITYは固定。
+コマンドごとの回数とFETCHの応答のバイト数を数える。
+"""
+import collections
+import email
+import re
+import socketserver
+import threading
+import time
+from datetime import datetime
+from email.parser import BytesHeaderParser
+from email.utils import parsedate_to_datetime
+
+UIDVALIDITY = 1
+
+
+class IMAPStandIn(socketserver.ThreadingTCPServer):
+    """latency秒の遅延をコマンドごとに入れるIMAPサーバー"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, messages: list[bytes], latency: float = 0.0):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.messages = messages
+        self.latency = latency
+        self.dates = [parsedate_to_datetime(BytesHeaderParser().parsebytes(raw)["Date"]).date()
+                      for raw in messages]
+        self.seen: set[int] = set()
+        self.parsed: dict[int, email.message.Message] = {}
+        self.commands = collections.Counter()
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self) -> "IMAPStandIn":
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def count(self, command: str) -> None:
+        with self.lock:
+            self.commands[command] += 1
+
+    def message(self, uid: int) -> email.message.Message:
+        """UIDのメールを解析したもの (BODYSTRUCTUREと部分取得に使う、一度だけ解析する)"""
+        msg = self.parsed.get(uid)
+        if msg is None:
+            msg = self.parsed[uid] = email.message_from_bytes(self.messages[uid - 1])
+        return msg
+
+    def sent(self, size: int) -> None:
+        with self.lock:
+            self.bytes_sent += size
+
+
+def parse_message_set(message_set: str, last: int) -> list[int]:
+    uids = []
+    for part in message_set.split(","):
+        if ":" in part:
+            start, end = part.split(":")
+            end = last if end == "*" else int(end)
+            uids.extend(range(int(start), end + 1))
+        else:
+            uids.append(last if part == "*" else int(part))
+    return [uid for uid in uids if 1 <= uid <= last]
+
+
+FETCH_ITEM_RE = re.compile(r"RFC822|BODYSTRUCTURE|BODY(?:\.PEEK)?\[([^\]]*)\]", re.IGNORECASE)
+
+
+def _quote(value) -> str:
+    return "NIL" if value is None else '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def body_structure(part) -> str:
+    """email.message.Message からBODYSTRUCTURE (拡張データなし) を組み立てる"""
+    if part.is_multipart():
+        children = "".join(body_structure(child) for child in part.get_payload())
+        return f"({children} {_quote(part.get_content_subtype().upper())})"
+    params = [f"{_quote(key.upper())} {_quote(value)}" for key, value in part.get_params()[1:]]
+    payload = part.get_payload()
+    fields = [_quote(part.get_content_maintype().upper()), _quote(part.get_content_subtype().upper()),
+              f"({' '.join(params)})" if params else "NIL", _quote(part.get("Content-ID")), "NIL",
+              _quote(part.get("Content-Transfer-Encoding", "7BIT").upper()), str(len(payload))]
+    if part.get_content_maintype() == "text":
+        fields.append(str(payload.count("\n")))
+    return f"({' '.join(fields)})"
+
+
+def body_section(msg, section: str) -> bytes:
+    """BODY[n.m] の中身 (転送エンコードされたままの本文) を返す"""
+    part = msg
+    for number in section.split("."):
+        if part.is_multipart():
+            part = part.get_payload()[int(number) - 1]
+    return part.get_payload().encode("ascii", "surrogateescape")
+
+
+def fetch_items(raw: bytes, items: str, msg=None) -> list[tuple[str, object]]:
+    """
+    FETCHの項目ごとに (応答の項目名, 値) を返す
+    値はリテラルで返すものがbytes、そのまま書くもの (BODYSTRUCTURE) がstr
+    msg に解析済みのメールを渡すと解析し直さない
+    """
+    results = []
+    for match in FETCH_ITEM_RE.finditer(items):
+        name = match.group().upper()
+        if name == "RFC822":
+            results.append((name, raw))
+            continue
+        if msg is None:
+            msg = email.message_from_bytes(raw)
+        if name == "BODYSTRUCTURE":
+            results.append((name, body_structure(msg)))
+            continue
+        section = match.group(1).upper()
+        if section.startswith("HEADER.FIELDS"):
+            names = set(section[section.index("(") + 1:section.rindex(")")].split())
+            header = "".join(f"{key}: {value}\r\n" for key, value in msg.items() if key.upper() in names)
+            results.append((f"BODY[{section}]", (header + "\r\n").encode()))
+        else:
+            results.append((f"BODY[{section}]", body_section(msg, section)))
+    return results
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    server: IMAPStandIn
+
+    def send(self, line: str) -> None:
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.send("* OK [CAPABILITY IMAP4rev1 IDLE] stand-in ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, rest = line.decode().rstrip("\r\n").partition(" ")
+            command, _, args = rest.partition(" ")
+            command = command.upper()
+            if command == "UID":
+                command, _, args = args.partition(" ")
+                command = f"UID {command.upper()}"
+            time.sleep(self.server.latency)
+            self.server.count(command)
+            if command == "LOGOUT":
+                self.send("* BYE stand-in logging out")
+                self.send(f"{tag} OK LOGOUT completed")
+                return
+            handler = getattr(self, "do_" + command.replace(" ", "_"), None)
+            if handler is None:
+                self.send(f"{tag} BAD unknown command {command}")
+                continue
+            handler(tag, args)
+
+    def do_CAPABILITY(self, tag, args):
+        self.send("* CAPABILITY IMAP4rev1 IDLE")
+        self.send(f"{tag} OK CAPABILITY completed")
+
+    def do_LOGIN(self, tag, args):
+        self.send(f"{tag} OK LOGIN completed")
+
+    def do_NOOP(self, tag, args):
+        self.send(f"{tag} OK NOOP completed")
+
+    def do_SELECT(self, tag, args):
+        count = len(self.server.messages)
+        self.send(f"* {count} EXISTS")
+        self.send(f"* OK [UIDVALIDITY {UIDVALIDITY}] UIDs valid")
+        self.send(f"* OK [UIDNEXT {count + 1}] Predicted next UID")
+        self.send(f"{tag} OK [READ-WRITE] SELECT completed")
+
+    do_EXAMINE = do_SELECT
+
+    def do_CLOSE(self, tag, args):
+        self.send(f"{tag} OK CLOSE completed")
+
+    def do_IDLE(self, tag, args):
+        self.send("+ idling")
+        self.rfile.readline()  # DONE
+        self.send(f"{tag} OK IDLE terminated")
+
+    def do_UID_SEARCH(self, tag, args):
+        # 差出人と件名はすべて一致するものとし、"UID n:*" と "SINCE" だけを解釈する
+        last = len(self.server.messages)
+        uids = range(1, last + 1)
+        match = re.search(r"UID (\d+):\*", args)
+        if match:
+            # "n:*" は該当がなくても最大UIDを含む
+            uids = range(min(int(match.group(1)), last), last + 1)
+        match = re.search(r"SINCE (\d{1,2}-\w{3}-\d{4})", args)
+        if match:
+            since = datetime.strptime(match.group(1), "%d-%b-%Y").date()
+            uids = [uid for uid in uids if self.server.dates[uid - 1] >= since]
+        self.send("* SEARCH " + " ".join(str(uid) for uid in uids))
+        self.send(f"{tag} OK SEARCH completed")
+
+    def do_UID_FETCH(self, tag, args):
+        message_set, _, items = args.partition(" ")
+        for uid in parse_message_set(message_set, len(self.server.messages)):
+            response = f"* {uid} FETCH (UID {uid}".encode()
+            for name, value in fetch_items(self.server.messages[uid - 1], items, self.server.message(uid)):
+                if isinstance(value, bytes):
+                    response += f" {name} {{{len(value)}}}\r\n".encode() + value
+                else:
+                    response += f" {name} {value}".encode()
+            response += b")\r\n"
+            self.wfile.write(response)
+            self.server.sent(len(response))
+        self.send(f"{tag} OK FETCH completed")
+
+    def do_UID_STORE(self, tag, args):
+        message_set, _, _ = args.partition(" ")
+        for uid in parse_message_set(message_set, len(self.server.messages)):
+            self.server.seen.add(uid)
+            self.send(f"* {uid} FETCH (UID {uid} FLAGS (\\Seen))")
+        self.send(f"{tag} OK STORE completed")
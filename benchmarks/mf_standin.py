@@ -0,0 +1,160 @@
+"""
+マネーフォワード /cf の手入力フォームを模したローカルのスタンドインサーバー
+
+GET /cf で手入力フォームを返し、POST /cf/create で受け取ったフォームを records に記録する。
+必須項目が空なら、保存せずに入力エラーを200で返す。
+Cookie (_moneybook_session) とCSRFトークンが一致しない場合はサインインページへリダイレクトする。
+GET/POST /sign_in はメールアドレス、パスワードの順に入力するサインイン画面を模し、
+パスワードまで送るとセッションのCookieを発行して /cf にリダイレクトする。
+パスごとのリクエスト数を requests に数える。
+"""
+import collections
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SESSION_COOKIE = "_moneybook_session"
+SESSION_ID = "standin-session"
+CSRF_TOKEN = "standin-csrf-token"
+
+SUB_ACCOUNTS = {"財布 (現金)": "wallet0001", "ANA Pay (ANA Pay)": "anapay0001"}
+CATEGORIES = {
+    ("11", "食費"): {"41": "食料品", "42": "外食", "43": "カフェ"},
+    ("12", "日用品"): {"51": "日用品", "52": "ドラッグストア"},
+    ("18", "その他"): {"91": "その他", "92": "未分類"},
+}
+
+SIGN_IN_PAGE = """<!DOCTYPE html>
+<html><body><main><form action="/sign_in" method="post">
+{fields}
+<button id="submitto" type="submit">ログインする</button>
+</form></main></body></html>
+"""
+
+CF_PAGE = """<!DOCTYPE html>
+<html><head><meta name="csrf-token" content="{csrf}"></head>
+<body><div id="kakeibo"><section>
+<form id="form-user-asset-act" action="/cf/create" method="post" data-remote="true">
+<input type="hidden" name="utf8" value="&#x2713;">
+<input type="hidden" name="authenticity_token" value="{csrf}">
+<input type="hidden" name="user_asset_act[is_transfer]" value="0">
+<input type="hidden" name="user_asset_act[is_income]" value="0">
+<input type="text" name="user_asset_act[updated_at]" value="">
+<input type="text" name="user_asset_act[amount]" value="">
+<select name="user_asset_act[sub_account_id_hash]">{options}</select>
+<ul class="dropdown-menu">{categories}</ul>
+<input type="text" name="user_asset_act[content]" value="">
+<input type="submit" name="commit" value="保存する">
+</form>
+</section></div></body></html>
+"""
+
+ENTRY_SAVED_JS = """$('.modal-body').html('<button class="btn">続けて入力する</button>');"""
+ENTRY_ERROR_JS = """$('.modal-body').prepend('<div class="alert alert-danger">入力内容に誤りがあります</div>');"""
+
+
+def render_cf_page() -> str:
+    options = "".join(f'<option value="{value}">{text}</option>' for text, value in SUB_ACCOUNTS.items())
+    categories = ""
+    for (large_id, large), middles in CATEGORIES.items():
+        items = "".join(f'<li><a class="m_c_name" id="{mid}" href="#">{name}</a></li>' for mid, name in middles.items())
+        categories += (f'<li class="dropdown-submenu"><a class="l_c_name" id="{large_id}" href="#">{large}</a>'
+                       f'<ul class="dropdown-menu sub">{items}</ul></li>')
+    return CF_PAGE.format(csrf=CSRF_TOKEN, options=options, categories=categories)
+
+
+class MoneyForwardStandIn(ThreadingHTTPServer):
+    """127.0.0.1の空きポートで動くスタンドイン。latency秒の遅延をリクエストごとに入れる"""
+
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.latency = latency
+        self.records: list[dict[str, str]] = []
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> "MoneyForwardStandIn":
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: MoneyForwardStandIn
+
+    def log_message(self, format, *args):
+        pass
+
+    def _logged_in(self) -> bool:
+        return f"{SESSION_COOKIE}={SESSION_ID}" in self.headers.get("Cookie", "")
+
+    def _send(self, status: int, body: str = "", content_type: str = "text/html; charset=utf-8", location=None):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        if location:
+            self.send_header("Location", location)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _count(self):
+        with self.server.lock:
+            self.server.requests[f"{self.command} {self.path}"] += 1
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        self._count()
+        if self.path == "/sign_in":
+            return self._send(200, SIGN_IN_PAGE.format(fields='<input type="email" name="mfid_user[email]" value="">'))
+        if self.path != "/cf":
+            return self._send(404)
+        if not self._logged_in():
+            return self._send(302, location="/sign_in")
+        self._send(200, render_cf_page())
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        length = int(self.headers.get("Content-Length", "0"))
+        form = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode()))
+        self._count()
+        if self.path == "/sign_in":
+            return self._sign_in(form)
+        if self.path != "/cf/create":
+            return self._send(404)
+        if not self._logged_in() or self.headers.get("X-CSRF-Token") != CSRF_TOKEN \
+                or form.get("authenticity_token") != CSRF_TOKEN:
+            return self._send(302, location="/sign_in")
+        # 入力エラーでも保存できた場合でも200で、モーダルに表示する内容をJavaScriptで返す
+        required = ("user_asset_act[updated_at]", "user_asset_act[amount]", "user_asset_act[sub_account_id_hash]")
+        if any(not form.get(name) for name in required):
+            return self._send(200, ENTRY_ERROR_JS, "text/javascript; charset=utf-8")
+        with self.server.lock:
+            self.server.records.append(form)
+        self._send(200, ENTRY_SAVED_JS, "text/javascript; charset=utf-8")
+
+    def _sign_in(self, form: dict[str, str]):
+        email = form.get("mfid_user[email]", "")
+        if not email:
+            return self._send(302, location="/sign_in")
+        if not form.get("mfid_user[password]"):
+            fields = (f'<input type="hidden" name="mfid_user[email]" value="{email}">'
+                      '<input type="password" name="mfid_user[password]" value="">')
+            return self._send(200, SIGN_IN_PAGE.format(fields=fields))
+        self.send_response(302)
+        self.send_header("Set-Cookie", f"{SESSION_COOKIE}={SESSION_ID}; Path=/; HttpOnly")
+        self.send_header("Location", "/cf")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
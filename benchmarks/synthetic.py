@@ -0,0 +1,51 @@
+"""ベンチマーク用の合成ANA Pay通知メールと共通ヘルパー"""
+import os
+import sys
+from datetime import datetime, timedelta
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import format_datetime, make_msgid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+STORES = ["セブン-イレブン", "ローソン", "ファミリーマート", "ANA FESTA", "スターバックス"]
+BASE_DATE = datetime(2024, 3, 20, 9, 0, 0)
+
+
+def make_anapay_mail(i: int, image_size: int = 0) -> bytes:
+    """
+    i番目の合成ANA Pay利用通知 (multipart/alternative) を返す
+    image_size を指定するとHTML側にそのバイト数のインライン画像 (multipart/related) を付ける
+    """
+    used_at = BASE_DATE + timedelta(minutes=17 * i)
+    sent_at = used_at + timedelta(seconds=30)
+    body = (
+        "ANA Payをご利用いただきありがとうございます。\n"
+        "\n"
+        f"ご利用日時：{used_at:%Y-%m-%d %H:%M:%S}\n"
+        f"ご利用金額：{(i * 37) % 20000 + 100:,}円\n"
+        f"ご利用店舗：{STORES[i % len(STORES)]}\n"
+    )
+    msg = MIMEMultipart("alternative")
+    msg["Subject"] = "［ANA Pay］ご利用のお知らせ"
+    msg["From"] = "payinfo@121.ana.co.jp"
+    msg["To"] = "user@example.com"
+    msg["Date"] = format_datetime(sent_at).replace("-0000", "+0900") + " (JST)"
+    msg["Message-ID"] = make_msgid(idstring=f"anapay{i}", domain="121.ana.co.jp")
+    msg.attach(MIMEText(body, "plain", "utf-8"))
+    html = MIMEText(f"<html><body><pre>{body}</pre></body></html>", "html", "utf-8")
+    if image_size:
+        html = MIMEText(f"<html><body><img src=\"cid:logo\"><pre>{body}</pre></body></html>", "html", "utf-8")
+        related = MIMEMultipart("related")
+        related.attach(html)
+        image = MIMEImage(os.urandom(image_size), "png")
+        image["Content-ID"] = "<logo>"
+        related.attach(image)
+        html = related
+    msg.attach(html)
+    return msg.as_bytes()
+
+
+def make_corpus(n: int, image_size: int = 0) -> list[bytes]:
+    return [make_anapay_mail(i, image_size) for i in range(n)]